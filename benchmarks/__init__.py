@@ -0,0 +1 @@
+"""Benchmarks for the task reminder bot."""
@@ -0,0 +1,190 @@
+"""Bot API client settings against a local stub server.
+
+The stub runs in its own process, answers sendMessage after --latency
+ms, holds getUpdates for the requested long-poll timeout and counts the
+connections it accepts.
+Scenarios:
+
+    pool       a burst of sends through pools of different sizes:
+               throughput, p50/p99, pool timeouts, connections opened
+    keepalive  bursts separated by --gap seconds of silence, with PTB's
+               5 s keep-alive and a longer one: connections opened
+    polling    sends while getUpdates long-polls, with getUpdates sharing
+               the send pool and with its own request
+
+HTTP/2 is not covered: the stub (aiohttp) only speaks HTTP/1.1.
+
+    python -m benchmarks.bench_http_pool [--messages 2000] [--latency 20] [--gap 6]
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import time
+
+import httpx
+from aiohttp import web
+from telegram import Bot
+from telegram.error import TelegramError
+
+from bot_api import TimedHTTPXRequest
+
+TOKEN = '123:stub'
+
+
+class StubServer:
+    """Bot API stub; GET /connections returns and resets the count of new connections"""
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.connections = set()
+        self.counted = 0
+
+    async def handle_connections(self, request):
+        opened = len(self.connections) - self.counted
+        self.counted = len(self.connections)
+        return web.json_response(opened)
+
+    async def handle(self, request):
+        self.connections.add(request.transport.get_extra_info('peername'))
+        method = request.match_info['method']
+        data = await request.post() if request.content_type != 'application/json' else await request.json()
+        if method == 'getMe':
+            result = {'id': 1, 'is_bot': True, 'first_name': 'Stub', 'username': 'stub_bot'}
+        elif method == 'getUpdates':
+            await asyncio.sleep(float(data.get('timeout', 0)))
+            result = []
+        else:
+            await asyncio.sleep(self.latency)
+            result = {
+                'message_id': 1, 'date': int(time.time()), 'text': data.get('text', ''),
+                'chat': {'id': int(data.get('chat_id', 1)), 'type': 'private'},
+            }
+        return web.json_response({'ok': True, 'result': result}, dumps=json.dumps)
+
+    async def serve(self, ports):
+        app = web.Application()
+        app.router.add_post('/bot{token}/{method}', self.handle)
+        app.router.add_get('/connections', self.handle_connections)
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, '127.0.0.1', 0).start()
+        ports.put(runner.addresses[0][1])
+        await asyncio.Event().wait()
+
+
+def stub_main(latency, ports):
+    asyncio.run(StubServer(latency).serve(ports))
+
+
+async def connections_opened(port):
+    """New connections the stub accepted since the last call"""
+    async with httpx.AsyncClient() as client:
+        return (await client.get(f"http://127.0.0.1:{port}/connections")).json()
+
+
+async def make_bot(base_url, request, get_updates_request=None):
+    bot = Bot(TOKEN, base_url=base_url, request=request, get_updates_request=get_updates_request)
+    await bot.initialize()
+    return bot
+
+
+async def send_burst(bot, messages, concurrency):
+    """Send messages from `concurrency` tasks; return (seconds, failures)"""
+    failures = 0
+
+    async def sender(count):
+        nonlocal failures
+        for i in range(count):
+            try:
+                await bot.send_message(i, 'x')
+            except TelegramError:
+                failures += 1
+
+    started = time.perf_counter()
+    share = messages // concurrency
+    await asyncio.gather(*(sender(share) for _ in range(concurrency)))
+    return time.perf_counter() - started, failures
+
+
+def send_stats(request):
+    stats = request.stats()['sendMessage']
+    return f"p50={stats['p50'] * 1000:.1f}ms p99={stats['p99'] * 1000:.1f}ms pool_timeouts={stats['pool_timeouts']}"
+
+
+async def bench_pool(port, base_url, args):
+    print(f"pool: {args.messages} sends from 64 tasks, {args.latency}ms per call, pool timeout 1s")
+    for size in (1, 8, 64):
+        await connections_opened(port)
+        request = TimedHTTPXRequest(connection_pool_size=size, pool_timeout=1.0)
+        bot = await make_bot(base_url, request)
+        elapsed, failures = await send_burst(bot, args.messages, 64)
+        print(f"  pool={size:<3} {args.messages / elapsed:>7,.0f} msg/s failed={failures:<5} "
+              f"{send_stats(request)} connections={await connections_opened(port)}")
+        await bot.shutdown()
+
+
+async def bench_keepalive(port, base_url, args):
+    print(f"keepalive: 3 bursts of {args.messages // 10} sends, {args.gap}s apart, pool 16")
+    for keepalive in (5.0, 60.0):
+        request = TimedHTTPXRequest(connection_pool_size=16, keepalive=keepalive)
+        bot = await make_bot(base_url, request)
+        await connections_opened(port)
+        opened = []
+        for burst in range(3):
+            if burst:
+                await asyncio.sleep(args.gap)
+            await send_burst(bot, args.messages // 10, 16)
+            opened.append(await connections_opened(port))
+        print(f"  keepalive={keepalive:<4.0f}s connections opened per burst: {opened}")
+        await bot.shutdown()
+
+
+async def bench_polling(port, base_url, args):
+    print(f"polling: {args.messages // 4} sends from 4 tasks while getUpdates long-polls, pool 4")
+    for shared in (True, False):
+        request = TimedHTTPXRequest(connection_pool_size=4, pool_timeout=1.0)
+        get_updates_request = request if shared else TimedHTTPXRequest(connection_pool_size=1)
+        bot = await make_bot(base_url, request, get_updates_request)
+        polling = True
+
+        async def poll():
+            while polling:
+                await bot.get_updates(timeout=1, read_timeout=3)
+
+        poller = asyncio.create_task(poll())
+        await asyncio.sleep(0.1)
+        elapsed, failures = await send_burst(bot, args.messages // 4, 4)
+        polling = False
+        await poller
+        print(f"  {'shared pool  ' if shared else 'separate pool'} "
+              f"{args.messages // 4 / elapsed:>7,.0f} msg/s failed={failures:<5} {send_stats(request)}")
+        await bot.shutdown()
+
+
+async def run(port, args):
+    base_url = f"http://127.0.0.1:{port}/bot"
+    await bench_pool(port, base_url, args)
+    await bench_keepalive(port, base_url, args)
+    await bench_polling(port, base_url, args)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--messages', type=int, default=2000)
+    parser.add_argument('--latency', type=float, default=20)
+    parser.add_argument('--gap', type=float, default=6)
+    args = parser.parse_args()
+
+    context = multiprocessing.get_context('spawn')
+    ports = context.Queue()
+    stub = context.Process(target=stub_main, args=(args.latency / 1000, ports), daemon=True)
+    stub.start()
+    try:
+        asyncio.run(run(ports.get(timeout=30), args))
+    finally:
+        stub.terminate()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,194 @@
+"""Correctness and throughput of quick-add and bulk task input.
+
+Known lines are checked against the task they should give. Then
+generated quick-add lines are parsed one by one (parse_line) and as
+documents (parse_bulk) of quick-add lines, CSV and iCalendar, reported in
+lines per second. Finally a batch of tasks is stored task by task and as
+one insert_tasks() call, for each backend.
+
+    python -m benchmarks.bench_quickadd [--lines 200000] [--batch 1000]
+"""
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+from quickadd import parse_bulk, parse_line
+from storage import JsonBackend, SQLiteBackend
+
+# Sunday
+NOW = datetime(2030, 6, 2, 12, 0)
+
+CASES = [
+    ("Купить продукты завтра 14:30 каждую неделю", "Купить продукты", datetime(2030, 6, 3, 14, 30), {'freq': 'weekly'}),
+    ("Планёрка по будням в 10:00", "Планёрка", datetime(2030, 6, 3, 10, 0), {'freq': 'weekly', 'weekdays': [0, 1, 2, 3, 4]}),
+    ("Оплатить счета 25.06 каждый месяц", "Оплатить счета", datetime(2030, 6, 25, 9, 0), {'freq': 'monthly'}),
+    ("Позвонить маме через 2 часа", "Позвонить маме", datetime(2030, 6, 2, 14, 0), None),
+    ("Встреча в пятницу в 9:00", "Встреча", datetime(2030, 6, 7, 9, 0), None),
+    ("Отчёт к 01.02", "Отчёт", datetime(2031, 2, 1, 9, 0), None),
+    ("Бассейн каждый вторник и четверг 19:30", "Бассейн", datetime(2030, 6, 4, 19, 30), {'freq': 'weekly', 'weekdays': [1, 3]}),
+    ("Аренда в последний день месяца 10:00", "Аренда", datetime(2030, 6, 30, 10, 0), {'freq': 'monthly', 'day': 'last'}),
+    ("Полить цветы каждые 3 дня в 8:00", "Полить цветы", datetime(2030, 6, 3, 8, 0), {'freq': 'daily', 'interval': 3}),
+    ("Сдать 2030-06-20", "Сдать", datetime(2030, 6, 20, 9, 0), None),
+    ("на завтра купить хлеб в 9:15", "купить хлеб", datetime(2030, 6, 3, 9, 15), None),
+    ("Купить хлеб, молоко послезавтра", "Купить хлеб, молоко", datetime(2030, 6, 4, 9, 0), None),
+    ("привет", None, None, None),
+    ("Купить 1.5 литра молока завтра", "Купить 1.5 литра молока", datetime(2030, 6, 3, 9, 0), None),
+    ("Купить 1.5 литра молока через 2 часа", "Купить 1.5 литра молока", datetime(2030, 6, 2, 14, 0), None),
+]
+# Chat messages that are a task for the menu (strict parse_line) or not
+STRICT = [
+    ("Купить 1.5 литра молока", False),
+    ("Взять 2.5 кг и 1.5 литра", False),
+    ("Купить 1.5 литра молока завтра", True),
+    ("Отчёт к 01.05", True),
+    ("Отчёт 1.5.2031", True),
+    ("Созвон в 1:30", True),
+]
+ERRORS = ["Старое 01.01.2020 10:00", "Время 25:00", "Дата 31.02 10:00", "завтра 10:00"]
+
+NAMES = ["Купить продукты", "Позвонить маме", "Планёрка", "Оплатить счета", "Сдать отчёт", "Бассейн"]
+WHEN = ["завтра", "послезавтра", "в пятницу", "25.12", "01.07.2031", "2031-03-15", "через 3 дня", ""]
+TIMES = ["14:30", "в 9:00", "18:45", "07:15"]
+REPEATS = ["", "", "каждую неделю", "по будням", "ежедневно", "каждые 2 дня", "каждый вторник и четверг",
+           "в последний день месяца", "каждый год"]
+
+
+def check():
+    failures = []
+    for text, name, when, rule in CASES:
+        parsed = parse_line(text, NOW)
+        got = None if parsed is None else (parsed.name, parsed.when, parsed.rule and parsed.rule.to_dict())
+        want = None if name is None else (name, when, rule)
+        if got != want:
+            failures.append(f"{text!r}: got {got}, expected {want}")
+    for text in ERRORS:
+        try:
+            parse_line(text, NOW)
+        except ValueError:
+            continue
+        failures.append(f"{text!r}: no error")
+    for text, task in STRICT:
+        if (parse_line(text, NOW, strict=True) is not None) != task:
+            failures.append(f"{text!r}: {'not ' if task else ''}a task in strict mode")
+    return failures
+
+
+def make_lines(count, seed):
+    rng = random.Random(seed)
+    return [
+        " ".join(part for part in (rng.choice(NAMES), rng.choice(WHEN), rng.choice(TIMES), rng.choice(REPEATS)) if part)
+        for _ in range(count)
+    ]
+
+
+def make_csv(count, seed):
+    rng = random.Random(seed)
+    rows = ["Название;Дата;Время;Повтор"]
+    for i in range(count):
+        rows.append(f"{rng.choice(NAMES)} {i};{rng.randint(1, 28):02d}.{rng.randint(1, 12):02d}.2031;"
+                    f"{rng.randint(0, 23):02d}:{rng.choice(['00', '15', '30', '45'])};"
+                    f"{rng.choice(['', 'daily', 'weekly', 'по будням', 'каждые 2 дня'])}")
+    return "\n".join(rows)
+
+
+def make_ics(count, seed):
+    rng = random.Random(seed)
+    lines = ["BEGIN:VCALENDAR", "VERSION:2.0"]
+    for i in range(count):
+        lines += [
+            "BEGIN:VEVENT",
+            f"UID:{i}@bench",
+            f"SUMMARY:{rng.choice(NAMES)} {i}",
+            f"DTSTART:2031{rng.randint(1, 12):02d}{rng.randint(1, 28):02d}T{rng.randint(0, 23):02d}0000Z",
+        ]
+        if rng.random() < 0.5:
+            lines.append(rng.choice(["RRULE:FREQ=DAILY", "RRULE:FREQ=WEEKLY;BYDAY=MO,WE,FR",
+                                     "RRULE:FREQ=MONTHLY;BYMONTHDAY=-1", "RRULE:FREQ=YEARLY;COUNT=5"]))
+        lines.append("END:VEVENT")
+    lines.append("END:VCALENDAR")
+    return "\n".join(lines)
+
+
+def rate(count, func):
+    started = time.perf_counter()
+    func()
+    return count / (time.perf_counter() - started)
+
+
+def run_parsing(count, seed):
+    lines = make_lines(count, seed)
+    text, csv_text, ics_text = "\n".join(lines), make_csv(count, seed), make_ics(count, seed)
+    results = {
+        'parse_line': rate(count, lambda: [parse_line(line, NOW) for line in lines]),
+        'bulk lines': rate(count, lambda: list(parse_bulk(text, NOW))),
+        'bulk csv': rate(count, lambda: list(parse_bulk(csv_text, NOW))),
+        'bulk ics': rate(count, lambda: list(parse_bulk(ics_text, NOW, 'Europe/Moscow'))),
+    }
+    failed = sum(1 for _, parsed in parse_bulk(text, NOW) if isinstance(parsed, ValueError))
+    return results, failed
+
+
+def run_store(batch):
+    tasks = [
+        parsed.to_task('Europe/Moscow', time.time()).to_dict()
+        for _, parsed in parse_bulk(make_csv(batch, 1), NOW)
+        if not isinstance(parsed, ValueError)
+    ]
+    results = {}
+    backends = {
+        'json': lambda path: JsonBackend(os.path.join(path, 'tasks.json')),
+        'sqlite': lambda path: SQLiteBackend(os.path.join(path, 'tasks.db')),
+        'sqlite autocommit': lambda path: SQLiteBackend(os.path.join(path, 'tasks.db'), autocommit=True),
+    }
+    for name, factory in backends.items():
+        for mode in ('one by one', 'batch'):
+            workdir = tempfile.mkdtemp()
+            try:
+                backend = factory(workdir)
+                backend.load_all()
+                copies = [dict(task) for task in tasks]
+                started = time.perf_counter()
+                if mode == 'batch':
+                    backend.insert_tasks('1', copies)
+                else:
+                    for task in copies:
+                        backend.insert_task('1', task)
+                backend.flush()
+                results[name, mode] = (time.perf_counter() - started) * 1000
+                backend.close()
+            finally:
+                shutil.rmtree(workdir)
+    return len(tasks), results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--lines', type=int, default=200000)
+    parser.add_argument('--batch', type=int, default=1000)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    failures = check()
+    print(f"checks: {len(CASES) + len(ERRORS) + len(STRICT)} lines, {len(failures)} failures")
+    for failure in failures:
+        print("  " + failure)
+
+    results, failed = run_parsing(args.lines, args.seed)
+    print(f"{'input':<12} {'lines/s':>10}   ({failed} of {args.lines} generated lines rejected)")
+    for name, value in results.items():
+        print(f"{name:<12} {value:>10,.0f}")
+
+    count, results = run_store(args.batch)
+    print(f"{'backend':<18} {'mode':<11} {'ms':>8}   ({count} tasks)")
+    for (name, mode), elapsed in results.items():
+        print(f"{name:<18} {mode:<11} {elapsed:>8.1f}")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
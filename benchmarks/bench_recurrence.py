@@ -0,0 +1,175 @@
+"""Property checks and throughput of the recurrence engine.
+
+Random rules are checked against a brute-force reference that walks the
+calendar day by day and tests each day against the rule's definition;
+next_after(), first() and occurrences() must agree with it, and rules
+must survive a to_dict()/from_dict() round trip. Then next_after() is
+timed for moments up to 30 years after the start, which the engine
+answers from the anchor without walking the occurrences in between.
+
+    python -m benchmarks.bench_recurrence [--cases 500] [--ops 1000000] [--seed 1]
+"""
+import argparse
+import random
+import sys
+import time
+from datetime import date, datetime, timedelta
+
+from recurrence import FREQUENCIES, Recurrence
+
+HORIZON_YEARS = {'daily': 3, 'weekly': 5, 'monthly': 25, 'yearly': 120}
+MAX_GAP_DAYS = {'daily': 40, 'weekly': 40, 'monthly': 200, 'yearly': 2000}
+
+
+def last_day(year, month):
+    following = date(year + month // 12, month % 12 + 1, 1)
+    return (following - timedelta(days=1)).day
+
+
+def target_day(rule, start, year, month):
+    last = last_day(year, month)
+    if rule.day == 'last':
+        return last
+    if rule.day == 'last_business':
+        day = last
+        while date(year, month, day).weekday() >= 5:
+            day -= 1
+        return day
+    return min(start.day, last)
+
+
+def reference(rule, start):
+    """Occurrences within the horizon by definition, and whether the series ends in it"""
+    first_day = start.date()
+    first_monday = first_day - timedelta(days=first_day.weekday())
+    n = rule.interval
+    result = []
+    for i in range(HORIZON_YEARS[rule.freq] * 366):
+        day = first_day + timedelta(days=i)
+        if rule.freq == 'daily':
+            ok = i % n == 0 and (rule.weekdays is None or day.weekday() in rule.weekdays)
+        elif rule.freq == 'weekly':
+            weekdays = rule.weekdays if rule.weekdays is not None else {first_day.weekday()}
+            ok = ((day - first_monday).days // 7) % n == 0 and day.weekday() in weekdays
+        else:
+            step = n if rule.freq == 'monthly' else 12 * n
+            months = (day.year - start.year) * 12 + day.month - start.month
+            ok = months % step == 0 and day.day == target_day(rule, start, day.year, day.month)
+        if ok:
+            result.append(datetime.combine(day, start.time()))
+    horizon = datetime.combine(first_day + timedelta(days=HORIZON_YEARS[rule.freq] * 366), start.time())
+    complete = (
+        (rule.count is not None and len(result) >= rule.count)
+        or (rule.until is not None and rule.until < horizon)
+    )
+    if rule.count is not None:
+        result = result[:rule.count]
+    if rule.until is not None:
+        result = [when for when in result if when <= rule.until]
+    return [when for when in result if when not in rule.exdates], complete
+
+
+def random_rule(rng, start):
+    freq = rng.choice(FREQUENCIES)
+    kwargs = {'interval': rng.choice([1, 1, 2, 3, 5])}
+    if freq in ('daily', 'weekly') and rng.random() < 0.5:
+        kwargs['weekdays'] = rng.sample(range(7), rng.randint(1, 5))
+    if freq in ('monthly', 'yearly'):
+        kwargs['day'] = rng.choice([None, None, 'last', 'last_business'])
+    if rng.random() < 0.3:
+        kwargs['until'] = start + timedelta(days=rng.randint(0, 366 * HORIZON_YEARS[freq] // 2))
+    if rng.random() < 0.3:
+        kwargs['count'] = rng.randint(1, 40)
+    rule = Recurrence(freq, **kwargs)
+    if rng.random() < 0.3:
+        occurrences = reference(rule, start)[0][:60]
+        rule.exdates = frozenset(rng.sample(occurrences, min(len(occurrences), rng.randint(1, 3))))
+    return rule
+
+
+def random_start(rng):
+    return datetime(2020, 1, 1, rng.randint(0, 23), rng.choice([0, 15, 30, 45])) + timedelta(
+        days=rng.randint(0, 3000)
+    )
+
+
+def check(rule, start, rng, failures):
+    expected, complete = reference(rule, start)
+    horizon = start + timedelta(days=366 * HORIZON_YEARS[rule.freq] - MAX_GAP_DAYS[rule.freq])
+
+    def fail(what, got, want):
+        failures.append(f"{rule!r} start={start} {what}: got {got}, expected {want}")
+
+    if Recurrence.from_dict(rule.to_dict()) != rule:
+        fail("round trip", Recurrence.from_dict(rule.to_dict()), rule)
+    want_first = expected[0] if expected else None
+    if (want_first is not None or complete) and rule.first(start) != want_first:
+        fail("first()", rule.first(start), want_first)
+
+    for _ in range(20):
+        after = start + timedelta(minutes=rng.randint(-1440, int((horizon - start).total_seconds() // 60)))
+        later = [when for when in expected if when > after]
+        if not later and not complete:
+            continue
+        want = later[0] if later else None
+        got = rule.next_after(start, after)
+        if got != want:
+            fail(f"next_after({after})", got, want)
+        got_list = [when for _, when in zip(range(10), rule.occurrences(start, after))]
+        if later[:10] != got_list and (len(later) >= 10 or complete):
+            fail(f"occurrences({after})", got_list, later[:10])
+
+
+def run_properties(cases, seed):
+    rng = random.Random(seed)
+    failures = []
+    for _ in range(cases):
+        start = random_start(rng)
+        check(random_rule(rng, start), start, rng, failures)
+    return failures
+
+
+def run_throughput(ops, seed):
+    rng = random.Random(seed)
+    rules = [(random_rule(rng, start), start) for start in (random_start(rng) for _ in range(1000))]
+    for rule, _ in rules:
+        rule.count = rule.until = None
+    queries = [
+        (rule, start, start + timedelta(minutes=rng.randint(0, 30 * 366 * 1440)))
+        for rule, start in rules for _ in range(10)
+    ]
+    results = {}
+    for freq in FREQUENCIES:
+        selected = [q for q in queries if q[0].freq == freq]
+        started = time.perf_counter()
+        done = 0
+        while done < ops // len(FREQUENCIES):
+            for rule, start, after in selected:
+                rule.next_after(start, after)
+            done += len(selected)
+        results[freq] = done / (time.perf_counter() - started)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--cases', type=int, default=500)
+    parser.add_argument('--ops', type=int, default=1000000)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    failures = run_properties(args.cases, args.seed)
+    print(f"property checks: {args.cases} rules, {len(failures)} failures "
+          f"({time.perf_counter() - started:.1f}s)")
+    for failure in failures[:20]:
+        print("  " + failure)
+
+    print(f"{'freq':<8} {'next_after/s':>13}")
+    for freq, rate in run_throughput(args.ops, args.seed).items():
+        print(f"{freq:<8} {rate:>13,.0f}")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+"""Handler latency while tasks are being saved, for growing store sizes.
+
+Compares the old save (json.dump of the whole document on the event loop)
+with JsonBackend.flush_async(). A fake handler changes one user's task
+every few milliseconds; we report its latency percentiles while the store
+is flushed continuously in the background.
+
+    python -m benchmarks.bench_save [--sizes 1000 10000 100000]
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import tempfile
+import time
+
+from storage import JsonBackend
+
+
+def make_tasks(task_count, tasks_per_user=10):
+    tasks = {}
+    for i in range(task_count):
+        user_id = str(100000 + i // tasks_per_user)
+        tasks.setdefault(user_id, []).append({
+            'name': f"Задача {i}",
+            'date': '25.11.2030',
+            'time': '14:30',
+            'datetime': '2030-11-25T14:30:00',
+            'repeat': 'none',
+            'created_at': '2025-01-01T00:00:00',
+        })
+    return tasks
+
+
+async def run_handlers(backend, tasks, duration):
+    """Mutate one user at a time and measure how late each handler runs"""
+    user_ids = list(tasks)
+    latencies = []
+    deadline = time.perf_counter() + duration
+    i = 0
+    while time.perf_counter() < deadline:
+        started = time.perf_counter()
+        await asyncio.sleep(0.002)
+        user_id = user_ids[i % len(user_ids)]
+        task = tasks[user_id][0]
+        task['name'] = f"Задача {i}"
+        backend.update_task(user_id, task)
+        latencies.append(time.perf_counter() - started - 0.002)
+        i += 1
+    return latencies
+
+
+async def legacy_flusher(path, tasks, stop):
+    while not stop.is_set():
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(tasks, f, ensure_ascii=False, indent=2)
+        await asyncio.sleep(0.05)
+
+
+async def async_flusher(backend, stop):
+    while not stop.is_set():
+        await backend.flush_async()
+        await asyncio.sleep(0.05)
+
+
+async def measure(mode, task_count, duration):
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'tasks.json')
+        backend = JsonBackend(path)
+        backend.save_all(make_tasks(task_count))
+        tasks = backend.load_all()
+        stop = asyncio.Event()
+        if mode == 'legacy':
+            flusher = asyncio.create_task(legacy_flusher(path, tasks, stop))
+        else:
+            flusher = asyncio.create_task(async_flusher(backend, stop))
+        latencies = await run_handlers(backend, tasks, duration)
+        stop.set()
+        await flusher
+    latencies.sort()
+    return {
+        'mode': mode,
+        'tasks': task_count,
+        'handled': len(latencies),
+        'p50_ms': statistics.median(latencies) * 1000,
+        'p99_ms': latencies[int(len(latencies) * 0.99)] * 1000,
+        'max_ms': latencies[-1] * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--duration', type=float, default=3.0)
+    args = parser.parse_args()
+
+    print(f"{'mode':<8} {'tasks':>8} {'handled':>8} {'p50 ms':>8} {'p99 ms':>8} {'max ms':>8}")
+    for size in args.sizes:
+        for mode in ('legacy', 'async'):
+            r = asyncio.run(measure(mode, size, args.duration))
+            print(f"{r['mode']:<8} {r['tasks']:>8} {r['handled']:>8} "
+                  f"{r['p50_ms']:>8.2f} {r['p99_ms']:>8.2f} {r['max_ms']:>8.2f}")
+
+
+if __name__ == '__main__':
+    main()
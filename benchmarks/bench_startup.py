@@ -0,0 +1,186 @@
+"""Cold start at 100k and 1M tasks.
+
+Every run is a fresh process in its own directory with a generated
+fixture, going through the bot's startup with a fake Bot:
+
+    blocking    task_store.load() and the reminder engine before the
+                application starts, the order main() used to have
+    background  main()'s order: the application starts and on_startup
+                loads the tasks in the background
+
+A /listtasks is sent as soon as the application accepts updates. Each run
+reports when updates are accepted (ready), when that first reply is
+sent, when the tasks are loaded and reminders armed, the longest stall
+of the event loop and the peak RSS. The SQLite store is imported from
+the same fixture. Fixtures are kept in --cache if it is given.
+
+    python -m benchmarks.bench_startup [--tasks 100000 1000000] [--backend json sqlite] [--cache DIR]
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from telegram.ext import Application
+
+from benchmarks.fixtures import user_id, write_fixture
+from benchmarks.suite import Driver, InstantBot, peak_rss_mb
+from storage import migrate_json_to_sqlite
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MODES = ('blocking', 'background')
+
+
+class StallMonitor:
+    """Longest time the event loop did not get to a 1 ms timer"""
+
+    def __init__(self):
+        self.longest = 0.0
+        self._task = None
+
+    async def _run(self):
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(0.001)
+            self.longest = max(self.longest, time.perf_counter() - started - 0.001)
+
+    async def start(self):
+        self._task = asyncio.create_task(self._run())
+        await asyncio.sleep(0)
+
+    def stop(self):
+        self._task.cancel()
+
+
+async def measure(bot, mode):
+    application = (
+        Application.builder()
+        .bot(InstantBot(bot.TELEGRAM_BOT_TOKEN))
+        .concurrent_updates(bot.PerUserUpdateProcessor(bot.CONCURRENT_UPDATES))
+        .updater(None)
+        .build()
+    )
+    bot.register_handlers(application)
+    stalls = StallMonitor()
+    await stalls.start()
+    result = {}
+
+    started = time.perf_counter()
+    if mode == 'blocking':
+        bot.task_store.load()
+        bot.reminder_engine.start(application.job_queue, bot.deliver_reminder)
+    await application.initialize()
+    if mode == 'blocking':
+        bot.dispatcher.start(application.bot)
+        bot.outbox.load()
+        bot.outbox.start()
+    else:
+        await bot.on_startup(application)
+    await application.start()
+    result['ready_s'] = time.perf_counter() - started
+
+    await Driver(application, 1).send(user_id(0), '/listtasks')
+    result['first_reply_s'] = time.perf_counter() - started
+    await bot.task_store.loaded.wait()
+    result['loaded_s'] = time.perf_counter() - started
+    while bot.reminder_engine.deliver is None:
+        await asyncio.sleep(0.01)
+    result['armed_s'] = time.perf_counter() - started
+
+    # The monitor measures a stall when it runs again after it
+    await asyncio.sleep(0.01)
+    stalls.stop()
+    result['stall_ms'] = stalls.longest * 1000
+    result['tasks'] = len(bot.task_store)
+    result['scheduled'] = len(bot.reminder_engine)
+    result['peak_rss_mb'] = peak_rss_mb()
+    await application.stop()
+    await bot.on_stop(application)
+    await application.shutdown()
+    return result
+
+
+def command_measure(mode):
+    """Runs in the child process, in the directory with the store"""
+    import task_reminder_bot
+    logging.getLogger().setLevel(logging.WARNING)
+    print(json.dumps(asyncio.run(measure(task_reminder_bot, mode))))
+
+
+def prepare(cache, tasks, tasks_per_user, backend):
+    """Path of the fixture with about `tasks` tasks for the backend, generated if needed"""
+    path = os.path.join(cache, f"tasks_{tasks}.json")
+    if not os.path.exists(path):
+        started = time.perf_counter()
+        count = write_fixture(path, tasks // tasks_per_user, tasks_per_user)
+        print(f"fixture {path}: {count} tasks ({time.perf_counter() - started:.1f}s)", flush=True)
+    if backend == 'json':
+        return path
+    db_path = os.path.join(cache, f"tasks_{tasks}.db")
+    if not os.path.exists(db_path):
+        started = time.perf_counter()
+        migrate_json_to_sqlite(path, db_path)
+        print(f"fixture {db_path} ({time.perf_counter() - started:.1f}s)", flush=True)
+    return db_path
+
+
+def run_child(fixture, backend, mode):
+    workdir = tempfile.mkdtemp()
+    try:
+        if backend == 'json':
+            # The backend replaces tasks.json on compaction, never the fixture itself
+            os.symlink(fixture, os.path.join(workdir, 'tasks.json'))
+        else:
+            shutil.copy(fixture, os.path.join(workdir, 'tasks.db'))
+        env = dict(os.environ, STORAGE_BACKEND=backend, PYTHONPATH=ROOT)
+        output = subprocess.run(
+            [sys.executable, '-m', 'benchmarks.bench_startup', '--measure', mode],
+            cwd=workdir, env=env, capture_output=True, text=True
+        )
+        if output.returncode:
+            sys.exit(output.stderr)
+        return json.loads(output.stdout.splitlines()[-1])
+    finally:
+        shutil.rmtree(workdir)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--tasks', type=int, nargs='+', default=[100000, 1000000])
+    parser.add_argument('--tasks-per-user', type=int, default=5)
+    parser.add_argument('--backend', nargs='+', choices=('json', 'sqlite'), default=['json', 'sqlite'])
+    parser.add_argument('--modes', nargs='+', choices=MODES, default=list(MODES))
+    parser.add_argument('--cache', help='directory to keep fixtures in between runs')
+    parser.add_argument('--measure', choices=MODES, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.measure:
+        command_measure(args.measure)
+        return
+
+    cache = os.path.abspath(args.cache) if args.cache else tempfile.mkdtemp()
+    os.makedirs(cache, exist_ok=True)
+    try:
+        print(f"{'tasks':>8} {'backend':<7} {'mode':<10} {'ready':>7} {'reply':>7} {'loaded':>7} "
+              f"{'armed':>7} {'stall':>8} {'rss':>7}")
+        for tasks in args.tasks:
+            for backend in args.backend:
+                fixture = prepare(cache, tasks, args.tasks_per_user, backend)
+                for mode in args.modes:
+                    r = run_child(fixture, backend, mode)
+                    print(f"{r['tasks']:>8} {backend:<7} {mode:<10} {r['ready_s']:>6.2f}s "
+                          f"{r['first_reply_s']:>6.2f}s {r['loaded_s']:>6.2f}s {r['armed_s']:>6.2f}s "
+                          f"{r['stall_ms']:>6.0f}ms {r['peak_rss_mb']:>5.0f}MB", flush=True)
+    finally:
+        if not args.cache:
+            shutil.rmtree(cache)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,134 @@
+"""Memory per task and reminder tick time: task dicts vs Task objects.
+
+The dict form is the stored JSON shape that the bot used to keep in
+memory, with the due time as 'date', 'time' and an ISO 'datetime' string.
+A tick is what the reminder path does for one due task: take the earliest
+task from the heap, read its due time, and queue the next occurrence of a
+daily task. Index build is the startup cost of ordering every task by due
+time.
+
+    python -m benchmarks.bench_task_model [--sizes 10000 100000]
+"""
+import argparse
+import gc
+import heapq
+import time
+import tracemalloc
+from datetime import datetime, timedelta, timezone
+
+from models import Repeat, Task
+
+START = datetime(2030, 1, 1, 9, 0, tzinfo=timezone.utc)
+
+
+def make_dicts(count):
+    tasks = []
+    for i in range(count):
+        due = START + timedelta(minutes=i)
+        # 'date' and 'time' are in the server's zone, as for tasks without 'tz'
+        local = due.astimezone()
+        tasks.append({
+            'name': f"Задача {i}",
+            'date': local.strftime('%d.%m.%Y'),
+            'time': local.strftime('%H:%M'),
+            'datetime': due.isoformat(),
+            'repeat': 'daily',
+            'created_at': START.isoformat(),
+            'id': i + 1,
+        })
+    return tasks
+
+
+def make_objects(count):
+    return [Task.from_dict(data) for data in make_dicts(count)]
+
+
+def measure_memory(factory, count):
+    """Bytes allocated per task while building `count` tasks"""
+    gc.collect()
+    tracemalloc.start()
+    tasks = factory(count)
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del tasks
+    return current / count
+
+
+def build_dicts(tasks):
+    heap = [(datetime.fromisoformat(t['datetime']).timestamp(), t['id'], t) for t in tasks]
+    heapq.heapify(heap)
+    return heap
+
+
+def build_objects(tasks):
+    heap = [(t.due, t.id, t) for t in tasks]
+    heapq.heapify(heap)
+    return heap
+
+
+def tick_dicts(heap, next_id):
+    _, _, task = heapq.heappop(heap)
+    due = datetime.fromisoformat(task['datetime'])
+    next_due = due + timedelta(days=1)
+    new_task = {
+        'name': task['name'],
+        'date': next_due.strftime('%d.%m.%Y'),
+        'time': next_due.strftime('%H:%M'),
+        'datetime': next_due.isoformat(),
+        'repeat': task['repeat'],
+        'created_at': task['created_at'],
+        'id': next_id,
+    }
+    heapq.heappush(heap, (next_due.timestamp(), next_id, new_task))
+
+
+def tick_objects(heap, next_id):
+    _, _, task = heapq.heappop(heap)
+    next_due = task.due + 86400
+    new_task = Task(name=task.name, due=next_due, repeat=task.repeat,
+                    created=task.created, id=next_id)
+    heapq.heappush(heap, (next_due, next_id, new_task))
+
+
+def measure(kind, count, ticks):
+    tasks = make_dicts(count) if kind == 'dict' else make_objects(count)
+    build, tick = (build_dicts, tick_dicts) if kind == 'dict' else (build_objects, tick_objects)
+
+    started = time.perf_counter()
+    heap = build(tasks)
+    build_ms = (time.perf_counter() - started) * 1000
+
+    started = time.perf_counter()
+    for i in range(ticks):
+        tick(heap, count + i + 1)
+    tick_us = (time.perf_counter() - started) / ticks * 1e6
+
+    factory = make_dicts if kind == 'dict' else make_objects
+    return {
+        'kind': kind,
+        'tasks': count,
+        'bytes_per_task': measure_memory(factory, count),
+        'build_ms': build_ms,
+        'tick_us': tick_us,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000])
+    parser.add_argument('--ticks', type=int, default=50000)
+    args = parser.parse_args()
+
+    assert Task.from_dict(make_dicts(1)[0]).to_dict() == make_dicts(1)[0]
+    assert Task.from_dict(make_dicts(1)[0]).repeat is Repeat.DAILY
+
+    print(f"{'kind':<8} {'tasks':>8} {'bytes/task':>11} {'build ms':>9} {'tick us':>8}")
+    for size in args.sizes:
+        for kind in ('dict', 'task'):
+            r = measure(kind, size, args.ticks)
+            print(f"{r['kind']:<8} {r['tasks']:>8} {r['bytes_per_task']:>11.0f} "
+                  f"{r['build_ms']:>9.1f} {r['tick_us']:>8.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,128 @@
+"""Synthetic tasks.json fixtures for benchmarks.
+
+Writes a snapshot in the format JsonBackend reads, one user at a time, so
+fixtures of a million users are generated in constant memory. Every user
+gets 1 to 2 * --tasks-per-user tasks with mixed repeat types: one-off
+tasks (some already reminded), simple daily/weekly/monthly/yearly
+repeats and RRULE-style rules, repeating ones with a history of fired
+occurrences. A share of the pending tasks (--overdue) is due within the
+last hour, so startup has reminders to catch up on.
+
+    python -m benchmarks.fixtures --users 100000 [--tasks-per-user 5] [--overdue 0] [--out tasks.json]
+"""
+import argparse
+import json
+import random
+import time
+from datetime import datetime, timedelta
+
+from models import HISTORY_LIMIT, Repeat, Task
+from recurrence import SIMPLE_RULES, Recurrence
+
+FIRST_USER_ID = 100000000
+
+RULES = (
+    Recurrence('weekly', weekdays={0, 2, 4}),
+    Recurrence('daily', interval=2),
+    Recurrence('daily', weekdays={0, 1, 2, 3, 4}),
+    Recurrence('weekly', interval=2),
+    Recurrence('monthly', day='last_business'),
+)
+
+# (kind, weight): how often each kind of task occurs
+KINDS = (
+    ('once', 40), ('reminded', 15), ('daily', 12), ('weekly', 10),
+    ('monthly', 8), ('yearly', 5), ('rule', 10),
+)
+
+
+def user_id(i):
+    """Id of the i-th user of a fixture"""
+    return str(FIRST_USER_ID + i)
+
+
+def make_task(rng, kind, now, overdue):
+    minute = now.replace(second=0, microsecond=0)
+    created = (minute - timedelta(days=rng.randint(1, 400))).timestamp()
+    name = f"Задача {rng.randint(1, 10 ** 6)}"
+    if kind == 'reminded':
+        due = minute - timedelta(minutes=rng.randint(60, 365 * 24 * 60))
+        return Task(name=name, due=due.timestamp(), created=created, reminded=True)
+    is_overdue = rng.random() < overdue
+    if is_overdue:
+        due = minute - timedelta(minutes=rng.randint(1, 60))
+    else:
+        due = minute + timedelta(minutes=rng.randint(60, 365 * 24 * 60))
+    if kind == 'once':
+        return Task(name=name, due=due.timestamp(), created=created)
+
+    rule = rng.choice(RULES) if kind == 'rule' else SIMPLE_RULES[kind]
+    task = Task(
+        name=name,
+        due=due.timestamp(),
+        repeat=Repeat(rule.freq),
+        created=created,
+        rule=rule if kind == 'rule' else None
+    )
+    # Half of the pending series started during the last two weeks and
+    # have fired since
+    if not is_overdue and rng.random() < 0.5:
+        start = rule.first(minute - timedelta(days=rng.randint(1, 14), minutes=rng.randint(0, 1439)))
+        history = []
+        for when in rule.occurrences(start, start - timedelta(seconds=1)):
+            if when > minute:
+                task.due = when.timestamp()
+                break
+            history.append(when.timestamp())
+        task.start = start.timestamp()
+        task.history = tuple(history[-HISTORY_LIMIT:])
+    return task
+
+
+def generate(users, tasks_per_user=5, overdue=0.0, seed=1, now=None):
+    """Yield (user_id, [task dict, ...]) for every user, with ids assigned in order"""
+    rng = random.Random(seed)
+    now = now or datetime.now()
+    kinds = [kind for kind, _ in KINDS]
+    weights = [weight for _, weight in KINDS]
+    next_id = 1
+    for i in range(users):
+        tasks = []
+        for kind in rng.choices(kinds, weights, k=rng.randint(1, 2 * tasks_per_user - 1)):
+            data = make_task(rng, kind, now, overdue).to_dict()
+            data['id'] = next_id
+            next_id += 1
+            tasks.append(data)
+        yield user_id(i), tasks
+
+
+def write_fixture(path, users, tasks_per_user=5, overdue=0.0, seed=1):
+    """Write a fixture to `path`; return the number of tasks"""
+    count = 0
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('{\n')
+        for i, (owner, tasks) in enumerate(generate(users, tasks_per_user, overdue, seed)):
+            if i:
+                f.write(',\n')
+            f.write(json.dumps(owner) + ': ' + json.dumps(tasks, ensure_ascii=False))
+            count += len(tasks)
+        f.write('\n}\n')
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=100000)
+    parser.add_argument('--tasks-per-user', type=int, default=5)
+    parser.add_argument('--overdue', type=float, default=0.0, help='share of pending tasks that are due')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--out', default='tasks.json')
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    count = write_fixture(args.out, args.users, args.tasks_per_user, args.overdue, args.seed)
+    print(f"{args.out}: users={args.users} tasks={count} time={time.perf_counter() - started:.1f}s")
+
+
+if __name__ == '__main__':
+    main()
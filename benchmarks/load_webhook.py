@@ -0,0 +1,145 @@
+"""Load test of the webhook server.
+
+Recorded updates (one Telegram update JSON per line) are replayed over
+HTTP against a local WebhookServer that feeds the bot's real handlers,
+with a fake Bot answering API calls. Updates of one user always go over
+the same keep-alive connection in their recorded order, like Telegram
+delivers them. Without --updates, a session of /start, /addtask,
+/listtasks per user is generated (and can be written with --save).
+Reports throughput, HTTP response latency and handler latency (from
+receiving an update to the end of its handlers) as p50/p99.
+
+    python -m benchmarks.load_webhook [--updates FILE] [--users 500] [--connections 40]
+"""
+import argparse
+import asyncio
+import json
+import os
+import tempfile
+import time
+from collections import defaultdict
+
+import aiohttp
+from aiohttp import web
+from telegram.ext import Application
+
+from benchmarks.stress_concurrency import FakeBot, update_data
+from scheduler import LatencyTracker
+from webhook import SECRET_HEADER, WebhookServer
+
+SECRET = 'load-test-secret'
+
+
+def generate_updates(users):
+    updates = []
+    for user in range(users):
+        user_id = 1000 + user
+        texts = ['/start', '/addtask', f"task {user}", '01.01.2040', '10:00', '❌ Не повторять', '/listtasks']
+        for text in texts:
+            updates.append(update_data(len(updates) + 1, user_id, text))
+    return updates
+
+
+def sender_id(update):
+    for kind in ('message', 'edited_message', 'callback_query'):
+        if kind in update:
+            return update[kind]['from']['id']
+    return None
+
+
+async def replay(url, updates, connections):
+    """POST updates over `connections` connections; return per-request latency and retries"""
+    queues = defaultdict(list)
+    for update in updates:
+        queues[hash(sender_id(update)) % connections].append(update)
+
+    latency = LatencyTracker(size=len(updates))
+    retries = 0
+    connector = aiohttp.TCPConnector(limit=connections)
+    async with aiohttp.ClientSession(connector=connector, headers={SECRET_HEADER: SECRET}) as session:
+
+        async def send_all(batch):
+            nonlocal retries
+            for update in batch:
+                while True:
+                    started = time.perf_counter()
+                    async with session.post(url, json=update) as response:
+                        await response.read()
+                    if response.status != 503:
+                        break
+                    # Telegram retries a rejected update after a while
+                    retries += 1
+                    await asyncio.sleep(0.05)
+                if response.status != 200:
+                    raise RuntimeError(f"Webhook answered {response.status}")
+                latency.add(time.perf_counter() - started)
+
+        await asyncio.gather(*(send_all(batch) for batch in queues.values()))
+    return latency, retries
+
+
+async def run(bot_module, updates, args):
+    application = (
+        Application.builder()
+        .bot(FakeBot(bot_module.TELEGRAM_BOT_TOKEN))
+        .concurrent_updates(bot_module.PerUserUpdateProcessor(args.concurrency))
+        .updater(None)
+        .build()
+    )
+    bot_module.register_handlers(application)
+    bot_module.task_store.load()
+    await application.initialize()
+    await application.start()
+
+    server = WebhookServer(application, '/telegram', SECRET, max_pending=args.max_pending)
+    runner = web.AppRunner(server.make_app(), access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    port = runner.addresses[0][1]
+
+    started = time.perf_counter()
+    http, retries = await replay(f"http://127.0.0.1:{port}/telegram", updates, args.connections)
+    while server.pending:
+        await asyncio.sleep(0.01)
+    elapsed = time.perf_counter() - started
+
+    await runner.cleanup()
+    await application.stop()
+    await application.shutdown()
+
+    print(f"updates={len(updates)} connections={args.connections} time={elapsed:.2f}s "
+          f"throughput={len(updates) / elapsed:,.0f} upd/s rejected={retries}")
+    for name, tracker in (('http', http), ('handler', server.latency)):
+        stats = tracker.summary()
+        print(f"{name:<8} p50={stats['p50'] * 1000:.1f}ms p99={stats['p99'] * 1000:.1f}ms "
+              f"max={stats['max'] * 1000:.1f}ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--updates', help='JSONL file with recorded updates')
+    parser.add_argument('--save', help='write the generated updates to this JSONL file')
+    parser.add_argument('--users', type=int, default=500)
+    parser.add_argument('--connections', type=int, default=40)
+    parser.add_argument('--concurrency', type=int, default=64)
+    parser.add_argument('--max-pending', type=int, default=1000)
+    args = parser.parse_args()
+
+    if args.updates:
+        with open(args.updates, encoding='utf-8') as f:
+            updates = [json.loads(line) for line in f if line.strip()]
+    else:
+        updates = generate_updates(args.users)
+    if args.save:
+        with open(args.save, 'w', encoding='utf-8') as f:
+            for update in updates:
+                f.write(json.dumps(update, ensure_ascii=False) + '\n')
+
+    os.chdir(tempfile.mkdtemp())
+    import task_reminder_bot
+    asyncio.run(run(task_reminder_bot, updates, args))
+
+
+if __name__ == '__main__':
+    main()
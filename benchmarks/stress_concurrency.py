@@ -0,0 +1,136 @@
+"""Stress test for concurrent update handling.
+
+Many users run the /addtask conversation at the same time while their
+repeating tasks keep firing. Updates are fed through the update processor
+exactly as the bot's update fetcher does, and handlers reply through a
+fake Bot that yields to the event loop, so updates really interleave.
+At the end every user must have all the tasks they added, and the
+repeating task must have every fired occurrence in its history; any
+difference is a lost update.
+
+    python -m benchmarks.stress_concurrency [--users 200] [--tasks 5] [--processor per-user|simple]
+"""
+import argparse
+import asyncio
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+from telegram import Update, User
+from telegram.ext import Application, ExtBot, SimpleUpdateProcessor
+
+from models import Repeat, Task
+
+
+class FakeBot(ExtBot):
+    """Bot that answers every request locally after a short random delay"""
+
+    async def initialize(self):
+        self._bot_user = User(id=1, first_name='Fake', is_bot=True, username='fake_bot')
+        self._initialized = True
+
+    async def shutdown(self):
+        self._initialized = False
+
+    async def send_message(self, chat_id, text, **kwargs):
+        await asyncio.sleep(random.random() / 1000)
+
+
+def update_data(update_id, user_id, text):
+    """JSON of a private text message update, as Telegram sends it"""
+    data = {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': int(time.time()),
+            'chat': {'id': user_id, 'type': 'private'},
+            'from': {'id': user_id, 'is_bot': False, 'first_name': 'Test'},
+            'text': text,
+        },
+    }
+    if text.startswith('/'):
+        data['message']['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+    return data
+
+
+def make_update(bot, update_id, user_id, text):
+    return Update.de_json(update_data(update_id, user_id, text), bot)
+
+
+async def run(bot_module, args):
+    processor = (
+        bot_module.PerUserUpdateProcessor(args.concurrency)
+        if args.processor == 'per-user'
+        else SimpleUpdateProcessor(args.concurrency)
+    )
+    application = (
+        Application.builder()
+        .bot(FakeBot(bot_module.TELEGRAM_BOT_TOKEN))
+        .concurrent_updates(processor)
+        .build()
+    )
+    bot_module.register_handlers(application)
+    await application.initialize()
+    bot_module.task_store.load()
+
+    # Every user has a repeating task that keeps firing during the test
+    due = (datetime.now() - timedelta(minutes=1)).replace(second=0, microsecond=0)
+    repeating = {}
+    for user in range(args.users):
+        user_id = str(1000 + user)
+        task = Task(name='repeat', due=due.timestamp(), repeat=Repeat.DAILY, created=due.timestamp())
+        bot_module.task_store.add_task(user_id, task)
+        repeating[user_id] = task
+
+    async def fire_repeats(user_id):
+        for _ in range(args.tasks):
+            await asyncio.sleep(random.random() / 100)
+            await bot_module.deliver_reminder(None, user_id, repeating[user_id])
+
+    started = time.perf_counter()
+    jobs = []
+    update_id = 0
+    for i in range(args.tasks):
+        for user in range(args.users):
+            for text in ('/addtask', f"task {i}", '01.01.2040', '10:00', '❌ Не повторять'):
+                update_id += 1
+                update = make_update(application.bot, update_id, 1000 + user, text)
+                jobs.append(asyncio.create_task(
+                    processor.process_update(update, application.process_update(update))
+                ))
+    jobs += [asyncio.create_task(fire_repeats(user_id)) for user_id in repeating]
+    await asyncio.gather(*jobs)
+    elapsed = time.perf_counter() - started
+
+    lost = 0
+    for user_id in repeating:
+        names = [task.name for task in bot_module.task_store.get_user_tasks(user_id)]
+        expected = sorted([f"task {i}" for i in range(args.tasks)] + ['repeat'])
+        if sorted(names) != expected or len(repeating[user_id].history) != args.tasks:
+            lost += 1
+    await application.shutdown()
+
+    print(f"processor={args.processor} users={args.users} updates={update_id} "
+          f"time={elapsed:.2f}s users_with_lost_updates={lost}")
+    return lost
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--tasks', type=int, default=5)
+    parser.add_argument('--concurrency', type=int, default=64)
+    parser.add_argument('--processor', choices=['per-user', 'simple'], default='per-user')
+    args = parser.parse_args()
+
+    os.chdir(tempfile.mkdtemp())
+    import task_reminder_bot
+    lost = asyncio.run(run(task_reminder_bot, args))
+    sys.exit(1 if lost else 0)
+
+
+if __name__ == '__main__':
+    main()
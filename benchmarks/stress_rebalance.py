@@ -0,0 +1,107 @@
+"""Stress test for rebalancing a shard worker's outbox during delivery.
+
+A worker's outbox keeps sending reminders through a fake Bot with slow
+sends while the set of live workers changes every few milliseconds, as
+the shard coordinator does when workers start and stop. The outbox is
+reloaded the way the worker does it on each 'assign'. In the end the
+worker owns every chat again, and every reminder must have been sent
+exactly once: a second send is a duplicate reminder.
+
+    python -m benchmarks.stress_rebalance [--reminders 2000] [--rebalances 200] [--reload]
+
+--reload reloads with Outbox.load() instead of Outbox.reassign(), which
+re-queues the entries being sent.
+"""
+import argparse
+import asyncio
+import os
+import random
+import sys
+import tempfile
+import time
+from collections import Counter
+
+from dispatch import Dispatcher, Outbox
+from shards import shard_for
+from storage import SQLiteBackend
+
+
+class SlowBot:
+    """Bot that records every message after a random delay of up to 20 ms"""
+
+    def __init__(self):
+        self.sent = Counter()
+
+    async def send_message(self, chat_id, text, **kwargs):
+        await asyncio.sleep(random.random() / 50)
+        self.sent[text] += 1
+
+
+async def run(args):
+    backend = SQLiteBackend(os.path.join(tempfile.mkdtemp(), 'outbox.db'), autocommit=True)
+    bot = SlowBot()
+    dispatcher = Dispatcher(workers=16, global_rate=100000, chat_rate=100000)
+    dispatcher.start(bot)
+    outbox = Outbox(backend, dispatcher)
+    worker = 0
+    live = [worker]
+
+    def owns(chat_id):
+        return shard_for(str(chat_id), live) == worker
+
+    def reload():
+        if args.reload:
+            outbox.load(owns=owns)
+        else:
+            outbox.reassign(owns)
+
+    reload()
+    outbox.start()
+    started = time.perf_counter()
+
+    async def put_reminders():
+        for i in range(args.reminders):
+            key = f"{i}:0"
+            outbox.put(key, i % args.chats, key, time.time())
+            if i % 50 == 0:
+                await asyncio.sleep(0.001)
+
+    async def rebalance():
+        for _ in range(args.rebalances):
+            live[:] = random.sample(range(4), random.randint(1, 4))
+            if worker not in live:
+                live.append(worker)
+            reload()
+            await asyncio.sleep(random.random() / 100)
+        live[:] = [worker]
+        reload()
+
+    await asyncio.gather(put_reminders(), rebalance())
+    deadline = time.monotonic() + 60
+    while len(bot.sent) < args.reminders and time.monotonic() < deadline:
+        await asyncio.sleep(0.01)
+    elapsed = time.perf_counter() - started
+    await outbox.stop()
+    await dispatcher.stop()
+    backend.close()
+
+    duplicates = sum(1 for count in bot.sent.values() if count > 1)
+    missing = args.reminders - len(bot.sent)
+    print(f"mode={'load' if args.reload else 'reassign'} reminders={args.reminders} "
+          f"rebalances={args.rebalances} time={elapsed:.2f}s duplicates={duplicates} missing={missing}")
+    return duplicates + missing
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--reminders', type=int, default=2000)
+    parser.add_argument('--chats', type=int, default=500)
+    parser.add_argument('--rebalances', type=int, default=200)
+    parser.add_argument('--reload', action='store_true')
+    args = parser.parse_args()
+    failures = asyncio.run(run(args))
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,301 @@
+"""Benchmark suite: the bot's real handlers against a large task store.
+
+A fixture from benchmarks.fixtures is loaded the way main() loads tasks
+at startup, then the real handlers are driven through the bot's update
+processor, replying through a fake Bot:
+
+    startup  task_store.load(), outbox.load(), reminder_engine.start()
+    list     /listtasks (list_tasks_command)
+    add      the repeat choice that ends /addtask (task_repeat_received)
+    delete   the number that answers /deletetask (handle_delete_number)
+    remind   tasks due now, from scheduling to the end of deliver_reminder
+             (ReminderEngine replaced check_tasks_periodically)
+    flush    writing the changes the scenarios made
+
+Every scenario works on its own random users; the steps that lead up to
+the timed one (/addtask, name, date, time; /deletetask) are not timed.
+Each reports throughput, latency percentiles and the peak RSS of the
+process so far. Results are written as JSON, and `compare` exits with 1
+if a metric got worse by more than --threshold percent; single runs on
+a busy machine differ by 10-20%, so compare runs from the same machine.
+
+    python -m benchmarks.suite run [--users 100000] [--ops 2000] [--fixture tasks.json] [--output run.json]
+    python -m benchmarks.suite compare base.json new.json [--threshold 20]
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import platform
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+from telegram.ext import Application
+
+from benchmarks.fixtures import user_id, write_fixture
+from benchmarks.stress_concurrency import FakeBot, make_update
+from models import Task
+from scheduler import LatencyTracker
+
+SCENARIOS = ('list', 'add', 'delete', 'remind', 'flush')
+
+# (metric, True if higher is better) checked by `compare`
+COMPARED = (('throughput', True), ('p50_ms', False), ('p99_ms', False), ('peak_rss_mb', False))
+
+
+class InstantBot(FakeBot):
+    """FakeBot without the random delay, so that runs are comparable"""
+
+    async def send_message(self, chat_id, text, **kwargs):
+        await asyncio.sleep(0)
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def report(ops, seconds, latency=None):
+    result = {'ops': ops, 'seconds': round(seconds, 4), 'throughput': round(ops / seconds, 1)}
+    if latency is not None:
+        stats = latency.summary()
+        for name in ('p50', 'p90', 'p99', 'max'):
+            result[f"{name}_ms"] = round(stats[name] * 1000, 3)
+    result['peak_rss_mb'] = round(peak_rss_mb(), 1)
+    return result
+
+
+class Driver:
+    """Feeds updates to the application as the bot's update fetcher does"""
+
+    def __init__(self, application, clients):
+        self.application = application
+        self.clients = clients
+        self._update_ids = itertools.count(1)
+
+    async def send(self, user, text):
+        update = make_update(self.application.bot, next(self._update_ids), int(user), text)
+        await self.application.update_processor.process_update(
+            update, self.application.process_update(update)
+        )
+
+    async def run(self, sessions):
+        """Play (user, [text, ...]) sessions; the last message of each is timed"""
+        latency = LatencyTracker(size=len(sessions))
+        queue = iter(sessions)
+
+        async def client():
+            for user, texts in queue:
+                for text in texts[:-1]:
+                    await self.send(user, text)
+                started = time.perf_counter()
+                await self.send(user, texts[-1])
+                latency.add(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(client() for _ in range(self.clients)))
+        return report(len(sessions), time.perf_counter() - started, latency)
+
+
+async def bench_remind(bot, users, delivered):
+    """Add a task due now for each user and wait until all are delivered"""
+    latency = LatencyTracker(size=len(users))
+    pending = {}
+    done = asyncio.Event()
+
+    def on_delivered(task):
+        due = pending.pop(task.id, None)
+        if due is None:
+            return
+        latency.add(time.time() - due)
+        if not pending:
+            done.set()
+
+    delivered.append(on_delivered)
+    started = time.perf_counter()
+    for user in users:
+        now = time.time()
+        task = Task(name='Напоминание', due=now, created=now)
+        bot.task_store.add_task(user, task)
+        pending[task.id] = now
+    await done.wait()
+    return report(len(users), time.perf_counter() - started, latency)
+
+
+async def run(bot, args, fixture_tasks):
+    application = (
+        Application.builder()
+        .bot(InstantBot(bot.TELEGRAM_BOT_TOKEN))
+        .concurrent_updates(bot.PerUserUpdateProcessor(bot.CONCURRENT_UPDATES))
+        .updater(None)
+        .build()
+    )
+    bot.register_handlers(application)
+    delivered = []
+
+    async def deliver(context, owner, task):
+        await bot.deliver_reminder(context, owner, task)
+        for callback in delivered:
+            callback(task)
+
+    results = {}
+    # The same steps as main() before it starts polling
+    started = time.perf_counter()
+    bot.task_store.load()
+    bot.outbox.load()
+    bot.reminder_engine.start(application.job_queue, deliver)
+    results['startup'] = report(fixture_tasks, time.perf_counter() - started)
+    results['startup']['scheduled'] = len(bot.reminder_engine)
+    print(f"  startup  {format_result(results['startup'])}", flush=True)
+    await application.initialize()
+    await application.start()
+
+    rng = random.Random(args.seed)
+    # Every scenario gets its own users, so none of them sees another's changes
+    picked = iter(rng.sample(range(args.users), args.ops * len(SCENARIOS)))
+    driver = Driver(application, args.clients)
+    for scenario in args.scenarios:
+        users = [user_id(next(picked)) for _ in range(args.ops)]
+        if scenario == 'list':
+            results[scenario] = await driver.run([(user, ['/listtasks']) for user in users])
+        elif scenario == 'add':
+            texts = ['/addtask', 'Новая задача', '01.01.2040', '10:00', '📅 Каждый день']
+            results[scenario] = await driver.run([(user, texts) for user in users])
+        elif scenario == 'delete':
+            results[scenario] = await driver.run([(user, ['/deletetask', '1']) for user in users])
+        elif scenario == 'remind':
+            results[scenario] = await bench_remind(bot, users, delivered)
+        elif scenario == 'flush':
+            started = time.perf_counter()
+            await bot.task_store.flush()
+            results[scenario] = report(1, time.perf_counter() - started)
+        print(f"  {scenario:<8} {format_result(results[scenario])}", flush=True)
+
+    await application.stop()
+    await application.shutdown()
+    return results
+
+
+def format_result(result):
+    parts = [f"{result['throughput']:>10,.1f} ops/s"]
+    if 'p50_ms' in result:
+        parts.append(f"p50={result['p50_ms']:.2f}ms p99={result['p99_ms']:.2f}ms")
+    parts.append(f"peak_rss={result['peak_rss_mb']:.0f}MB")
+    return ' '.join(parts)
+
+
+def git_commit():
+    try:
+        output = subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+            capture_output=True, text=True, check=True
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return output.stdout.strip()
+
+
+def command_run(args):
+    if args.ops * len(SCENARIOS) > args.users:
+        sys.exit(f"--users must be at least {args.ops * len(SCENARIOS)} for --ops {args.ops}")
+    output = os.path.abspath(args.output) if args.output else None
+    fixture = os.path.abspath(args.fixture) if args.fixture else None
+
+    workdir = tempfile.mkdtemp()
+    os.chdir(workdir)
+    started = time.perf_counter()
+    if fixture:
+        # The backend replaces tasks.json on compaction, never the fixture itself
+        os.symlink(fixture, 'tasks.json')
+        with open('tasks.json', encoding='utf-8') as f:
+            tasks = sum(len(user_tasks) for user_tasks in json.load(f).values())
+    else:
+        tasks = write_fixture('tasks.json', args.users, args.tasks_per_user, seed=args.seed)
+    print(f"fixture: users={args.users} tasks={tasks} size={os.path.getsize('tasks.json') / 2 ** 20:.1f}MB "
+          f"({time.perf_counter() - started:.1f}s)")
+
+    import task_reminder_bot
+    # Every reminder and task change is logged at INFO
+    logging.getLogger().setLevel(logging.WARNING)
+    results = asyncio.run(run(task_reminder_bot, args, tasks))
+
+    document = {
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'args': {
+            'users': args.users, 'tasks_per_user': args.tasks_per_user, 'ops': args.ops,
+            'clients': args.clients, 'seed': args.seed,
+        },
+        'fixture': {'users': args.users, 'tasks': tasks, 'bytes': os.path.getsize('tasks.json')},
+        'results': results,
+    }
+    if output:
+        with open(output, 'w', encoding='utf-8') as f:
+            json.dump(document, f, indent=2)
+            f.write('\n')
+        print(f"results written to {output}")
+    shutil.rmtree(workdir)
+
+
+def command_compare(args):
+    with open(args.base, encoding='utf-8') as f:
+        base = json.load(f)
+    with open(args.new, encoding='utf-8') as f:
+        new = json.load(f)
+    if base['args'] != new['args']:
+        print(f"warning: runs used different arguments: {base['args']} vs {new['args']}")
+
+    regressions = 0
+    print(f"{'scenario':<9} {'metric':<12} {'base':>12} {'new':>12} {'change':>8}")
+    for scenario, results in base['results'].items():
+        for metric, higher_is_better in COMPARED:
+            old, value = results.get(metric), new['results'].get(scenario, {}).get(metric)
+            if old is None or value is None:
+                continue
+            change = (value - old) / old * 100 if old else 0.0
+            worse = -change if higher_is_better else change
+            flag = ''
+            if worse > args.threshold:
+                regressions += 1
+                flag = '  <- regression'
+            print(f"{scenario:<9} {metric:<12} {old:>12,.2f} {value:>12,.2f} {change:>+7.1f}%{flag}")
+    print(f"{regressions} regression(s) above {args.threshold}%")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    run_parser = subparsers.add_parser('run', help='run the benchmarks')
+    run_parser.add_argument('--users', type=int, default=100000)
+    run_parser.add_argument('--tasks-per-user', type=int, default=5)
+    run_parser.add_argument('--fixture', help='fixture written by benchmarks.fixtures with the same --users')
+    run_parser.add_argument('--ops', type=int, default=2000, help='operations per scenario')
+    run_parser.add_argument('--clients', type=int, default=8, help='users acting at the same time')
+    run_parser.add_argument('--scenarios', nargs='+', choices=SCENARIOS, default=list(SCENARIOS))
+    run_parser.add_argument('--seed', type=int, default=1)
+    run_parser.add_argument('--output', help='write the results to this JSON file')
+    compare_parser = subparsers.add_parser('compare', help='compare two result files')
+    compare_parser.add_argument('base')
+    compare_parser.add_argument('new')
+    compare_parser.add_argument('--threshold', type=float, default=20, help='percent')
+    args = parser.parse_args()
+
+    if args.command == 'run':
+        command_run(args)
+    elif command_compare(args):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
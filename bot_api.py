@@ -0,0 +1,91 @@
+"""HTTP client for the Bot API with connection reuse and per-endpoint timing.
+
+PTB's HTTPXRequest keeps a pool of connections, but idle ones expire
+after 5 seconds, so reminders sent in bursts a minute apart open new
+connections every time. TimedHTTPXRequest keeps idle connections for
+`keepalive` seconds and records how long every Bot API method takes.
+The bot uses one instance for getUpdates and another for everything it
+sends, so a long poll never holds a connection that a reminder needs.
+"""
+import time
+
+import httpx
+from telegram.error import TimedOut
+from telegram.request import HTTPXRequest
+
+from scheduler import LatencyTracker
+
+
+class EndpointStats:
+    """Calls, failures and recent durations of one Bot API method"""
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.pool_timeouts = 0
+        self.latency = LatencyTracker(size=1000)
+
+
+class TimedHTTPXRequest(HTTPXRequest):
+    """HTTPXRequest with a configurable keep-alive that times every call.
+
+    A call fails if it raises or Telegram answers with an HTTP error;
+    pool timeouts (no free connection within `pool_timeout`) are also
+    counted separately, since they mean the pool is too small.
+    """
+
+    def __init__(self, connection_pool_size=1, keepalive=30.0, **kwargs):
+        self._keepalive = keepalive
+        self.endpoints = {}
+        super().__init__(connection_pool_size=connection_pool_size, **kwargs)
+
+    def _build_client(self):
+        limits = self._client_kwargs['limits']
+        self._client_kwargs['limits'] = httpx.Limits(
+            max_connections=limits.max_connections,
+            max_keepalive_connections=limits.max_keepalive_connections,
+            keepalive_expiry=self._keepalive
+        )
+        return super()._build_client()
+
+    async def do_request(self, url, method, *args, **kwargs):
+        endpoint = url.rsplit('/', 1)[-1]
+        stats = self.endpoints.get(endpoint)
+        if stats is None:
+            stats = self.endpoints[endpoint] = EndpointStats()
+        stats.count += 1
+        started = time.perf_counter()
+        try:
+            code, payload = await super().do_request(url, method, *args, **kwargs)
+        except TimedOut as e:
+            stats.errors += 1
+            if isinstance(e.__cause__, httpx.PoolTimeout):
+                stats.pool_timeouts += 1
+            raise
+        except Exception:
+            stats.errors += 1
+            raise
+        finally:
+            stats.latency.add(time.perf_counter() - started)
+        if code >= 400:
+            stats.errors += 1
+        return code, payload
+
+    def stats(self):
+        """Return {method: count, errors, pool_timeouts and p50/p90/p99/max seconds}"""
+        result = {}
+        for endpoint, stats in self.endpoints.items():
+            summary = stats.latency.summary()
+            summary.update(count=stats.count, errors=stats.errors, pool_timeouts=stats.pool_timeouts)
+            result[endpoint] = summary
+        return result
+
+
+def format_stats(request):
+    """One log line with the timing of every endpoint called so far"""
+    return "; ".join(
+        f"{endpoint}: {stats['count']} выз., ошибок {stats['errors']}"
+        + (f" (пул {stats['pool_timeouts']})" if stats['pool_timeouts'] else "")
+        + f", p50={stats['p50'] * 1000:.0f}мс p99={stats['p99'] * 1000:.0f}мс"
+        for endpoint, stats in sorted(request.stats().items())
+    )
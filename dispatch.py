@@ -0,0 +1,354 @@
+"""Rate-limited outgoing message dispatch."""
+import asyncio
+import heapq
+import logging
+import random
+import time
+from collections import OrderedDict, deque
+
+from telegram.error import BadRequest, Forbidden, RetryAfter
+
+from scheduler import LatencyTracker
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """Token bucket refilled at `rate` tokens per second up to `capacity`"""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self):
+        """Seconds until a token is available (0 if one is available now)"""
+        self._refill()
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    async def acquire(self):
+        """Wait for a token and take it"""
+        while True:
+            wait = self.delay()
+            if wait == 0:
+                self.tokens -= 1
+                return
+            await asyncio.sleep(wait)
+
+
+class Dispatcher:
+    """Sends messages through a bounded pool of worker tasks.
+
+    Sends are limited by a global token bucket (Telegram allows about 30
+    messages per second per bot) and a bucket per chat. When Telegram
+    answers with RetryAfter, all workers pause for the requested time and
+    the message is retried.
+    """
+
+    def __init__(self, workers=8, global_rate=30, chat_rate=1, max_queue=0, max_chats=10000):
+        self.workers = workers
+        self.chat_rate = chat_rate
+        self.max_chats = max_chats
+        self.global_bucket = TokenBucket(global_rate)
+        self.bot = None
+        self._queue = asyncio.Queue(max_queue)
+        self._chat_buckets = OrderedDict()
+        self._tasks = []
+        self._paused_until = 0
+        self._sent_times = deque(maxlen=10000)
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self.in_flight = 0
+
+    def start(self, bot):
+        """Start the worker tasks that send through `bot`"""
+        self.bot = bot
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self, timeout=10):
+        """Wait up to `timeout` seconds for queued messages, then stop workers"""
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Не отправлено сообщений при остановке: {self._queue.qsize()}")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def send(self, chat_id, text, **kwargs):
+        """Queue a message and wait until it is sent; raise if sending fails"""
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((chat_id, text, kwargs, future))
+        return await future
+
+    def stats(self):
+        """Return counters, queue depth and throughput over the last 10 seconds"""
+        now = time.monotonic()
+        recent = sum(1 for sent_at in self._sent_times if sent_at > now - 10)
+        return {
+            'sent': self.sent,
+            'failed': self.failed,
+            'retried': self.retried,
+            'queue_depth': self._queue.qsize(),
+            'in_flight': self.in_flight,
+            'throughput': recent / 10,
+        }
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self._chat_buckets[chat_id] = TokenBucket(self.chat_rate, 1)
+            if len(self._chat_buckets) > self.max_chats:
+                self._chat_buckets.popitem(last=False)
+        else:
+            self._chat_buckets.move_to_end(chat_id)
+        return bucket
+
+    async def _worker(self):
+        while True:
+            chat_id, text, kwargs, future = await self._queue.get()
+            self.in_flight += 1
+            try:
+                await self._send(chat_id, text, kwargs, future)
+            finally:
+                self.in_flight -= 1
+                self._queue.task_done()
+
+    async def _send(self, chat_id, text, kwargs, future):
+        while True:
+            await self._chat_bucket(chat_id).acquire()
+            pause = self._paused_until - time.monotonic()
+            if pause > 0:
+                await asyncio.sleep(pause)
+            await self.global_bucket.acquire()
+            try:
+                message = await self.bot.send_message(chat_id=chat_id, text=text, **kwargs)
+            except RetryAfter as e:
+                retry_after = e.retry_after
+                if not isinstance(retry_after, (int, float)):
+                    retry_after = retry_after.total_seconds()
+                logger.warning(f"Ограничение Telegram, повтор через {retry_after} с")
+                self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+                self.retried += 1
+                continue
+            except Exception as e:
+                self.failed += 1
+                if not future.done():
+                    future.set_exception(e)
+                return
+            self.sent += 1
+            self._sent_times.append(time.monotonic())
+            if not future.done():
+                future.set_result(message)
+            return
+
+
+class Outbox:
+    """Durable queue of reminders waiting to be sent.
+
+    A reminder is written to the storage backend before anything is sent
+    and the backend is flushed before the first attempt, so a pending
+    reminder survives a crash or restart. Failed sends are retried with
+    exponential backoff. Entries are keyed by reminder, and a delivered
+    entry is kept for `retention` seconds, so putting the same reminder
+    again is a no-op and a crash cannot make it go out twice. The only
+    window for a duplicate is a crash between a successful send and the
+    next flush.
+    """
+
+    def __init__(self, backend, dispatcher, base_delay=5, max_delay=3600,
+                 max_attempts=20, retention=2 * 24 * 3600):
+        self.backend = backend
+        self.dispatcher = dispatcher
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_attempts = max_attempts
+        self.retention = retention
+        self.latency = LatencyTracker()
+        self._entries = {}
+        self._pending = []
+        self._finished = deque()
+        self._wakeup = asyncio.Event()
+        self._task = None
+        # Key -> task of each send in flight; the loop keeps only weak references
+        self._sending = {}
+        # Chats this outbox sends to (see reassign), None for all
+        self._owns = None
+
+    def __len__(self):
+        return len(self._pending)
+
+    def load(self, owns=None):
+        """Load outbox entries from storage, only for chats `owns(chat_id)` accepts if given"""
+        self._owns = owns
+        self._entries = {}
+        self._pending = []
+        self._finished = deque()
+        entries = sorted(self.backend.load_outbox(), key=lambda entry: entry['updated'])
+        for entry in entries:
+            if owns is not None and not owns(entry['chat_id']):
+                continue
+            self._entries[entry['key']] = entry
+            if entry['status'] == 'pending':
+                heapq.heappush(self._pending, (entry['next_attempt'], entry['key']))
+            else:
+                self._finished.append(entry['key'])
+        if self._pending:
+            logger.info(f"Неотправленных напоминаний в очереди: {len(self._pending)}")
+        self._wakeup.set()
+
+    def reassign(self, owns):
+        """Keep only the entries of chats `owns(chat_id)` accepts, loading newly owned ones.
+
+        Unlike load(), entries already here stay as they are, so one that is
+        being sent is not queued again; it is kept until the send ends.
+        """
+        self._owns = owns
+        for key, entry in list(self._entries.items()):
+            if key not in self._sending and not owns(entry['chat_id']):
+                del self._entries[key]
+        self._pending = [item for item in self._pending if item[1] in self._entries]
+        self._finished = deque(key for key in self._finished if key in self._entries)
+        added = 0
+        for entry in sorted(self.backend.load_outbox(), key=lambda entry: entry['updated']):
+            if entry['key'] in self._entries or not owns(entry['chat_id']):
+                continue
+            self._entries[entry['key']] = entry
+            if entry['status'] == 'pending':
+                self._pending.append((entry['next_attempt'], entry['key']))
+                added += 1
+            else:
+                self._finished.append(entry['key'])
+        heapq.heapify(self._pending)
+        if added:
+            logger.info(f"Неотправленных напоминаний передано в очередь: {added}")
+        self._wakeup.set()
+
+    def put(self, key, chat_id, text, due):
+        """Add a reminder; return False if one with this key already exists"""
+        if key in self._entries:
+            return False
+        entry = {
+            'key': key,
+            'chat_id': chat_id,
+            'text': text,
+            'due': due,
+            'status': 'pending',
+            'attempts': 0,
+            'next_attempt': 0,
+            'updated': time.time(),
+        }
+        self._entries[key] = entry
+        self.backend.save_outbox_entry(entry)
+        heapq.heappush(self._pending, (0, key))
+        self._wakeup.set()
+        return True
+
+    def start(self):
+        """Start delivering pending entries"""
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self, timeout=10):
+        """Stop the delivery loop, waiting up to `timeout` seconds for sends in flight"""
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        sending = list(self._sending.values())
+        if not sending:
+            return
+        _, unfinished = await asyncio.wait(sending, timeout=timeout)
+        if unfinished:
+            # Entries stay pending in storage and are sent after a restart
+            logger.warning(f"Прервано отправок напоминаний при остановке: {len(unfinished)}")
+            for task in unfinished:
+                task.cancel()
+            await asyncio.gather(*unfinished, return_exceptions=True)
+
+    def _purge_finished(self, now):
+        while self._finished:
+            entry = self._entries.get(self._finished[0])
+            if entry is not None and entry['updated'] >= now - self.retention:
+                break
+            key = self._finished.popleft()
+            if entry is not None:
+                del self._entries[key]
+                self.backend.delete_outbox_entry(key)
+
+    async def _run(self):
+        while True:
+            self._wakeup.clear()
+            now = time.time()
+            self._purge_finished(now)
+
+            ready = []
+            while self._pending and self._pending[0][0] <= now:
+                ready.append(self._entries[heapq.heappop(self._pending)[1]])
+
+            if ready:
+                # Entries must be durable before the first send attempt
+                try:
+                    await self.backend.flush_async()
+                except Exception as e:
+                    logger.error(f"Ошибка при сохранении очереди напоминаний: {e}")
+                    for entry in ready:
+                        heapq.heappush(self._pending, (entry['next_attempt'], entry['key']))
+                    await asyncio.sleep(self.base_delay)
+                    continue
+                for entry in ready:
+                    key = entry['key']
+                    task = self._sending[key] = asyncio.create_task(self._deliver(entry))
+                    task.add_done_callback(lambda _, key=key: self._sending.pop(key, None))
+
+            timeout = max(self._pending[0][0] - now, 0) if self._pending else None
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _deliver(self, entry):
+        try:
+            await self.dispatcher.send(entry['chat_id'], entry['text'])
+        except (Forbidden, BadRequest) as e:
+            # The chat is gone or blocked the bot: retrying will not help
+            logger.error(f"Напоминание для {entry['chat_id']} не может быть доставлено: {e}")
+            self._finish(entry, 'failed')
+        except Exception as e:
+            entry['attempts'] += 1
+            if entry['attempts'] >= self.max_attempts:
+                logger.error(
+                    f"Напоминание для {entry['chat_id']} не доставлено "
+                    f"после {entry['attempts']} попыток: {e}"
+                )
+                self._finish(entry, 'failed')
+                return
+            delay = min(self.base_delay * 2 ** (entry['attempts'] - 1), self.max_delay)
+            entry['next_attempt'] = time.time() + delay * random.uniform(0.8, 1.2)
+            entry['updated'] = time.time()
+            self.backend.save_outbox_entry(entry)
+            if self._owns is not None and not self._owns(entry['chat_id']):
+                # Чат перешёл к другому воркеру, пока шла отправка: повторит он
+                del self._entries[entry['key']]
+                return
+            heapq.heappush(self._pending, (entry['next_attempt'], entry['key']))
+            self._wakeup.set()
+            logger.warning(f"Ошибка при отправке напоминания, попытка {entry['attempts']}: {e}")
+        else:
+            self.latency.add(time.time() - entry['due'])
+            self._finish(entry, 'done')
+
+    def _finish(self, entry, status):
+        entry['status'] = status
+        entry['updated'] = time.time()
+        self.backend.save_outbox_entry(entry)
+        self._finished.append(entry['key'])
@@ -0,0 +1,253 @@
+"""iCalendar (RFC 5545) events as tasks and tasks as events.
+
+Only what a reminder needs is read: SUMMARY, DTSTART and the subset of
+RRULE that a Recurrence can express (FREQ, INTERVAL, BYDAY without
+ordinals, BYMONTHDAY=-1, the last weekday of a month, COUNT, UNTIL) plus
+EXDATE. Times are returned as naive wall-clock datetimes in the zone the
+caller asks for.
+
+Tasks are written as VEVENTs with an alarm at the start, one event per
+series. Times of tasks in IANA zones carry a TZID (without VTIMEZONE,
+which calendar apps do not need for IANA names); other tasks are in UTC.
+A monthly series on the 29th-31st is approximate: RRULE skips shorter
+months where a Recurrence takes their last day.
+"""
+import re
+from datetime import datetime, time, timezone
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+
+from recurrence import Recurrence
+from timezones import get_zone, to_local, to_timestamp
+
+# Time of all-day events (DTSTART;VALUE=DATE)
+ALL_DAY_TIME = time(9, 0)
+
+_FREQUENCIES = {'DAILY': 'daily', 'WEEKLY': 'weekly', 'MONTHLY': 'monthly', 'YEARLY': 'yearly'}
+_WEEKDAYS = {'MO': 0, 'TU': 1, 'WE': 2, 'TH': 3, 'FR': 4, 'SA': 5, 'SU': 6}
+_UNESCAPE = {'n': '\n', 'N': '\n', ',': ',', ';': ';', '\\': '\\'}
+_ESCAPED = re.compile(r'\\(.)', re.DOTALL)
+_FREQUENCY_NAMES = {freq: name for name, freq in _FREQUENCIES.items()}
+_WEEKDAY_CODES = ('MO', 'TU', 'WE', 'TH', 'FR', 'SA', 'SU')
+_BUSINESS_DAYS = 'MO,TU,WE,TH,FR'
+
+CALENDAR_HEAD = (
+    'BEGIN:VCALENDAR\r\n'
+    'VERSION:2.0\r\n'
+    'PRODID:-//task_reminder_bot//RU\r\n'
+    'CALSCALE:GREGORIAN\r\n'
+)
+CALENDAR_TAIL = 'END:VCALENDAR\r\n'
+
+
+def unfold(lines):
+    """Yield (line number, logical line) joining folded continuation lines"""
+    current, start = None, 0
+    for number, line in enumerate(lines, 1):
+        line = line.rstrip('\r\n')
+        if line[:1] in (' ', '\t') and current is not None:
+            current += line[1:]
+            continue
+        if current:
+            yield start, current
+        current, start = line, number
+    if current:
+        yield start, current
+
+
+def split_property(line):
+    """Split 'NAME;PARAM=VALUE:value' into (NAME, {PARAM: VALUE}, value)"""
+    head, sep, value = line.partition(':')
+    if not sep:
+        raise ValueError(f"Not a property line: {line}")
+    name, *params = head.split(';')
+    return name.upper(), dict(param.partition('=')[::2] for param in params), value
+
+
+def unescape(text):
+    if '\\' not in text:
+        return text
+    return _ESCAPED.sub(lambda match: _UNESCAPE.get(match.group(1), match.group(1)), text)
+
+
+def iter_events(lines):
+    """Yield (line number, {NAME: (params, value)}) for every VEVENT"""
+    event, start = None, 0
+    for number, line in unfold(lines):
+        try:
+            name, params, value = split_property(line)
+        except ValueError:
+            continue
+        if name == 'BEGIN' and value.upper() == 'VEVENT':
+            event, start = {}, number
+        elif name == 'END' and value.upper() == 'VEVENT':
+            if event is not None:
+                yield start, event
+            event = None
+        elif event is not None:
+            # EXDATE may repeat; the other properties are read once
+            if name == 'EXDATE' and name in event:
+                previous_params, previous = event[name]
+                event[name] = (previous_params, previous + ',' + value)
+            else:
+                event[name] = (params, value)
+
+
+def parse_datetime(params, value, zone):
+    """Wall-clock datetime in `zone` of a DATE or DATE-TIME value"""
+    value = value.strip()
+    if params.get('VALUE', '').upper() == 'DATE' or len(value) == 8:
+        return datetime.combine(datetime.strptime(value, '%Y%m%d').date(), ALL_DAY_TIME)
+    if value.endswith('Z'):
+        wall = datetime.strptime(value[:-1], '%Y%m%dT%H%M%S')
+        return to_local(to_timestamp(wall, timezone.utc), zone)
+    wall = datetime.strptime(value, '%Y%m%dT%H%M%S')
+    if 'TZID' in params:
+        # parse_zone() is for what users type; TZID is an exact name
+        try:
+            event_zone = get_zone(params['TZID'].strip('"'))
+        except (ZoneInfoNotFoundError, ValueError):
+            raise ValueError(f"Unknown TZID: {params['TZID']}") from None
+        return to_local(to_timestamp(wall, event_zone), zone)
+    # A floating time is the same wall-clock time in every zone
+    return wall
+
+
+def parse_rrule(value, zone, start=None):
+    """Recurrence for an RRULE value; ValueError if it cannot be expressed.
+
+    BYMONTH is accepted for a yearly rule when it is the month of `start`.
+    """
+    parts = dict(part.partition('=')[::2] for part in value.upper().split(';') if part)
+    freq = _FREQUENCIES.get(parts.pop('FREQ', None))
+    if freq is None:
+        raise ValueError(f"Unsupported RRULE frequency: {value}")
+    weekdays = day = until = count = None
+    interval = int(parts.pop('INTERVAL', '1'))
+    if (parts.get('BYSETPOS') == '-1' and freq in ('monthly', 'yearly')
+            and set(parts.get('BYDAY', '').split(',')) == set(_BUSINESS_DAYS.split(','))):
+        # The last Monday-Friday of the month
+        del parts['BYSETPOS'], parts['BYDAY']
+        day = 'last_business'
+    if 'BYDAY' in parts:
+        codes = parts.pop('BYDAY').split(',')
+        # Ordinals (1MO, -1FR) have no Recurrence counterpart
+        if not all(code in _WEEKDAYS for code in codes):
+            raise ValueError(f"Unsupported RRULE BYDAY: {value}")
+        weekdays = [_WEEKDAYS[code] for code in codes]
+    if 'BYMONTHDAY' in parts:
+        if parts.pop('BYMONTHDAY') != '-1' or day is not None:
+            raise ValueError(f"Unsupported RRULE BYMONTHDAY: {value}")
+        day = 'last'
+    if 'COUNT' in parts:
+        count = int(parts.pop('COUNT'))
+    if 'UNTIL' in parts:
+        until = parts.pop('UNTIL')
+        if len(until) == 8:
+            # The whole last day is included
+            until = datetime.combine(datetime.strptime(until, '%Y%m%d').date(), time.max)
+        else:
+            until = parse_datetime({}, until, zone)
+    if 'BYMONTH' in parts and freq == 'yearly' and start is not None and parts['BYMONTH'] == str(start.month):
+        del parts['BYMONTH']
+    parts.pop('WKST', None)
+    if parts:
+        raise ValueError(f"Unsupported RRULE parts: {', '.join(parts)}")
+    return Recurrence(freq, interval=interval, weekdays=weekdays, day=day, until=until, count=count)
+
+
+def event_fields(event, zone):
+    """(summary, start, Recurrence or None) of an event; ValueError if it has no start"""
+    if 'DTSTART' not in event:
+        raise ValueError("Event has no DTSTART")
+    summary = unescape(event.get('SUMMARY', ({}, ''))[1]).strip()
+    start = parse_datetime(*event['DTSTART'], zone)
+    rule = parse_rrule(event['RRULE'][1], zone, start) if 'RRULE' in event else None
+    if rule is not None and 'EXDATE' in event:
+        params, values = event['EXDATE']
+        exdates = [parse_datetime(params, when, zone) for when in values.split(',') if when]
+        rule = Recurrence(
+            rule.freq, interval=rule.interval, weekdays=rule.weekdays, day=rule.day,
+            until=rule.until, count=rule.count, exdates=exdates
+        )
+    return summary, start, rule
+
+
+def escape(text):
+    return text.replace('\\', '\\\\').replace(';', '\\;').replace(',', '\\,').replace('\n', '\\n')
+
+
+def fold(line):
+    """Content line with CRLF, folded into lines of at most 75 octets"""
+    data = line.encode('utf-8')
+    if len(data) <= 75:
+        return line + '\r\n'
+    parts = []
+    limit = 75
+    while data:
+        cut = min(limit, len(data))
+        # A fold must not split a UTF-8 sequence
+        while cut < len(data) and data[cut] & 0xC0 == 0x80:
+            cut -= 1
+        parts.append(data[:cut].decode('utf-8'))
+        data = data[cut:]
+        # Continuation lines start with a space
+        limit = 74
+    return '\r\n '.join(parts) + '\r\n'
+
+
+def format_datetime(timestamp, tz):
+    """(';TZID=...' or '', value) of a moment of a task in zone `tz`"""
+    zone = get_zone(tz)
+    if isinstance(zone, ZoneInfo) and tz != 'UTC':
+        return f';TZID={tz}', to_local(timestamp, zone).strftime('%Y%m%dT%H%M%S')
+    return '', datetime.fromtimestamp(timestamp, timezone.utc).strftime('%Y%m%dT%H%M%SZ')
+
+
+def format_rrule(rule, start, zone):
+    """RRULE value of a Recurrence of a series starting at wall-clock `start`"""
+    parts = [f'FREQ={_FREQUENCY_NAMES[rule.freq]}']
+    if rule.interval != 1:
+        parts.append(f'INTERVAL={rule.interval}')
+    if rule.weekdays is not None:
+        parts.append('BYDAY=' + ','.join(_WEEKDAY_CODES[day] for day in sorted(rule.weekdays)))
+    if rule.day is not None and rule.freq == 'yearly':
+        parts.append(f'BYMONTH={start.month}')
+    if rule.day == 'last':
+        parts.append('BYMONTHDAY=-1')
+    elif rule.day == 'last_business':
+        parts.append(f'BYDAY={_BUSINESS_DAYS};BYSETPOS=-1')
+    if rule.count is not None:
+        parts.append(f'COUNT={rule.count}')
+    if rule.until is not None:
+        # UNTIL is in UTC when DTSTART has a zone
+        until = datetime.fromtimestamp(to_timestamp(rule.until, zone), timezone.utc)
+        parts.append(f'UNTIL={until:%Y%m%dT%H%M%SZ}')
+    return ';'.join(parts)
+
+
+def format_event(task):
+    """VEVENT of a task (a models.Task) as folded content lines"""
+    start = task.due if task.start is None else task.start
+    params, value = format_datetime(start, task.tz)
+    lines = [
+        'BEGIN:VEVENT',
+        f'UID:task-{task.id}-{int(task.created)}@task_reminder_bot',
+        f'DTSTAMP:{datetime.fromtimestamp(task.created, timezone.utc):%Y%m%dT%H%M%SZ}',
+        f'DTSTART{params}:{value}',
+        f'SUMMARY:{escape(task.name)}',
+    ]
+    rule = task.recurrence
+    if rule is not None:
+        lines.append('RRULE:' + format_rrule(rule, task.anchor, task.zone))
+        for when in sorted(rule.exdates):
+            exdate_params, exdate = format_datetime(to_timestamp(when, task.zone), task.tz)
+            lines.append(f'EXDATE{exdate_params}:{exdate}')
+    lines += [
+        'BEGIN:VALARM',
+        'ACTION:DISPLAY',
+        'TRIGGER:PT0S',
+        f'DESCRIPTION:{escape(task.name)}',
+        'END:VALARM',
+        'END:VEVENT',
+    ]
+    return ''.join(fold(line) for line in lines)
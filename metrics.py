@@ -0,0 +1,273 @@
+"""Prometheus metrics served over HTTP.
+
+Metrics live in a Registry and are rendered in the Prometheus text format
+at /metrics by a small aiohttp server. Counters and histograms are
+updated on the hot paths; values that components already keep (dispatch
+counters, latency trackers, Bot API call stats) are read by collectors
+only when the endpoint is scraped, so they cost nothing in between.
+"""
+import bisect
+import contextlib
+import functools
+import logging
+import math
+import time
+
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Seconds, from a fast handler to a slow disk write
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def _format_value(value):
+    if value is None:
+        return 'NaN'
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _format_labels(names, values):
+    if not names:
+        return ''
+    escaped = (
+        str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        for value in values
+    )
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(names, escaped)) + '}'
+
+
+class Metric:
+    """Metric family: one value per combination of label values"""
+
+    kind = 'untyped'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+
+    def _key(self, labels):
+        if len(labels) != len(self.labels):
+            raise ValueError(f"{self.name} expects labels {self.labels}, got {labels}")
+        return tuple(str(label) for label in labels)
+
+    def set(self, value, *labels):
+        self._values[self._key(labels)] = value
+
+    def samples(self):
+        """Yield (name suffix, label names, label values, value)"""
+        for key, value in self._values.items():
+            yield '', self.labels, key, value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for suffix, names, values, value in self.samples():
+            lines.append(f"{self.name}{suffix}{_format_labels(names, values)} {_format_value(value)}")
+        return lines
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, *labels, amount=1):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+
+class Histogram(Metric):
+    """Counts observations in cumulative `le` buckets"""
+
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, *labels):
+        key = self._key(labels)
+        state = self._values.get(key)
+        if state is None:
+            # Per-bucket counts (the last one is +Inf), sum, count
+            state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        state[0][bisect.bisect_left(self.buckets, value)] += 1
+        state[1] += value
+        state[2] += 1
+
+    @contextlib.contextmanager
+    def time(self, *labels):
+        """Observe how long the block takes"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *labels)
+
+    def samples(self):
+        names = self.labels + ('le',)
+        for key, (counts, total, count) in self._values.items():
+            cumulative = 0
+            for bound, bucket in zip(self.buckets + (math.inf,), counts):
+                cumulative += bucket
+                yield '_bucket', names, key + (_format_value(float(bound)),), cumulative
+            yield '_sum', self.labels, key, total
+            yield '_count', self.labels, key, count
+
+
+class Summary(Metric):
+    """Quantiles taken from a LatencyTracker summary"""
+
+    kind = 'summary'
+
+    QUANTILES = (('p50', '0.5'), ('p90', '0.9'), ('p99', '0.99'))
+
+    def samples(self):
+        names = self.labels + ('quantile',)
+        for key, summary in self._values.items():
+            for field, quantile in self.QUANTILES:
+                yield '', names, key + (quantile,), summary[field]
+            yield '_sum', self.labels, key, summary['sum']
+            yield '_count', self.labels, key, summary['count']
+
+
+class Registry:
+    """Metrics updated in place plus collectors that build metrics per scrape"""
+
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+
+    def _add(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self._add(Counter(name, help, labels))
+
+    def gauge(self, name, help, labels=()):
+        return self._add(Gauge(name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        return self._add(Histogram(name, help, labels, buckets))
+
+    def add_collector(self, collect):
+        """`collect()` returns a list of metrics; it is called on every scrape"""
+        self._collectors.append(collect)
+
+    def render(self):
+        metrics = list(self._metrics)
+        for collect in self._collectors:
+            try:
+                metrics.extend(collect())
+            except Exception as e:
+                logger.error(f"Ошибка при сборе метрик: {e}")
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+def timed(histogram, callback, *labels):
+    """Wrap an async callback so every call is observed in `histogram`"""
+
+    @functools.wraps(callback)
+    async def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await callback(*args, **kwargs)
+        finally:
+            histogram.observe(time.perf_counter() - started, *labels)
+
+    return wrapper
+
+
+def delivery_stats(dispatcher, outbox, engine, request):
+    """Plain-dict snapshot of reminder delivery (shard workers send it to the bot)"""
+    return {
+        'dispatch': dispatcher.stats(),
+        'outbox': len(outbox),
+        'lag': outbox.latency.summary(),
+        'engine': engine.stats(),
+        'api': request.stats(),
+    }
+
+
+def delivery_metrics(sources):
+    """Metrics from {worker: delivery_stats()} of every process that sends reminders"""
+    labels = ('worker',)
+    sent = Counter('taskbot_reminders_sent_total', 'Reminders sent', labels)
+    failed = Counter('taskbot_reminder_send_errors_total', 'Failed send attempts', labels)
+    retried = Counter('taskbot_reminder_send_retries_total', 'Sends retried after RetryAfter', labels)
+    queued = Gauge('taskbot_reminder_dispatch_queue', 'Reminders waiting for a dispatch worker', labels)
+    outbox = Gauge('taskbot_reminder_outbox_entries', 'Reminders in the outbox', labels)
+    lag = Summary('taskbot_reminder_lag_seconds', 'Time from due to sent, recent reminders', labels)
+    scheduled = Gauge(
+        'taskbot_reminders_scheduled', 'Pending reminders, armed as jobs or waiting in the index',
+        labels + ('state',)
+    )
+    refill = Summary('taskbot_reminder_refill_seconds', 'Time to arm the next reminders', labels)
+    scanned = Counter('taskbot_reminder_refill_scanned_total', 'Reminders taken from the index', labels)
+    for worker, stats in sources.items():
+        dispatch, engine = stats['dispatch'], stats['engine']
+        sent.set(dispatch['sent'], worker)
+        failed.set(dispatch['failed'], worker)
+        retried.set(dispatch['retried'], worker)
+        queued.set(dispatch['queue_depth'], worker)
+        outbox.set(stats['outbox'], worker)
+        lag.set(stats['lag'], worker)
+        scheduled.set(engine['armed'], worker, 'armed')
+        scheduled.set(engine['indexed'], worker, 'indexed')
+        refill.set(engine['refill_time'], worker)
+        scanned.set(engine['scanned'], worker)
+    return [sent, failed, retried, queued, outbox, lag, scheduled, refill, scanned]
+
+
+def api_metrics(sources):
+    """Metrics from {client: TimedHTTPXRequest.stats()}"""
+    labels = ('client', 'method')
+    calls = Counter('taskbot_bot_api_requests_total', 'Bot API calls', labels)
+    errors = Counter('taskbot_bot_api_errors_total', 'Bot API calls that failed', labels)
+    pool_timeouts = Counter(
+        'taskbot_bot_api_pool_timeouts_total', 'Bot API calls that found no free connection', labels
+    )
+    duration = Summary('taskbot_bot_api_request_seconds', 'Bot API call time, recent calls', labels)
+    for client, endpoints in sources.items():
+        for method, stats in endpoints.items():
+            calls.set(stats['count'], client, method)
+            errors.set(stats['errors'], client, method)
+            pool_timeouts.set(stats['pool_timeouts'], client, method)
+            duration.set(stats, client, method)
+    return [calls, errors, pool_timeouts, duration]
+
+
+class MetricsServer:
+    """Serves a Registry at GET /metrics"""
+
+    def __init__(self, registry):
+        self.registry = registry
+        self._runner = None
+
+    async def handle(self, request):
+        return web.Response(body=self.registry.render().encode(), headers={'Content-Type': CONTENT_TYPE})
+
+    async def start(self, listen, port):
+        app = web.Application()
+        app.router.add_get('/metrics', self.handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, listen, port).start()
+        logger.info(f"Метрики доступны на http://{listen}:{port}/metrics")
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
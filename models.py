@@ -0,0 +1,205 @@
+"""In-memory task representation."""
+from dataclasses import dataclass, replace
+from datetime import datetime, timezone
+from enum import Enum
+
+from recurrence import SIMPLE_RULES, Recurrence
+from timezones import get_zone, to_local, to_timestamp, utc_isoformat
+
+# How many past occurrences a repeating task remembers
+HISTORY_LIMIT = 10
+
+
+class Repeat(str, Enum):
+    """How often a task repeats; members compare equal to their JSON values"""
+    NONE = 'none'
+    DAILY = 'daily'
+    WEEKLY = 'weekly'
+    MONTHLY = 'monthly'
+    YEARLY = 'yearly'
+
+
+# Members by value; a dict lookup is several times cheaper than Repeat(value)
+# for the million calls of a large load
+_REPEATS = {repeat.value: repeat for repeat in Repeat}
+
+
+@dataclass(slots=True, eq=False)
+class Task:
+    """A task with its due time kept as a POSIX timestamp.
+
+    The stored JSON shape repeats the due moment as 'date', 'time' and an
+    ISO 'datetime' string; here it is a single float, and the strings are
+    only produced by to_dict() when the task is written to storage.
+    'datetime' is in UTC; 'date' and 'time' are the wall-clock time in the
+    task's zone `tz` (None is the server's zone, as in older stores where
+    'datetime' was the server's local time).
+
+    A repeating task is a single series: when it fires, the occurrence is
+    added to a bounded history and `due` moves to the next occurrence,
+    computed from the series start. The series follows `rule` if it is set
+    (`repeat` then holds the rule's frequency for older readers), otherwise
+    the simple rule for `repeat`. Occurrences are computed in wall-clock
+    time of the task's zone and converted to timestamps once per fire, so
+    a series keeps its time of day across DST changes.
+    """
+    name: str
+    due: float
+    repeat: Repeat = Repeat.NONE
+    created: float = 0.0
+    id: int = None
+    reminded: bool = False
+    version: int = 0
+    start: float = None
+    history: tuple = ()
+    rule: Recurrence = None
+    tz: str = None
+
+    @classmethod
+    def from_dict(cls, data):
+        """Build a task from its stored JSON shape"""
+        due = datetime.fromisoformat(data['datetime']).timestamp()
+        created_at = data.get('created_at')
+        history = data.get('history')
+        return cls(
+            name=data['name'],
+            due=due,
+            repeat=_REPEATS[data.get('repeat', 'none')],
+            created=datetime.fromisoformat(created_at).timestamp() if created_at else due,
+            id=data.get('id'),
+            reminded=data.get('reminded', False),
+            version=data.get('version', 0),
+            start=datetime.fromisoformat(data['start']).timestamp() if data.get('start') else None,
+            history=tuple([datetime.fromisoformat(when).timestamp() for when in history]) if history else (),
+            rule=Recurrence.from_dict(data['rule']) if data.get('rule') else None,
+            tz=data.get('tz'),
+        )
+
+    def to_dict(self):
+        """Return the stored JSON shape of the task"""
+        due = datetime.fromtimestamp(self.due, timezone.utc)
+        when = due.astimezone(get_zone(self.tz))
+        data = {
+            'name': self.name,
+            'date': when.strftime('%d.%m.%Y'),
+            'time': when.strftime('%H:%M'),
+            'datetime': due.isoformat(),
+            'repeat': self.repeat.value,
+            'created_at': utc_isoformat(self.created),
+        }
+        if self.tz is not None:
+            data['tz'] = self.tz
+        if self.id is not None:
+            data['id'] = self.id
+        if self.reminded:
+            data['reminded'] = True
+        if self.version:
+            data['version'] = self.version
+        if self.start is not None:
+            data['start'] = utc_isoformat(self.start)
+        if self.history:
+            data['history'] = [utc_isoformat(when) for when in self.history]
+        if self.rule is not None:
+            data['rule'] = self.rule.to_dict()
+        return data
+
+    @property
+    def zone(self):
+        """tzinfo of the task's zone, None for the server's zone"""
+        return get_zone(self.tz)
+
+    @property
+    def when(self):
+        """Due time as a naive wall-clock datetime in the task's zone"""
+        return to_local(self.due, self.zone)
+
+    @property
+    def anchor(self):
+        """Start of the series as a naive wall-clock datetime in the task's zone"""
+        return to_local(self.due if self.start is None else self.start, self.zone)
+
+    @property
+    def recurrence(self):
+        """The rule the task repeats by, or None for a one-off task"""
+        if self.rule is not None:
+            return self.rule
+        return SIMPLE_RULES.get(self.repeat.value)
+
+    @property
+    def date(self):
+        return self.when.strftime('%d.%m.%Y')
+
+    @property
+    def time(self):
+        return self.when.strftime('%H:%M')
+
+    def reschedule(self, when):
+        """Move the task to a new wall-clock due time in its zone; a new time needs a new reminder"""
+        due = to_timestamp(when, self.zone)
+        if due != self.due:
+            self.due = due
+            self.start = None
+            self.reminded = False
+
+    def fire(self, now):
+        """Mark the current occurrence as reminded.
+
+        A one-off task becomes reminded; a repeating task records the
+        occurrence and moves to the first occurrence after both it and
+        `now`, so occurrences missed while the bot was down are skipped.
+        A series that has ended (until/count) becomes reminded as well.
+        """
+        rule = self.recurrence
+        if rule is None:
+            self.reminded = True
+            return
+        # The next occurrence is found before anything changes, so a rule
+        # that fails leaves the task as it was
+        start = self.due if self.start is None else self.start
+        zone = self.zone
+        next_when = rule.next_after(to_local(start, zone), to_local(max(self.due, now), zone))
+        self.start = start
+        self.history = (self.history + (self.due,))[-HISTORY_LIMIT:]
+        if next_when is None:
+            self.reminded = True
+            return
+        self.due = to_timestamp(next_when, zone)
+
+    def move_to_zone(self, tz):
+        """Move the task to zone `tz` keeping the wall-clock times of its series"""
+        old, new = self.zone, get_zone(tz)
+        self.due = to_timestamp(to_local(self.due, old), new)
+        if self.start is not None:
+            self.start = to_timestamp(to_local(self.start, old), new)
+        self.tz = tz
+
+    def copy(self):
+        return replace(self)
+
+
+def fold_series(tasks):
+    """Fold fired copies of repeating tasks into the history of one task.
+
+    Older versions stored every occurrence of a repeating task as a new
+    task and kept fired ones with reminded=True. Copies of one series share
+    name, repeat and creation time; the pending copy (or the latest one)
+    is kept. Return (changed, dropped) lists of tasks.
+    """
+    series = {}
+    for task in tasks:
+        if task.repeat is not Repeat.NONE:
+            series.setdefault((task.name, task.repeat, task.created), []).append(task)
+
+    changed, dropped = [], []
+    for copies in series.values():
+        if len(copies) < 2:
+            continue
+        copies.sort(key=lambda task: task.due)
+        pending = [task for task in copies if not task.reminded]
+        keep = pending[0] if pending else copies[-1]
+        fired = [task.due for task in copies if task.reminded and task is not keep]
+        keep.start = copies[0].due
+        keep.history = tuple(sorted(keep.history + tuple(fired)))[-HISTORY_LIMIT:]
+        changed.append(keep)
+        dropped.extend(task for task in copies if task is not keep)
+    return changed, dropped
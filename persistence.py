@@ -0,0 +1,171 @@
+"""PTB persistence for conversation state, kept in the task storage.
+
+ConversationHandler states and users' user_data go to the same backend
+as tasks, so a restart (e.g. a deploy) resumes half-finished /addtask,
+/deletetask and /edittask dialogs. Changes are written to the backend's
+buffer and become durable with the bot's write-behind flush, so a burst
+of them costs one write; unchanged user_data is not written at all.
+
+user_data is not loaded at startup. PTB calls refresh_user_data() before
+a user's handler runs, and that user's data is read from the backend
+then. evict() unloads users idle for `idle_timeout` seconds (and the
+least recently seen ones while more than `cache_size` are loaded), so
+memory follows the number of active users, not of all users ever seen.
+Conversations left unfinished for `conversation_ttl` seconds are dropped
+when the handlers load them.
+"""
+import json
+import logging
+import time
+from collections import OrderedDict
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+from models import Task
+
+logger = logging.getLogger(__name__)
+
+
+def _encode(value):
+    if isinstance(value, Task):
+        return {'__task__': value.to_dict()}
+    raise TypeError(f"{type(value).__name__} cannot be stored in user_data")
+
+
+def _decode(data):
+    if '__task__' in data:
+        return Task.from_dict(data['__task__'])
+    return data
+
+
+class StorePersistence(BasePersistence):
+    """Keeps user_data and conversation states in a StorageBackend"""
+
+    def __init__(self, backend, update_interval=60, cache_size=10000, idle_timeout=1800,
+                 conversation_ttl=7 * 24 * 3600):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval
+        )
+        self.backend = backend
+        self.cache_size = cache_size
+        self.idle_timeout = idle_timeout
+        self.conversation_ttl = conversation_ttl
+        # Users whose user_data is loaded: {user_id: last seen}, least recent first
+        self._seen = OrderedDict()
+        # What was last read or written for each loaded user
+        self._saved = {}
+
+    async def get_user_data(self):
+        # Read per user in refresh_user_data()
+        return {}
+
+    async def refresh_user_data(self, user_id, user_data):
+        if user_id in self._seen:
+            self._seen.move_to_end(user_id)
+            self._seen[user_id] = time.monotonic()
+            return
+        stored = self.backend.load_user_data(str(user_id))
+        self._seen[user_id] = time.monotonic()
+        self._saved[user_id] = json.dumps(stored or {}, ensure_ascii=False, sort_keys=True)
+        if stored and not user_data:
+            user_data.update(json.loads(self._saved[user_id], object_hook=_decode))
+
+    async def update_user_data(self, user_id, data):
+        # Only users whose data was loaded can have changed it
+        if user_id not in self._seen:
+            return
+        text = json.dumps(data, default=_encode, ensure_ascii=False, sort_keys=True)
+        if text == self._saved.get(user_id):
+            return
+        self._saved[user_id] = text
+        if data:
+            self.backend.save_user_data(str(user_id), json.loads(text))
+        else:
+            self.backend.delete_user_data(str(user_id))
+
+    async def drop_user_data(self, user_id):
+        self._seen.pop(user_id, None)
+        self._saved.pop(user_id, None)
+        self.backend.delete_user_data(str(user_id))
+
+    async def get_conversations(self, name):
+        now = time.time()
+        conversations = {}
+        expired = 0
+        for key, (state, updated) in self.backend.load_conversations(name).items():
+            if now - updated > self.conversation_ttl:
+                self.backend.delete_conversation(name, key)
+                expired += 1
+            else:
+                conversations[tuple(json.loads(key))] = state
+        if expired:
+            logger.info(f"Удалено незавершённых диалогов {name}: {expired}")
+        return conversations
+
+    async def update_conversation(self, name, key, new_state):
+        key = json.dumps(list(key))
+        if new_state is None:
+            self.backend.delete_conversation(name, key)
+        else:
+            self.backend.save_conversation(name, key, new_state)
+
+    def evict(self, application):
+        """Unload the user_data of idle users from the application; return how many"""
+        # PTB has no public way to unload user_data without deleting it from
+        # the persistence, so entries are removed from its dict directly
+        user_data = application._user_data
+        now = time.monotonic()
+        # A user PTB may still write back must stay loaded until it has
+        min_idle = max(2 * self.update_interval, 1)
+        evicted = 0
+        while self._seen:
+            user_id, seen = next(iter(self._seen.items()))
+            idle = now - seen
+            if idle < min_idle or (len(self._seen) <= self.cache_size and idle < self.idle_timeout):
+                break
+            del self._seen[user_id]
+            del self._saved[user_id]
+            user_data.pop(user_id, None)
+            evicted += 1
+        # Empty entries PTB creates for users no handler was run for
+        for user_id in [user_id for user_id in user_data if user_id not in self._seen]:
+            if not user_data[user_id]:
+                del user_data[user_id]
+        return evicted
+
+    def loaded_users(self):
+        """Number of users whose user_data is in memory"""
+        return len(self._seen)
+
+    async def flush(self):
+        await self.backend.flush_async()
+
+    # Bot data, chat data and callback data are not used by the bot
+
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def update_chat_data(self, chat_id, data):
+        pass
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def drop_chat_data(self, chat_id):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
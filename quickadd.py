@@ -0,0 +1,444 @@
+"""Tasks from one message: quick-add lines, CSV and iCalendar.
+
+A quick-add line is a task in plain Russian, e.g.
+
+    Купить продукты завтра 14:30 каждую неделю
+    Планёрка по будням в 10:00
+    Оплатить счета 25.11 каждый месяц
+    Позвонить маме через 2 часа
+
+Dates, times and repeats are found in one pass over the words of the
+line with precomputed word tables; whatever is left is the task name. A line
+needs a date or a time to be a task. Without a time the task is at
+DEFAULT_TIME, without a date it is today (tomorrow if the time has passed).
+
+Many lines at once, a CSV table (name, date, time, repeat columns) or an
+iCalendar file become many tasks; lines that cannot be read are reported
+by number and do not stop the rest.
+"""
+import csv
+import re
+from dataclasses import dataclass
+from datetime import date, datetime, time, timedelta
+from functools import lru_cache
+
+import ical
+from models import Repeat, Task
+from recurrence import SIMPLE_RULES, Recurrence
+from timezones import get_zone, to_timestamp
+
+# Time of tasks given only a date
+DEFAULT_TIME = time(9, 0)
+
+_WEEKDAY_WORDS = {
+    'понедельник': 0, 'пн': 0,
+    'вторник': 1, 'вт': 1,
+    'среда': 2, 'среду': 2, 'ср': 2,
+    'четверг': 3, 'чт': 3,
+    'пятница': 4, 'пятницу': 4, 'пт': 4,
+    'суббота': 5, 'субботу': 5, 'сб': 5,
+    'воскресенье': 6, 'вс': 6,
+}
+_DAYS_FROM_TODAY = {'сегодня': 0, 'завтра': 1, 'послезавтра': 2}
+_UNITS = {
+    'дня': 'daily', 'дней': 'daily', 'день': 'daily',
+    'недели': 'weekly', 'недель': 'weekly', 'неделю': 'weekly',
+    'месяца': 'monthly', 'месяцев': 'monthly', 'месяц': 'monthly',
+    'года': 'yearly', 'год': 'yearly', 'лет': 'yearly',
+}
+_LATER = {
+    'мин': 'minutes', 'минуту': 'minutes', 'минуты': 'minutes', 'минут': 'minutes',
+    'час': 'hours', 'часа': 'hours', 'часов': 'hours',
+    'день': 'days', 'дня': 'days', 'дней': 'days',
+    'неделю': 'weeks', 'недели': 'weeks', 'недель': 'weeks',
+}
+_FIXED_RULES = {
+    'ежедневно': Recurrence('daily'),
+    'еженедельно': Recurrence('weekly'),
+    'ежемесячно': Recurrence('monthly'),
+    'ежегодно': Recurrence('yearly'),
+}
+_WORKDAYS = Recurrence('weekly', weekdays=range(5))
+_WEEKENDS = Recurrence('weekly', weekdays=(5, 6))
+_LAST_DAY = Recurrence('monthly', day='last')
+
+# What the first word of a token is; the tokens are read word by word with
+# these lookups, the line is never searched character by character
+_WORDS = {word: 'days' for word in _DAYS_FROM_TODAY}
+_WORDS.update({word: 'fixed' for word in _FIXED_RULES})
+_WORDS.update({
+    'на': 'on', 'в': 'at', 'во': 'at', 'по': 'by', 'через': 'later',
+    'каждый': 'every', 'каждую': 'every', 'каждое': 'every', 'каждые': 'every',
+})
+# Words that may start a token, also with a trailing comma ("завтра,")
+_STARTS = frozenset(_WORDS) | {word + mark for word in _WORDS for mark in ',;'}
+# A word starting with a digit: 25.11, 25.11.2025, 25/11/25, 2025-11-25 or 14:30
+_NUMBER = re.compile(
+    r'(?:(\d{1,2})[./](\d{1,2})(?:[./](\d{4}|\d{2}))?|(\d{4})-(\d{2})-(\d{2})|(\d{1,2}):(\d{2}))[,;]?'
+)
+# Prepositions left dangling at the end of a name ("Отчёт к 25.11" -> "Отчёт")
+_TRAILING = {'в', 'во', 'на', 'к', 'до', 'с', '-', '—'}
+
+# Values of a CSV 'repeat' column besides quick-add phrases
+_REPEAT_VALUES = {repeat.value: repeat.value for repeat in Repeat} | {
+    '': 'none', 'нет': 'none', 'не повторять': 'none',
+}
+_CSV_COLUMNS = {
+    'name': 'name', 'название': 'name', 'задача': 'name',
+    'date': 'date', 'дата': 'date',
+    'time': 'time', 'время': 'time',
+    'repeat': 'repeat', 'повтор': 'repeat',
+}
+
+
+@dataclass(slots=True)
+class ParsedTask:
+    """A task read from text; times are wall-clock times in the user's zone.
+
+    `start` is the start of the series when it is earlier than `when`
+    (a series that began in the past keeps counting from its start).
+    """
+    name: str
+    when: datetime
+    rule: Recurrence = None
+    start: datetime = None
+
+    def to_task(self, tz, created):
+        """Task for the user with time zone `tz`"""
+        zone = get_zone(tz)
+        rule = self.rule
+        repeat = Repeat.NONE if rule is None else Repeat(rule.freq)
+        if rule is not None and rule == SIMPLE_RULES[rule.freq]:
+            rule = None
+        return Task(
+            name=self.name,
+            due=to_timestamp(self.when, zone),
+            repeat=repeat,
+            created=created,
+            start=None if self.start is None else to_timestamp(self.start, zone),
+            rule=rule,
+            tz=tz,
+        )
+
+
+@lru_cache(maxsize=1024)
+def _every(freq, interval, weekdays=None):
+    # Rules are not changed once made, so tasks can share them
+    return Recurrence(freq, interval=interval, weekdays=weekdays)
+
+
+def _word(words, i):
+    word = words[i]
+    return word[:-1] if word[-1] in ',;' else word
+
+
+@lru_cache(maxsize=4096)
+def _number(word):
+    """('date', value) or ('time', value) for a word starting with a digit, or None"""
+    match = _NUMBER.fullmatch(word)
+    if match is None:
+        return None
+    day, month, year, iso_year, iso_month, iso_day, hour, minute = match.groups()
+    if hour is not None:
+        return 'time', (int(hour), int(minute))
+    if iso_year is not None:
+        return 'date', ('date', int(iso_year), int(iso_month), int(iso_day))
+    if year is not None:
+        return 'date', ('date', int(year) + (2000 if len(year) == 2 else 0), int(month), int(day))
+    # 1.5 may as well be a quantity ("1.5 литра"); 01.05 and 1.5.2030 are dates
+    return 'date', ('date' if len(day) == len(month) == 2 else 'short', None, int(month), int(day))
+
+
+def _token(words, i, n):
+    """(slot, value, index after the token) for a token starting at words[i], or None.
+
+    `words` are lower-case. Slots are 'date', 'time', 'later' and 'rule'.
+    """
+    word = words[i]
+    if word[0].isdigit():
+        found = _number(word)
+        return None if found is None else (found[0], found[1], i + 1)
+    word = _word(words, i)
+    kind = _WORDS.get(word)
+    if kind is None:
+        return None
+    if kind == 'days':
+        return 'date', ('days', _DAYS_FROM_TODAY[word]), i + 1
+    if kind == 'fixed':
+        return 'rule', _FIXED_RULES[word], i + 1
+    if i + 1 == n:
+        return None
+    following = _word(words, i + 1)
+    if kind == 'on':
+        # "на завтра", "на 25.11"
+        found = _token(words, i + 1, n)
+        return found if found is not None and found[0] == 'date' else None
+    if kind == 'at':
+        if following[0].isdigit():
+            found = _number(words[i + 1])
+            return None if found is None or found[0] != 'time' else (found[0], found[1], i + 2)
+        if following in _WEEKDAY_WORDS:
+            return 'date', ('weekday', _WEEKDAY_WORDS[following]), i + 2
+        if words[i + 1:i + 4] == ['последний', 'день', 'месяца']:
+            return 'rule', _LAST_DAY, i + 4
+        return None
+    if kind == 'by':
+        if following == 'будням':
+            return 'rule', _WORKDAYS, i + 2
+        if following == 'выходным':
+            return 'rule', _WEEKENDS, i + 2
+        return None
+    # "через 2 часа", "через неделю"; "каждые 3 дня", "каждый вторник и четверг"
+    j = i + 1
+    amount = 1
+    if following.isdigit():
+        amount = int(following)
+        j += 1
+        if j == n:
+            return None
+        following = _word(words, j)
+    if kind == 'later':
+        unit = _LATER.get(following)
+        return None if unit is None else ('later', (amount, unit), j + 1)
+    freq = _UNITS.get(following)
+    if freq is not None:
+        return 'rule', _every(freq, amount), j + 1
+    weekdays = []
+    while following in _WEEKDAY_WORDS:
+        weekdays.append(_WEEKDAY_WORDS[following])
+        j += 1
+        # Дни через запятую или "и": "каждый пн, ср и пт"
+        if j < n and words[j - 1][-1] == ',':
+            following = _word(words, j)
+        elif j + 1 < n and words[j] == 'и':
+            j += 1
+            following = _word(words, j)
+        else:
+            break
+        if following not in _WEEKDAY_WORDS:
+            j -= 1 if words[j - 1] == 'и' else 0
+            break
+    if not weekdays:
+        return None
+    return 'rule', _every('weekly', amount, frozenset(weekdays)), j
+
+
+def _fits(slots, slot):
+    """Whether a token for `slot` may join the already found `slots`"""
+    if slot in slots:
+        return False
+    if slot in ('date', 'time'):
+        return 'later' not in slots
+    return slot != 'later' or ('date' not in slots and 'time' not in slots)
+
+
+def _scan(text):
+    """Split text into the name and the date, time and repeat it mentions.
+
+    Returns (name, fields). A second mention of the same kind (two dates)
+    stays in the name.
+    """
+    words = text.split()
+    lowered = text.lower().split()
+    n = len(words)
+    fields = {}
+    name = []
+    # (place in the name, words) of a short date, given back to the name if another date follows
+    short = None
+    i = 0
+    while i < n:
+        word = lowered[i]
+        # Most words are the name; only a digit or a table word can start a token
+        found = _token(lowered, i, n) if word in _STARTS or word[0].isdigit() else None
+        if found is not None:
+            slot, value, end = found
+            if (short is not None and (slot == 'later' or slot == 'date' and value[0] != 'short')
+                    and _fits(fields.keys() - {'date'}, slot)):
+                # "Купить 1.5 литра молока завтра": 1.5 - количество, а не дата
+                name.insert(*short)
+                del fields['date']
+                short = None
+            if _fits(fields, slot):
+                if slot == 'date' and value[0] == 'short':
+                    short = len(name), ' '.join(words[i:end])
+                fields[slot] = value
+                i = end
+                continue
+        name.append(words[i])
+        i += 1
+    while name and name[-1].lower() in _TRAILING:
+        name.pop()
+    if name:
+        name[-1] = name[-1].rstrip(',;:')
+    return ' '.join(name), fields
+
+
+def _date(value, now):
+    kind = value[0]
+    today = now.date()
+    if kind == 'days':
+        return today + timedelta(days=value[1])
+    if kind == 'weekday':
+        return today + timedelta(days=(value[1] - today.weekday()) % 7)
+    _, year, month, day = value
+    if year is not None:
+        return date(year, month, day)
+    # Без года - ближайшая такая дата
+    when = date(today.year, month, day)
+    return when if when >= today else date(today.year + 1, month, day)
+
+
+def _time(value):
+    hour, minute = value
+    if hour > 23 or minute > 59:
+        raise ValueError(f"Invalid time: {hour}:{minute:02d}")
+    return time(hour, minute)
+
+
+def _schedule(name, when, rule, now, explicit_date):
+    """ParsedTask for a task at `when`; a past one-off task is an error"""
+    if not name:
+        raise ValueError("No task name")
+    if rule is None:
+        if when <= now:
+            raise ValueError(f"Time has passed: {when:%d.%m.%Y %H:%M}")
+        return ParsedTask(name, when)
+    first = rule.first(when)
+    if first is not None and first <= now:
+        first = rule.next_after(when, now)
+    if first is None:
+        raise ValueError("The series has no occurrences left")
+    # Серия, начатая в прошлом, продолжает считать от своего начала
+    start = when if explicit_date and first != when else None
+    return ParsedTask(name, first, rule, start)
+
+
+def _when(fields, now):
+    """(wall-clock time, whether a calendar date was given) of the scanned fields, or None"""
+    later = fields.get('later')
+    if later is not None:
+        amount, unit = later
+        try:
+            when = (now + timedelta(**{unit: amount})).replace(second=0, microsecond=0)
+        except OverflowError:
+            raise ValueError(f"Too far in the future: {amount} {unit}") from None
+        if unit in ('days', 'weeks'):
+            when = datetime.combine(when.date(), DEFAULT_TIME)
+        return when, True
+    date_value, time_value = fields.get('date'), fields.get('time')
+    if date_value is None and time_value is None:
+        return None
+    at = _time(time_value) if time_value is not None else DEFAULT_TIME
+    if date_value is None:
+        when = datetime.combine(now.date(), at)
+        return (when if when > now else when + timedelta(days=1)), False
+    when = datetime.combine(_date(date_value, now), at)
+    # "В пятницу 9:00", когда пятница сегодня и 9:00 прошло, - следующая пятница
+    if date_value[0] == 'weekday' and when <= now:
+        when += timedelta(days=7)
+    return when, date_value[0] in ('date', 'short')
+
+
+def parse_line(text, now, strict=False):
+    """Read a quick-add line as of the wall-clock time `now`.
+
+    Returns a ParsedTask, or None if the line mentions no date or time (it
+    is not a task). Raises ValueError for a task that cannot be scheduled.
+    With `strict`, a line whose only mention is a short date such as 1.5
+    (likely a quantity: "1.5 литра") is not a task either.
+    """
+    name, fields = _scan(text)
+    if strict and len(fields) == 1 and fields.get('date', ('',))[0] == 'short':
+        return None
+    found = _when(fields, now)
+    if found is None:
+        return None
+    when, explicit_date = found
+    return _schedule(name, when, fields.get('rule'), now, explicit_date)
+
+
+def _cell(cell, slot):
+    # A CSV cell has to be exactly one token of its column
+    name, fields = _scan(cell)
+    if name or list(fields) != [slot]:
+        raise ValueError(f"Cannot read {cell!r}")
+    return fields
+
+
+def _csv_row(row, columns, now):
+    values = {columns[i]: cell.strip() for i, cell in enumerate(row) if i in columns}
+    fields = {}
+    if values.get('date'):
+        fields.update(_cell(values['date'], 'date'))
+    if values.get('time'):
+        fields.update(_cell(values['time'], 'time'))
+    found = _when(fields, now)
+    if found is None:
+        raise ValueError("No date or time")
+    repeat = values.get('repeat', '')
+    if repeat.lower() in _REPEAT_VALUES:
+        freq = _REPEAT_VALUES[repeat.lower()]
+        rule = None if freq == 'none' else SIMPLE_RULES[freq]
+    else:
+        rule = _cell(repeat, 'rule')['rule']
+    when, explicit_date = found
+    return _schedule(values.get('name', ''), when, rule, now, explicit_date)
+
+
+def _csv_columns(line):
+    """Column positions of a CSV header line and its delimiter, or None if it is not one"""
+    delimiter = ';' if line.count(';') > line.count(',') else ','
+    names = [cell.strip().lower() for cell in next(csv.reader([line], delimiter=delimiter))]
+    columns = {i: _CSV_COLUMNS[cell] for i, cell in enumerate(names) if cell in _CSV_COLUMNS}
+    if 'name' not in columns.values() or len(columns) < 2:
+        return None
+    return columns, delimiter
+
+
+def parse_events(lines, now, tz=None):
+    """Yield (line number, ParsedTask or ValueError) for the events of iCalendar lines.
+
+    `lines` may be a file, which is then read as the events are parsed.
+    """
+    zone = get_zone(tz)
+    for number, event in ical.iter_events(lines):
+        try:
+            summary, when, rule = ical.event_fields(event, zone)
+            yield number, _schedule(summary, when, rule, now, True)
+        except ValueError as e:
+            yield number, e
+
+
+def parse_bulk(text, now, tz=None):
+    """Read many tasks from a message or a file.
+
+    The text is an iCalendar file, a CSV table with a header row, or
+    quick-add lines. Yields (line number, ParsedTask or ValueError);
+    blank lines are skipped.
+    """
+    lines = text.splitlines()
+    first = next((line for line in lines if line.strip()), '')
+    if first.strip().upper() == 'BEGIN:VCALENDAR':
+        yield from parse_events(lines, now, tz)
+        return
+    header = _csv_columns(first) if first.count(',') + first.count(';') else None
+    if header is not None:
+        columns, delimiter = header
+        start = lines.index(first) + 1
+        for number, row in enumerate(csv.reader(lines[start:], delimiter=delimiter), start + 1):
+            if not any(cell.strip() for cell in row):
+                continue
+            try:
+                yield number, _csv_row(row, columns, now)
+            except ValueError as e:
+                yield number, e
+        return
+    for number, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        try:
+            parsed = parse_line(line, now)
+        except ValueError as e:
+            yield number, e
+            continue
+        yield number, parsed if parsed is not None else ValueError("No date or time")
@@ -0,0 +1,275 @@
+"""Occurrences of repeating tasks.
+
+A repeating task is one series described by a Recurrence rule. The k-th
+occurrence is computed directly from the series start, so monthly and
+yearly series do not drift when a month is shorter (Jan 31 -> Feb 28 ->
+Mar 31), and finding the next occurrence after any moment is O(1).
+"""
+import bisect
+import calendar
+import heapq
+import itertools
+import math
+from datetime import datetime, timedelta
+
+from timezones import now_local
+
+FREQUENCIES = ('daily', 'weekly', 'monthly', 'yearly')
+WEEKDAY_NAMES = ('пн', 'вт', 'ср', 'чт', 'пт', 'сб', 'вс')
+
+_MONTH_STEP = {'monthly': 1, 'yearly': 12}
+
+
+class Recurrence:
+    """Recurrence rule in the spirit of RFC 5545 RRULE.
+
+    freq      'daily', 'weekly', 'monthly' or 'yearly'
+    interval  every N periods
+    weekdays  set of weekdays (0 = Monday) for daily and weekly rules;
+              a weekly rule defaults to the weekday of the start
+    day       None (the start's day, clamped to shorter months), 'last'
+              or 'last_business' (last Monday-Friday) for monthly and
+              yearly rules
+    until     last allowed occurrence (datetime)
+    count     number of occurrences generated by the rule
+    exdates   occurrences to skip; like in RRULE, they still count
+              towards `count`
+
+    Every occurrence is at the start's time of day. Day-based rules repeat
+    a fixed pattern of day offsets every `period` days (lcm(interval, 7)
+    for daily rules with weekdays, 7 * interval for weekly ones), so the
+    k-th occurrence and the index of the next one after any moment are a
+    division and a bisect away; the pattern only depends on the start's
+    weekday and is cached.
+    """
+
+    __slots__ = ('freq', 'interval', 'weekdays', 'day', 'until', 'count', 'exdates', '_patterns')
+
+    def __init__(self, freq, interval=1, weekdays=None, day=None, until=None, count=None, exdates=()):
+        if freq not in FREQUENCIES:
+            raise ValueError(f"Unknown frequency: {freq}")
+        if interval < 1:
+            raise ValueError("Interval must be positive")
+        if weekdays is not None:
+            weekdays = frozenset(weekdays)
+            if not weekdays or not weekdays <= set(range(7)):
+                raise ValueError("Weekdays must be a non-empty set of 0..6")
+            if freq not in ('daily', 'weekly'):
+                raise ValueError("Weekdays are only supported for daily and weekly rules")
+        if day not in (None, 'last', 'last_business'):
+            raise ValueError(f"Unknown day: {day}")
+        if day is not None and freq not in _MONTH_STEP:
+            raise ValueError("Day is only supported for monthly and yearly rules")
+        self.freq = freq
+        self.interval = interval
+        self.weekdays = weekdays
+        self.day = day
+        self.until = until
+        self.count = count
+        self.exdates = frozenset(exdates)
+        self._patterns = {}
+
+    def __eq__(self, other):
+        return isinstance(other, Recurrence) and self.to_dict() == other.to_dict()
+
+    def __repr__(self):
+        return f"Recurrence({self.to_dict()})"
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(
+            data['freq'],
+            interval=data.get('interval', 1),
+            weekdays=data.get('weekdays'),
+            day=data.get('day'),
+            until=datetime.fromisoformat(data['until']) if data.get('until') else None,
+            count=data.get('count'),
+            exdates=(datetime.fromisoformat(when) for when in data.get('exdates', ())),
+        )
+
+    def to_dict(self):
+        data = {'freq': self.freq}
+        if self.interval != 1:
+            data['interval'] = self.interval
+        if self.weekdays is not None:
+            data['weekdays'] = sorted(self.weekdays)
+        if self.day is not None:
+            data['day'] = self.day
+        if self.until is not None:
+            data['until'] = self.until.isoformat()
+        if self.count is not None:
+            data['count'] = self.count
+        if self.exdates:
+            data['exdates'] = sorted(when.isoformat() for when in self.exdates)
+        return data
+
+    def describe(self):
+        """Human-readable description for messages"""
+        n = self.interval
+        if self.freq == 'daily':
+            text = "каждый день" if n == 1 else f"каждые {n} дн."
+        elif self.freq == 'weekly':
+            text = "каждую неделю" if n == 1 else f"каждые {n} нед."
+        elif self.freq == 'monthly':
+            text = "каждый месяц" if n == 1 else f"каждые {n} мес."
+        else:
+            text = "каждый год" if n == 1 else f"каждые {n} г."
+        if self.weekdays is not None:
+            text += ", " + ", ".join(WEEKDAY_NAMES[d] for d in sorted(self.weekdays))
+        if self.day == 'last':
+            text += ", в последний день месяца"
+        elif self.day == 'last_business':
+            text += ", в последний рабочий день месяца"
+        if self.until is not None:
+            text += f", до {self.until:%d.%m.%Y}"
+        if self.count is not None:
+            text += f", повторений: {self.count}"
+        if self.exdates:
+            text += f", пропусков: {len(self.exdates)}"
+        return text
+
+    def _pattern(self, weekday):
+        pattern = self._patterns.get(weekday)
+        if pattern is not None:
+            return pattern
+        n = self.interval
+        if self.freq == 'daily':
+            if self.weekdays is None:
+                pattern = (n, (0,), 0)
+            else:
+                period = math.lcm(n, 7)
+                offsets = tuple(d for d in range(0, period, n) if (weekday + d) % 7 in self.weekdays)
+                pattern = (period, offsets, 0)
+        else:
+            # Offsets count from the Monday of the start's week
+            offsets = tuple(sorted(self.weekdays if self.weekdays is not None else (weekday,)))
+            pattern = (7 * n, offsets, sum(1 for d in offsets if d < weekday))
+        self._patterns[weekday] = pattern
+        return pattern
+
+    def _month_day(self, year, month, day):
+        last = calendar.monthrange(year, month)[1]
+        if self.day == 'last':
+            return last
+        if self.day == 'last_business':
+            return last - max(calendar.weekday(year, month, last) - 4, 0)
+        return min(day, last)
+
+    def _month_candidate(self, start, j):
+        months = start.month - 1 + _MONTH_STEP[self.freq] * self.interval * j
+        year, month = start.year + months // 12, months % 12 + 1
+        return start.replace(year=year, month=month, day=self._month_day(year, month, start.day))
+
+    def _month_skip(self, start):
+        # 1 if the rule's day in the start's month comes before the start
+        return 1 if self._month_day(start.year, start.month, start.day) < start.day else 0
+
+    def occurrence(self, start, k):
+        """Return the k-th occurrence (k=0 is the first) ignoring until/count/exdates, or None"""
+        if self.freq in _MONTH_STEP:
+            return self._month_candidate(start, k + self._month_skip(start))
+        period, offsets, skip = self._pattern(start.weekday())
+        if not offsets:
+            return None
+        base = start if self.freq == 'daily' else start - timedelta(days=start.weekday())
+        j = k + skip
+        return base + timedelta(days=(j // len(offsets)) * period + offsets[j % len(offsets)])
+
+    def _index_after(self, start, after):
+        """Index of the first occurrence later than `after`"""
+        if after < start:
+            return 0
+        if self.freq in _MONTH_STEP:
+            step = _MONTH_STEP[self.freq] * self.interval
+            months = (after.year - start.year) * 12 + after.month - start.month
+            k = max(months // step - self._month_skip(start), 0)
+            while self.occurrence(start, k) <= after:
+                k += 1
+            return k
+        # Occurrences are at the start's time of day, so the first one
+        # after `after` is on the first pattern day at least m days from base
+        period, offsets, skip = self._pattern(start.weekday())
+        base = start if self.freq == 'daily' else start - timedelta(days=start.weekday())
+        m = (after - base).days + 1
+        j = (m // period) * len(offsets) + bisect.bisect_left(offsets, m % period)
+        return max(j - skip, 0)
+
+    def _valid(self, start, k):
+        """Return (occurrence or None, whether the series continues)"""
+        if self.count is not None and k >= self.count:
+            return None, False
+        when = self.occurrence(start, k)
+        if when is None or (self.until is not None and when > self.until):
+            return None, False
+        return (None if when in self.exdates else when), True
+
+    def _empty(self, start):
+        return self.freq not in _MONTH_STEP and not self._pattern(start.weekday())[1]
+
+    def next_after(self, start, after):
+        """Return the first occurrence later than `after`, or None if the series ended"""
+        if self._empty(start):
+            return None
+        k = self._index_after(start, after)
+        while True:
+            when, more = self._valid(start, k)
+            if when is not None or not more:
+                return when
+            k += 1
+
+    def first(self, start):
+        """Return the first occurrence of a series starting at `start`"""
+        if (self.weekdays is None and self.day is None and self.count != 0
+                and (self.until is None or start <= self.until) and start not in self.exdates):
+            # Without weekdays or a day of the month the start is an occurrence
+            return start
+        return self.next_after(start, start - timedelta(microseconds=1))
+
+    def occurrences(self, start, after):
+        """Yield the occurrences later than `after` in time order"""
+        if self._empty(start):
+            return
+        for k in itertools.count(self._index_after(start, after)):
+            when, more = self._valid(start, k)
+            if not more:
+                return
+            if when is not None:
+                yield when
+
+
+# Rules for the simple repeat choices of the add/edit dialogs
+SIMPLE_RULES = {freq: Recurrence(freq) for freq in FREQUENCIES}
+
+
+def task_occurrences(task, after):
+    """Yield the task's pending occurrences later than `after`"""
+    if task.reminded:
+        return
+    when = task.when
+    if when > after:
+        yield when
+        after = when
+    rule = task.recurrence
+    if rule is not None:
+        yield from rule.occurrences(task.anchor, after)
+
+
+def _stream(i, task, after):
+    for when in task_occurrences(task, after):
+        yield when, i, task
+
+
+def next_occurrences(tasks, count, after=None):
+    """Return the next `count` (datetime, task) pairs over many tasks at once.
+
+    Occurrences are wall-clock times, so the tasks should share a zone (the
+    tasks of one user); `after` defaults to the current time in that zone.
+
+    Every series is a lazy stream and the streams are merged on a heap, so
+    the cost is O(len(tasks) + count * log(len(tasks))) however far ahead
+    the occurrences are.
+    """
+    if after is None:
+        after = now_local(tasks[0].zone if tasks else None)
+    streams = [_stream(i, task, after) for i, task in enumerate(tasks)]
+    return [(when, task) for when, _, task in itertools.islice(heapq.merge(*streams), count)]
@@ -0,0 +1,32 @@
+"""Reminder messages, shared by the bot and the shard workers."""
+
+
+def reminder_key(user_id, task):
+    """Identify one occurrence of a task's reminder"""
+    return f"{user_id}:{task.id}:{task.when.isoformat()}"
+
+
+def reminder_text(task):
+    """Text of the reminder for the task's current occurrence"""
+    task_datetime = task.when
+
+    repeat_type = task.repeat
+    repeat_info = ""
+    if repeat_type == 'daily':
+        repeat_info = "\n🔁 Повторяется каждый день"
+    elif repeat_type == 'weekly':
+        repeat_info = "\n🔁 Повторяется каждую неделю"
+    elif repeat_type == 'monthly':
+        repeat_info = "\n🔁 Повторяется каждый месяц"
+    elif repeat_type == 'yearly':
+        repeat_info = "\n🔁 Повторяется каждый год"
+    if task.rule is not None:
+        repeat_info = f"\n🔁 Повторяется: {task.rule.describe()}"
+
+    return (
+        "⏰ Напоминание о задаче!\n\n"
+        f"📝 {task.name}\n"
+        f"📅 {task_datetime:%d.%m.%Y} в {task_datetime:%H:%M}"
+        f"{repeat_info}\n\n"
+        "Не забудьте выполнить! ✅"
+    )
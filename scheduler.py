@@ -0,0 +1,244 @@
+"""Reminder scheduling primitives."""
+import heapq
+import itertools
+import logging
+import math
+import time
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+
+class DueIndex:
+    """Min-heap of pending reminders ordered by due time, keyed by task id.
+
+    Entries are removed lazily: remove() only marks the heap entry, and
+    marked entries are skipped when popped. The heap is rebuilt once marked
+    entries outnumber live ones, so its size stays proportional to the
+    number of pending tasks.
+    """
+
+    _REMOVED = object()
+
+    def __init__(self):
+        self._heap = []
+        self._entries = {}
+        self._counter = itertools.count()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def build(self, items):
+        """Index (user_id, task) pairs from scratch in O(n)"""
+        self._heap = []
+        self._entries = {}
+        for user_id, task in items:
+            entry = [task.due, next(self._counter), user_id, task]
+            self._entries[task.id] = entry
+            self._heap.append(entry)
+        heapq.heapify(self._heap)
+
+    def add(self, user_id, task):
+        """Add a task, replacing its previous entry if it is already indexed"""
+        self.remove(task)
+        entry = [task.due, next(self._counter), user_id, task]
+        self._entries[task.id] = entry
+        heapq.heappush(self._heap, entry)
+
+    def remove(self, task):
+        """Remove a task from the index if present"""
+        entry = self._entries.pop(task.id, None)
+        if entry is None:
+            return
+        entry[-1] = self._REMOVED
+        if len(self._heap) > 2 * len(self._entries) + 64:
+            self._heap = [e for e in self._heap if e[-1] is not self._REMOVED]
+            heapq.heapify(self._heap)
+
+    def peek(self):
+        """Return the earliest (due, user_id, task) or None"""
+        heap = self._heap
+        while heap and heap[0][-1] is self._REMOVED:
+            heapq.heappop(heap)
+        if not heap:
+            return None
+        due, _, user_id, task = heap[0]
+        return due, user_id, task
+
+    def pop(self):
+        """Remove and return the earliest (due, user_id, task) or None"""
+        heap = self._heap
+        while heap:
+            due, _, user_id, task = heapq.heappop(heap)
+            if task is self._REMOVED:
+                continue
+            del self._entries[task.id]
+            return due, user_id, task
+        return None
+
+
+class LatencyTracker:
+    """Keeps the most recent delivery lags (actual minus scheduled send time)"""
+
+    def __init__(self, size=10000):
+        self._samples = deque(maxlen=size)
+        self.count = 0
+        self.total = 0.0
+
+    def add(self, lag):
+        self._samples.append(lag)
+        self.count += 1
+        self.total += lag
+
+    def summary(self):
+        """Return total count and sum, and p50/p90/p99/max of recent lags in seconds"""
+        ordered = sorted(self._samples)
+        result = {'count': self.count, 'sum': self.total}
+        for name, p in (('p50', 50), ('p90', 90), ('p99', 99), ('max', 100)):
+            result[name] = ordered[max(math.ceil(p / 100 * len(ordered)) - 1, 0)] if ordered else None
+        return result
+
+
+class ReminderEngine:
+    """Single owner of reminder delivery.
+
+    Pending tasks live in a DueIndex; only the `window` earliest of them are
+    armed as JobQueue jobs at any time, each set to fire at the task's exact
+    due time. When an armed job fires, the task is delivered and the next
+    task from the index is armed, so the number of scheduler jobs stays
+    constant however many future tasks exist. A task that becomes due
+    sooner than the latest armed one is armed right away. Jobs are named
+    ``task_<id>``, so an edit or delete cancels exactly the task's job.
+
+    Tasks whose time passed while the loop was busy or the bot was down are
+    delivered immediately, unless they are older than `catchup` seconds:
+    those are handed to `skip` without a message, so that the owner marks
+    a one-off task as reminded and moves a series past the missed
+    occurrences.
+
+    stats() reports how long arming the next tasks takes and how many
+    tasks it has taken from the index.
+    """
+
+    def __init__(self, window=100, catchup=24 * 3600):
+        self.window = window
+        self.catchup = catchup
+        self.index = DueIndex()
+        self.job_queue = None
+        self.deliver = None
+        self.skip = None
+        self._armed = {}
+        self.scanned = 0
+        self.refill_time = LatencyTracker(size=1000)
+
+    def __len__(self):
+        return len(self.index) + len(self._armed)
+
+    def build(self, items):
+        """Index (user_id, task) pairs that need a reminder"""
+        for job, _, _, _ in self._armed.values():
+            job.schedule_removal()
+        self._armed = {}
+        self.index.build(items)
+        if self.job_queue is not None:
+            self._refill()
+
+    def start(self, job_queue, deliver, skip=None):
+        """Start arming jobs; `deliver(context, user_id, task)` sends a reminder.
+
+        `skip(user_id, task)` is called for a reminder older than `catchup`.
+        """
+        self.job_queue = job_queue
+        self.deliver = deliver
+        self.skip = skip
+        self._refill()
+
+    def schedule(self, user_id, task):
+        """Schedule (or reschedule) a reminder for the task"""
+        self._cancel(task)
+        if self.job_queue is None:
+            self.index.add(user_id, task)
+            return
+
+        due = task.due
+        if len(self._armed) < self.window:
+            self._arm(due, user_id, task)
+            return
+
+        # Arm the task only if it is due before the latest armed one
+        latest_key = max(self._armed, key=lambda key: self._armed[key][1])
+        if due < self._armed[latest_key][1]:
+            job, latest_due, latest_user_id, latest_task = self._armed.pop(latest_key)
+            job.schedule_removal()
+            self.index.add(latest_user_id, latest_task)
+            self._arm(due, user_id, task)
+        else:
+            self.index.add(user_id, task)
+
+    def unschedule(self, task):
+        """Cancel the task's reminder if it is scheduled"""
+        if self._cancel(task):
+            self._refill()
+
+    def stats(self):
+        """Return armed and indexed task counts, tasks scanned and refill time"""
+        return {
+            'armed': len(self._armed),
+            'indexed': len(self.index),
+            'scanned': self.scanned,
+            'refill_time': self.refill_time.summary(),
+        }
+
+    def _cancel(self, task):
+        self.index.remove(task)
+        entry = self._armed.pop(task.id, None)
+        if entry is None:
+            return False
+        entry[0].schedule_removal()
+        return True
+
+    def _arm(self, due, user_id, task):
+        # Overdue tasks fire right away; misfire_grace_time=None makes sure
+        # APScheduler never drops a job that starts late
+        job = self.job_queue.run_once(
+            self._fire,
+            when=max(due - time.time(), 0),
+            data=task.id,
+            name=f"task_{task.id}",
+            job_kwargs={'misfire_grace_time': None}
+        )
+        self._armed[task.id] = (job, due, user_id, task)
+
+    def _refill(self):
+        started = time.perf_counter()
+        now = time.time()
+        while len(self._armed) < self.window:
+            item = self.index.pop()
+            if item is None:
+                break
+            self.scanned += 1
+            due, user_id, task = item
+            if due < now - self.catchup:
+                logger.info(f"Пропущено устаревшее напоминание для {user_id}: {task.name}")
+                if self.skip is not None:
+                    # The skipped task may come back through schedule() with
+                    # its next occurrence
+                    try:
+                        self.skip(user_id, task)
+                    except Exception as e:
+                        logger.error(f"Ошибка при пропуске напоминания: {e}")
+                continue
+            self._arm(due, user_id, task)
+        self.refill_time.add(time.perf_counter() - started)
+
+    async def _fire(self, context):
+        entry = self._armed.pop(context.job.data, None)
+        if entry is None:
+            return
+        _, _, user_id, task = entry
+        try:
+            await self.deliver(context, user_id, task)
+        except Exception as e:
+            logger.error(f"Ошибка при отправке напоминания: {e}")
+        finally:
+            self._refill()
@@ -0,0 +1,337 @@
+"""Reminder delivery sharded across worker processes.
+
+The bot process keeps receiving updates and remains the only writer of
+tasks. Reminder scheduling and sending move to N worker processes; each
+owns the users that rendezvous hashing assigns to it, and runs its own
+ReminderEngine, Dispatcher and Outbox. The processes talk over
+multiprocessing queues:
+
+    bot -> worker   ('build', [(user_id, task_dict), ...])   whole partition
+                    ('schedule', user_id, task_dict)
+                    ('unschedule', task_id)
+                    ('assign', [worker, ...])                live workers
+                    ('stop',)
+    worker -> bot   ('ready', worker)
+                    ('fired', user_id, task_id, due)
+                    ('stats', worker, delivery_stats)        for /metrics
+
+A worker that fires a reminder puts it into its outbox and reports
+'fired'; the bot then marks the task (or moves a repeating one to its
+next occurrence), which schedules it again on the owning worker. When a
+worker starts or stops, every live worker gets its new partition and the
+list of live workers, from which it decides which outbox entries are its
+own. Outboxes of all workers share one SQLite file, so entries of a
+stopped worker are picked up by the workers that take over its users.
+
+Delivery is at least once: if a worker dies, reminders it sent but had
+not yet reported (or removed from the outbox) are sent again by the
+worker that takes over.
+"""
+import asyncio
+import logging
+import multiprocessing
+import queue
+import signal
+import time
+import zlib
+from types import SimpleNamespace
+
+from bot_api import TimedHTTPXRequest, format_stats
+from dispatch import Dispatcher, Outbox
+from metrics import delivery_stats
+from models import Task
+from reminders import reminder_key, reminder_text
+from scheduler import ReminderEngine
+from storage import SQLiteBackend
+
+logger = logging.getLogger(__name__)
+
+
+def shard_for(user_id, workers):
+    """Return the worker that owns the user (rendezvous hashing).
+
+    When a worker is added or removed, only the users it gains or loses
+    change owners.
+    """
+    return max(workers, key=lambda worker: zlib.crc32(f"{worker}:{user_id}".encode()))
+
+
+class ShardCoordinator:
+    """Drop-in replacement for ReminderEngine that delegates to worker processes.
+
+    Tracks every task that needs a reminder so that partitions can be
+    rebuilt when the set of live workers changes. Worker processes are
+    checked every `check_interval` seconds and restarted when they exit.
+    worker_stats keeps the latest delivery stats reported by each worker.
+    """
+
+    def __init__(self, workers, config, check_interval=5):
+        self.workers = workers
+        self.config = config
+        self.check_interval = check_interval
+        self.on_fired = None
+        self._context = multiprocessing.get_context('spawn')
+        self._events = None
+        self._reader = None
+        self._starting = False
+        self._closing = False
+        self._processes = {}
+        self._inboxes = {}
+        self._live = []
+        self._tasks = {}
+        self.worker_stats = {}
+
+    def __len__(self):
+        return len(self._tasks)
+
+    def build(self, items):
+        """Index (user_id, task) pairs that need a reminder"""
+        self._tasks = {task.id: (user_id, task) for user_id, task in items}
+        self._rebalance()
+
+    def start(self, job_queue, on_fired):
+        """Start the workers; `on_fired(user_id, task_id, due)` handles a fired reminder"""
+        self.on_fired = on_fired
+        self._events = self._context.Queue()
+        self._starting = True
+        for worker in range(self.workers):
+            self._spawn(worker)
+        job_queue.run_once(self._listen, when=0)
+        job_queue.run_repeating(self._check, interval=self.check_interval, first=self.check_interval)
+
+    async def stop(self, timeout=15):
+        """Stop the workers, letting them send their queued reminders first"""
+        for inbox in self._inboxes.values():
+            inbox.put(('stop',))
+        loop = asyncio.get_running_loop()
+        for worker, process in self._processes.items():
+            await loop.run_in_executor(None, process.join, timeout)
+            if process.is_alive():
+                logger.warning(f"Воркер {worker} не остановился, завершаем принудительно")
+                process.terminate()
+        self._live = []
+        # Events the workers sent before exiting are handled first
+        self._closing = True
+        if self._reader is not None:
+            await self._reader
+
+    def schedule(self, user_id, task):
+        """Schedule (or reschedule) a reminder for the task"""
+        self._tasks[task.id] = (user_id, task)
+        if self._live:
+            self._send(shard_for(user_id, self._live), ('schedule', user_id, task.to_dict()))
+
+    def unschedule(self, task):
+        """Cancel the task's reminder if it is scheduled"""
+        entry = self._tasks.pop(task.id, None)
+        if entry is not None and self._live:
+            self._send(shard_for(entry[0], self._live), ('unschedule', task.id))
+
+    def _spawn(self, worker):
+        inbox = self._context.Queue()
+        process = self._context.Process(
+            target=worker_main,
+            args=(worker, inbox, self._events, self.config),
+            name=f"reminder-worker-{worker}",
+            daemon=True
+        )
+        process.start()
+        self._inboxes[worker] = inbox
+        self._processes[worker] = process
+
+    def _send(self, worker, message):
+        self._inboxes[worker].put(message)
+
+    def _rebalance(self):
+        if not self._live:
+            return
+        partitions = {worker: [] for worker in self._live}
+        for user_id, task in self._tasks.values():
+            partitions[shard_for(user_id, self._live)].append((user_id, task.to_dict()))
+        for worker, items in partitions.items():
+            self._send(worker, ('assign', list(self._live)))
+            self._send(worker, ('build', items))
+        logger.info(
+            "Напоминания распределены по воркерам: "
+            + ", ".join(f"{worker}: {len(items)}" for worker, items in partitions.items())
+        )
+
+    def _handle(self, event):
+        if event[0] == 'ready':
+            worker = event[1]
+            if worker not in self._live and self._processes[worker].is_alive():
+                self._live.append(worker)
+                # On startup wait for all workers (or the first check), so
+                # overdue reminders are not fired by one worker and then
+                # handed over to another
+                if self._starting and len(self._live) < self.workers:
+                    return
+                self._starting = False
+                self._rebalance()
+        elif event[0] == 'stats':
+            self.worker_stats[event[1]] = event[2]
+        elif event[0] == 'fired':
+            try:
+                self.on_fired(*event[1:])
+            except Exception as e:
+                logger.error(f"Ошибка при обработке отправленного напоминания: {e}")
+
+    def _receive(self):
+        try:
+            return self._events.get(timeout=1)
+        except queue.Empty:
+            return None
+
+    async def _read_events(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            event = await loop.run_in_executor(None, self._receive)
+            if event is not None:
+                self._handle(event)
+            elif self._closing:
+                return
+
+    async def _listen(self, context):
+        self._reader = asyncio.create_task(self._read_events())
+
+    async def _check(self, context):
+        if self._starting:
+            self._starting = False
+            self._rebalance()
+        for worker, process in list(self._processes.items()):
+            if process.is_alive():
+                continue
+            logger.warning(f"Воркер {worker} остановился (код {process.exitcode}), перезапускаем")
+            if worker in self._live:
+                self._live.remove(worker)
+                self._rebalance()
+            self._spawn(worker)
+
+
+class LoopJobQueue:
+    """The part of PTB's JobQueue that ReminderEngine uses, on a bare event loop"""
+
+    def __init__(self):
+        self._running = set()
+
+    def run_once(self, callback, when, data=None, name=None, job_kwargs=None):
+        job = SimpleNamespace(data=data, name=name)
+
+        def run():
+            task = asyncio.create_task(callback(SimpleNamespace(job=job)))
+            self._running.add(task)
+            task.add_done_callback(self._running.discard)
+
+        handle = asyncio.get_running_loop().call_later(when, run)
+        job.schedule_removal = handle.cancel
+        return job
+
+
+def worker_main(worker, inbox, events, config):
+    """Entry point of a worker process"""
+    # Ctrl+C reaches the whole process group; the bot stops its workers itself
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    logging.basicConfig(
+        format=f'%(asctime)s - worker {worker} - %(name)s - %(levelname)s - %(message)s',
+        level=logging.INFO
+    )
+    asyncio.run(run_worker(worker, inbox, events, config))
+
+
+async def run_worker(worker, inbox, events, config):
+    from telegram import Bot
+
+    bot = Bot(config['token'], base_url=config['base_url'], request=TimedHTTPXRequest(**config['request']))
+    await bot.initialize()
+    # Entries of other workers live in the same file, so write transactions
+    # must be short
+    backend = SQLiteBackend(config['outbox_db'], autocommit=True)
+    dispatcher = Dispatcher(
+        workers=config['dispatch_workers'],
+        global_rate=config['global_rate'],
+        chat_rate=config['chat_rate']
+    )
+    outbox = Outbox(backend, dispatcher)
+    engine = ReminderEngine(window=config['window'], catchup=config['catchup'])
+    live = [worker]
+
+    async def deliver(context, user_id, task):
+        # The entry is committed before the bot marks the task as reminded
+        outbox.put(reminder_key(user_id, task), int(user_id), reminder_text(task), task.due)
+        events.put(('fired', user_id, task.id, task.due))
+
+    async def log_stats_periodically():
+        while True:
+            await asyncio.sleep(config['stats_interval'])
+            stats = dispatcher.stats()
+            latency = outbox.latency.summary()
+            logger.info(
+                f"Воркер {worker}: отправлено {stats['sent']}, ошибок {stats['failed']}, "
+                f"в очереди {stats['queue_depth']}, в outbox {len(outbox)}"
+                + (f", задержка p50={latency['p50']:.3f}с p99={latency['p99']:.3f}с"
+                   if latency['p50'] is not None else "")
+            )
+            if bot.request.endpoints:
+                logger.info(f"Воркер {worker}, Bot API: {format_stats(bot.request)}")
+
+    async def report_stats_periodically():
+        while True:
+            await asyncio.sleep(config['metrics_interval'])
+            events.put(('stats', worker, delivery_stats(dispatcher, outbox, engine, bot.request)))
+
+    dispatcher.start(bot)
+    outbox.start()
+    def skip(user_id, task):
+        # Too old to send: the bot moves the task on as if it had fired
+        events.put(('fired', user_id, task.id, task.due))
+
+    engine.start(LoopJobQueue(), deliver, skip)
+    stats_logger = asyncio.create_task(log_stats_periodically())
+    stats_reporter = None
+    if config['metrics_interval']:
+        stats_reporter = asyncio.create_task(report_stats_periodically())
+    events.put(('ready', worker))
+    loop = asyncio.get_running_loop()
+    parent = multiprocessing.parent_process()
+    started = time.monotonic()
+
+    def receive():
+        try:
+            return inbox.get(timeout=1)
+        except queue.Empty:
+            return None
+
+    try:
+        while True:
+            message = await loop.run_in_executor(None, receive)
+            if message is None:
+                if not parent.is_alive():
+                    logger.warning(f"Воркер {worker}: процесс бота завершился, останавливаемся")
+                    break
+                continue
+            kind = message[0]
+            if kind == 'stop':
+                break
+            if kind == 'assign':
+                live[:] = message[1]
+                outbox.reassign(lambda chat_id: shard_for(str(chat_id), live) == worker)
+            elif kind == 'build':
+                engine.build((user_id, Task.from_dict(data)) for user_id, data in message[1])
+                logger.info(f"Воркер {worker}: напоминаний в разделе {len(engine)}")
+            elif kind == 'schedule':
+                engine.schedule(message[1], Task.from_dict(message[2]))
+            elif kind == 'unschedule':
+                engine.unschedule(SimpleNamespace(id=message[1]))
+    finally:
+        stats_logger.cancel()
+        if stats_reporter is not None:
+            stats_reporter.cancel()
+        await outbox.stop()
+        await dispatcher.stop()
+        backend.close()
+        await bot.shutdown()
+        stats = dispatcher.stats()
+        logger.info(
+            f"Воркер {worker} остановлен: отправлено {stats['sent']}, ошибок {stats['failed']} "
+            f"за {time.monotonic() - started:.0f} с"
+        )
@@ -0,0 +1,944 @@
+"""Storage backends for tasks.
+
+A backend persists the ``{user_id: [task, ...]}`` mapping held by the bot's
+TaskStore, plus the reminder outbox and the conversation state (users'
+user_data and ConversationHandler states). Mutations are reported row by row
+(insert/update/delete) and made durable by flush(), which the bot calls
+from its write-behind job.
+"""
+import argparse
+import asyncio
+import fcntl
+import itertools
+import json
+import logging
+import os
+import sqlite3
+import time
+from datetime import datetime
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+
+class StorageBackend:
+    """Interface for task persistence"""
+
+    def load_all(self):
+        """Return all tasks as {user_id: [task, ...]}"""
+        raise NotImplementedError
+
+    def iter_tasks(self):
+        """Yield (user_id, [task, ...]) for every user, reading storage as it goes"""
+        yield from self.load_all().items()
+
+    def save_all(self, tasks):
+        """Replace everything in storage with the given tasks"""
+        raise NotImplementedError
+
+    def insert_task(self, user_id, task):
+        """Persist a new task"""
+        raise NotImplementedError
+
+    def insert_tasks(self, user_id, tasks):
+        """Persist several new tasks of a user at once: all of them or none"""
+        for task in tasks:
+            self.insert_task(user_id, task)
+
+    def update_task(self, user_id, task):
+        """Persist changes to an existing task"""
+        raise NotImplementedError
+
+    def delete_task(self, user_id, task):
+        """Remove a task from storage"""
+        raise NotImplementedError
+
+    def load_outbox(self):
+        """Return all outbox entries as a list of dicts"""
+        raise NotImplementedError
+
+    def save_outbox_entry(self, entry):
+        """Insert or replace an outbox entry (keyed by entry['key'])"""
+        raise NotImplementedError
+
+    def delete_outbox_entry(self, key):
+        """Remove an outbox entry"""
+        raise NotImplementedError
+
+    def iter_user_data(self):
+        """Yield (user_id, data) for every user with stored user_data"""
+        raise NotImplementedError
+
+    def load_user_data(self, user_id):
+        """Return the stored user_data of a user (a dict), or None"""
+        raise NotImplementedError
+
+    def save_user_data(self, user_id, data):
+        """Insert or replace the user_data of a user"""
+        raise NotImplementedError
+
+    def delete_user_data(self, user_id):
+        """Remove the user_data of a user"""
+        raise NotImplementedError
+
+    def load_conversations(self, name):
+        """Return {key: (state, updated timestamp)} of a ConversationHandler"""
+        raise NotImplementedError
+
+    def save_conversation(self, name, key, state):
+        """Insert or replace a conversation's state (`key` is a string)"""
+        raise NotImplementedError
+
+    def delete_conversation(self, name, key):
+        """Remove a finished conversation"""
+        raise NotImplementedError
+
+    def flush(self):
+        """Make pending changes durable"""
+
+    async def flush_async(self):
+        """Make pending changes durable without blocking the event loop"""
+        self.flush()
+
+    def close(self):
+        """Flush and release resources"""
+        self.flush()
+
+    def generation(self):
+        """A value that changes when a write may make a reader's view inconsistent, or None"""
+        return None
+
+    def files(self):
+        """Paths of the files the backend writes"""
+        return []
+
+    def size(self):
+        """Total size of the backend's files in bytes"""
+        return sum(os.path.getsize(path) for path in self.files() if os.path.exists(path))
+
+
+def atomic_write(path, data):
+    """Write text to `path` so that readers see either the old or the new file"""
+    directory = os.path.dirname(os.path.abspath(path))
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    if hasattr(os, 'O_DIRECTORY'):
+        dir_fd = os.open(directory, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+
+class JsonBackend(StorageBackend):
+    """JSON snapshot plus an append-only journal of mutations.
+
+    Every insert/update/delete (and outbox change) is appended to
+    ``<name>.journal`` as one JSON line, so a change costs O(1) instead of
+    a rewrite of the whole document. Lines are buffered and written with a
+    single fsync per flush. Once the journal outgrows `compact_bytes`, the
+    compactor folds it into the snapshot (``<name>.json``,
+    ``<name>_outbox.json`` and ``<name>_state.json`` with user_data and
+    conversations) and truncates it. Startup loads the snapshot
+    and replays the journal; replaying only records up to a timestamp gives
+    point-in-time recovery since the last compaction.
+
+    The snapshot holds one user per line and iter_tasks() parses it a line
+    at a time, so loading never holds the whole document. Each line is
+    kept as the user's pre-encoded chunk; the backend decodes a user's
+    tasks only when a change to them is applied, and drops them again once
+    they are re-encoded.
+
+    Journal records are idempotent upserts and deletes keyed by task id and
+    outbox key, so replaying a record that the snapshot already contains
+    is harmless. Only chunks of users that changed since the last
+    compaction are re-encoded. All
+    file writes happen in a worker thread through flush_async() and go
+    through a temporary file, fsync and os.replace.
+    """
+
+    def __init__(self, path, compact_bytes=4 * 1024 * 1024):
+        self.path = path
+        self.outbox_path = os.path.splitext(path)[0] + '_outbox.json'
+        self.state_path = os.path.splitext(path)[0] + '_state.json'
+        self.journal_path = os.path.splitext(path)[0] + '.journal'
+        self.compact_bytes = compact_bytes
+        self._tasks = {}
+        self._outbox = {}
+        # user_data and conversations, keyed like outbox entries
+        self._state = {}
+        # Journal records of tasks, read by _load_state() for iter_tasks()
+        self._task_records = []
+        self._state_loaded = False
+        self._loaded = False
+        self._next_id = 1
+        self._chunks = {}
+        self._outbox_chunks = {}
+        self._state_chunks = {}
+        self._dirty_users = set()
+        self._dirty_outbox = set()
+        self._dirty_state = set()
+        self._journal = []
+        self._journal_size = 0
+        self._compact_requested = False
+        self._flush_lock = None
+
+    def load_all(self, until=None):
+        """Load the snapshot and replay journal records up to `until` (timestamp)"""
+        return dict(self.iter_tasks(until))
+
+    def iter_tasks(self, until=None):
+        """Stream the snapshot with journal records up to `until` applied.
+
+        Users the journal changes (and tasks from older files without ids)
+        are yielded last, once the whole journal is applied.
+        """
+        if until is not None or not self._state_loaded:
+            self._load_state(until)
+        records = self._task_records
+        self._task_records = []
+        deferred = {record['user'] for record in records}
+        self._tasks = {}
+        self._chunks = {}
+        self._dirty_users = set()
+
+        max_id = 0
+        for user_id, chunk, user_tasks in self._read_snapshot():
+            self._chunks[user_id] = chunk
+            max_id = max(max_id, max((task.get('id', 0) for task in user_tasks), default=0))
+            if user_id in deferred or any('id' not in task for task in user_tasks):
+                deferred.add(user_id)
+                self._tasks[user_id] = user_tasks
+            else:
+                yield user_id, user_tasks
+
+        for record in records:
+            self._apply(record)
+        if records:
+            logger.info(f"Применено записей журнала: {len(records)}")
+
+        # Give ids to tasks from older files, then persist them in a snapshot
+        self._next_id = 1 + max(
+            max_id,
+            max((task.get('id', 0) for user_tasks in self._tasks.values() for task in user_tasks), default=0)
+        )
+        for user_tasks in self._tasks.values():
+            for task in user_tasks:
+                if 'id' not in task:
+                    task['id'] = self._next_id
+                    self._next_id += 1
+                    self._compact_requested = True
+
+        self._dirty_users |= deferred
+        self._loaded = True
+        for user_id in deferred:
+            user_tasks = self._tasks.get(user_id)
+            if user_tasks:
+                yield user_id, user_tasks
+
+    def _load_state(self, until=None):
+        """Load the outbox and conversation state, which do not need the tasks"""
+        self._outbox = {entry['key']: entry for entry in self._read_json(self.outbox_path, [])}
+        self._state = {entry['key']: entry for entry in self._read_json(self.state_path, [])}
+        self._task_records = []
+        for record in self._read_journal(until):
+            if 'user' in record:
+                self._task_records.append(record)
+            else:
+                self._apply(record)
+        self._outbox_chunks = {}
+        self._state_chunks = {}
+        self._dirty_outbox = set(self._outbox)
+        self._dirty_state = set(self._state)
+        self._state_loaded = True
+
+    @staticmethod
+    def _read_json(path, default):
+        if not os.path.exists(path):
+            return default
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def _read_snapshot(self):
+        """Yield (user_id, chunk, tasks) for every user in the snapshot"""
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'r', encoding='utf-8') as f:
+            if f.readline().rstrip() == '{':
+                read = 0
+                for line in f:
+                    chunk = line.rstrip()
+                    if not chunk or chunk == '}':
+                        continue
+                    chunk = chunk.removesuffix(',')
+                    try:
+                        (user_id, user_tasks), = json.loads('{' + chunk + '}').items()
+                    except ValueError:
+                        if read:
+                            raise
+                        # Not one user per line (e.g. written by json.dump
+                        # with indent): read the file whole
+                        break
+                    read += 1
+                    yield user_id, chunk, user_tasks
+                else:
+                    return
+            f.seek(0)
+            for user_id, user_tasks in json.load(f).items():
+                yield user_id, self._encode_user(user_id, user_tasks), user_tasks
+
+    def _read_journal(self, until):
+        self._journal_size = 0
+        records = []
+        if not os.path.exists(self.journal_path):
+            return records
+        with open(self.journal_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                self._journal_size += len(line.encode('utf-8'))
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # A torn last line from a crash during append; compact
+                    # so that new records are not appended after it
+                    logger.warning(f"Пропущена повреждённая запись журнала {self.journal_path}")
+                    self._compact_requested = True
+                    continue
+                if until is not None and record['ts'] > until:
+                    break
+                records.append(record)
+        return records
+
+    @staticmethod
+    def _encode_user(user_id, user_tasks):
+        return json.dumps(user_id) + ': ' + json.dumps(user_tasks, ensure_ascii=False)
+
+    def _user_tasks(self, user_id):
+        """The user's task dicts, decoded from their chunk if needed"""
+        user_tasks = self._tasks.get(user_id)
+        if user_tasks is None:
+            chunk = self._chunks.get(user_id)
+            user_tasks = json.loads('{' + chunk + '}')[user_id] if chunk is not None else []
+            self._tasks[user_id] = user_tasks
+        return user_tasks
+
+    def _apply(self, record):
+        op = record['op']
+        if op in ('add', 'update'):
+            task = record['task']
+            user_tasks = self._user_tasks(record['user'])
+            for i, existing in enumerate(user_tasks):
+                if existing.get('id') == task['id']:
+                    user_tasks[i] = task
+                    break
+            else:
+                user_tasks.append(task)
+        elif op == 'add_many':
+            # Upserts like 'add': the snapshot may already hold the batch
+            user_tasks = self._user_tasks(record['user'])
+            positions = {existing.get('id'): i for i, existing in enumerate(user_tasks)}
+            for task in record['tasks']:
+                i = positions.get(task['id'])
+                if i is None:
+                    positions[task['id']] = len(user_tasks)
+                    user_tasks.append(task)
+                else:
+                    user_tasks[i] = task
+        elif op == 'delete':
+            # An emptied list stays until _encode() drops the user's chunk
+            user_tasks = self._user_tasks(record['user'])
+            user_tasks[:] = [t for t in user_tasks if t.get('id') != record['id']]
+        elif op == 'outbox_put':
+            self._outbox[record['entry']['key']] = record['entry']
+        elif op == 'outbox_delete':
+            self._outbox.pop(record['key'], None)
+        elif op == 'state_put':
+            self._state[record['entry']['key']] = record['entry']
+        elif op == 'state_delete':
+            self._state.pop(record['key'], None)
+
+    def _append(self, record):
+        self._apply(record)
+        record['ts'] = time.time()
+        self._journal.append(json.dumps(record, ensure_ascii=False) + '\n')
+
+    def save_all(self, tasks):
+        self._tasks = tasks
+        self._chunks = {}
+        self._next_id = 1 + max(
+            (task.get('id', 0) for user_tasks in tasks.values() for task in user_tasks),
+            default=0
+        )
+        for user_tasks in tasks.values():
+            for task in user_tasks:
+                if 'id' not in task:
+                    task['id'] = self._next_id
+                    self._next_id += 1
+        self._dirty_users = set(tasks)
+        if not self._state_loaded:
+            self._load_state()
+        self._loaded = True
+        self._compact_requested = True
+        self.flush()
+
+    def insert_task(self, user_id, task):
+        if 'id' not in task:
+            task['id'] = self._next_id
+        self._next_id = max(self._next_id, task['id'] + 1)
+        self._dirty_users.add(user_id)
+        self._append({'op': 'add', 'user': user_id, 'task': task})
+
+    def insert_tasks(self, user_id, tasks):
+        # One journal line, so a crash cannot leave half of the batch
+        for task in tasks:
+            if 'id' not in task:
+                task['id'] = self._next_id
+            self._next_id = max(self._next_id, task['id'] + 1)
+        self._dirty_users.add(user_id)
+        self._append({'op': 'add_many', 'user': user_id, 'tasks': tasks})
+
+    def update_task(self, user_id, task):
+        self._dirty_users.add(user_id)
+        self._append({'op': 'update', 'user': user_id, 'task': task})
+
+    def delete_task(self, user_id, task):
+        self._dirty_users.add(user_id)
+        self._append({'op': 'delete', 'user': user_id, 'id': task['id']})
+
+    def load_outbox(self):
+        if not self._state_loaded:
+            self._load_state()
+        return list(self._outbox.values())
+
+    def save_outbox_entry(self, entry):
+        self._dirty_outbox.add(entry['key'])
+        self._append({'op': 'outbox_put', 'entry': entry})
+
+    def delete_outbox_entry(self, key):
+        if key in self._outbox:
+            self._dirty_outbox.add(key)
+            self._append({'op': 'outbox_delete', 'key': key})
+
+    def _put_state(self, entry):
+        if not self._state_loaded:
+            self._load_state()
+        self._dirty_state.add(entry['key'])
+        self._append({'op': 'state_put', 'entry': entry})
+
+    def _delete_state(self, key):
+        if not self._state_loaded:
+            self._load_state()
+        if key in self._state:
+            self._dirty_state.add(key)
+            self._append({'op': 'state_delete', 'key': key})
+
+    def iter_user_data(self):
+        if not self._state_loaded:
+            self._load_state()
+        for key, entry in list(self._state.items()):
+            if key.startswith('user:'):
+                yield key[5:], entry['data']
+
+    def load_user_data(self, user_id):
+        if not self._state_loaded:
+            self._load_state()
+        entry = self._state.get(f"user:{user_id}")
+        return entry['data'] if entry is not None else None
+
+    def save_user_data(self, user_id, data):
+        self._put_state({'key': f"user:{user_id}", 'data': data})
+
+    def delete_user_data(self, user_id):
+        self._delete_state(f"user:{user_id}")
+
+    def load_conversations(self, name):
+        if not self._state_loaded:
+            self._load_state()
+        return {
+            entry['conversation']: (entry['state'], entry['updated'])
+            for entry in self._state.values()
+            if entry.get('name') == name
+        }
+
+    def save_conversation(self, name, key, state):
+        self._put_state({
+            'key': f"conversation:{name}:{key}", 'name': name, 'conversation': key,
+            'state': state, 'updated': time.time(),
+        })
+
+    def delete_conversation(self, name, key):
+        self._delete_state(f"conversation:{name}:{key}")
+
+    def _encode(self):
+        for user_id in self._dirty_users:
+            # The chunk is all that is kept of a user's tasks until they change again
+            user_tasks = self._tasks.pop(user_id, None)
+            if user_tasks:
+                self._chunks[user_id] = self._encode_user(user_id, user_tasks)
+            else:
+                self._chunks.pop(user_id, None)
+        self._dirty_users = set()
+
+        for key in self._dirty_outbox:
+            entry = self._outbox.get(key)
+            if entry is not None:
+                self._outbox_chunks[key] = json.dumps(entry, ensure_ascii=False)
+            else:
+                self._outbox_chunks.pop(key, None)
+        self._dirty_outbox = set()
+
+        for key in self._dirty_state:
+            entry = self._state.get(key)
+            if entry is not None:
+                self._state_chunks[key] = json.dumps(entry, ensure_ascii=False)
+            else:
+                self._state_chunks.pop(key, None)
+        self._dirty_state = set()
+
+    def _prepare(self):
+        """Take buffered journal lines and, if due, a snapshot to write"""
+        lines = self._journal
+        self._journal = []
+        self._journal_size += sum(len(line.encode('utf-8')) for line in lines)
+        snapshot = None
+        # A snapshot taken while iter_tasks() is still reading would miss users
+        if self._loaded and (self._compact_requested or self._journal_size > self.compact_bytes):
+            self._encode()
+            snapshot = (
+                list(self._chunks.values()),
+                list(self._outbox_chunks.values()),
+                list(self._state_chunks.values())
+            )
+            self._compact_requested = False
+        return lines, snapshot
+
+    def _restore(self, lines, snapshot):
+        # A failed write is retried on the next flush
+        self._journal = lines + self._journal
+        self._journal_size -= sum(len(line.encode('utf-8')) for line in lines)
+        if snapshot is not None:
+            self._compact_requested = True
+
+    def _write(self, lines, snapshot):
+        if lines:
+            with open(self.journal_path, 'a', encoding='utf-8') as f:
+                f.writelines(lines)
+                f.flush()
+                os.fsync(f.fileno())
+        if snapshot is not None:
+            chunks, outbox_chunks, state_chunks = snapshot
+            atomic_write(self.outbox_path, '[\n' + ',\n'.join(outbox_chunks) + '\n]\n')
+            atomic_write(self.state_path, '[\n' + ',\n'.join(state_chunks) + '\n]\n')
+            atomic_write(self.path, '{\n' + ',\n'.join(chunks) + '\n}\n')
+            # Records appended after the snapshot was taken are still in the
+            # in-memory buffer, so the journal can be emptied
+            with open(self.journal_path, 'w', encoding='utf-8') as f:
+                f.flush()
+                os.fsync(f.fileno())
+
+    def _written(self, snapshot):
+        if snapshot is not None:
+            self._journal_size = 0
+            logger.info("Журнал задач свёрнут в снимок")
+
+    def flush(self):
+        lines, snapshot = self._prepare()
+        if not lines and snapshot is None:
+            return
+        try:
+            self._write(lines, snapshot)
+        except Exception:
+            self._restore(lines, snapshot)
+            raise
+        self._written(snapshot)
+
+    async def flush_async(self):
+        # Callers that arrive while a write is running wait for it and then
+        # write whatever changed meanwhile, so concurrent saves coalesce
+        if self._flush_lock is None:
+            self._flush_lock = asyncio.Lock()
+        async with self._flush_lock:
+            lines, snapshot = self._prepare()
+            if not lines and snapshot is None:
+                return
+            try:
+                await asyncio.get_running_loop().run_in_executor(None, self._write, lines, snapshot)
+            except Exception:
+                self._restore(lines, snapshot)
+                raise
+            self._written(snapshot)
+
+    def compact(self):
+        """Fold the journal into the snapshot now"""
+        self._compact_requested = True
+        self.flush()
+
+    def close(self):
+        self.compact()
+
+    def generation(self):
+        # A compaction replaces the snapshot and then empties the journal; a
+        # reader that got the journal before and the snapshot after would
+        # replay old records over newer tasks
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return stat.st_ino, stat.st_mtime_ns
+
+    def files(self):
+        return [self.path, self.outbox_path, self.state_path, self.journal_path]
+
+
+class SQLiteBackend(StorageBackend):
+    """SQLite database with one row per task.
+
+    Each row keeps the indexed columns (user_id, datetime) next to the full
+    task as JSON. Row operations run immediately inside an open transaction
+    which flush() commits, so a burst of changes costs one commit, and task
+    and outbox changes made together are committed atomically.
+    user_data and conversation states have tables of their own. With
+    autocommit=True every change is committed at once instead, so that
+    several processes can share the file without holding its write lock.
+    A readonly backend only reads a database that another process (the
+    running bot) writes; WAL gives every statement a consistent snapshot.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS tasks (
+            id INTEGER PRIMARY KEY,
+            user_id TEXT NOT NULL,
+            datetime TEXT NOT NULL,
+            data TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_tasks_user_datetime ON tasks (user_id, datetime);
+        CREATE INDEX IF NOT EXISTS idx_tasks_datetime ON tasks (datetime);
+        CREATE TABLE IF NOT EXISTS outbox (
+            key TEXT PRIMARY KEY,
+            data TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS user_data (
+            user_id TEXT PRIMARY KEY,
+            data TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS conversations (
+            name TEXT NOT NULL,
+            key TEXT NOT NULL,
+            state TEXT NOT NULL,
+            updated REAL NOT NULL,
+            PRIMARY KEY (name, key)
+        );
+    """
+
+    def __init__(self, path, autocommit=False, readonly=False):
+        self.path = path
+        if readonly:
+            self.conn = sqlite3.connect(Path(path).absolute().as_uri() + '?mode=ro', uri=True)
+            return
+        self.conn = sqlite3.connect(path, isolation_level=None if autocommit else '')
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.executescript(self.SCHEMA)
+        self.conn.commit()
+
+    @staticmethod
+    def _dump(task):
+        data = {k: v for k, v in task.items() if k != 'id'}
+        return json.dumps(data, ensure_ascii=False)
+
+    @staticmethod
+    def _row_to_task(row):
+        task = json.loads(row[2])
+        task['id'] = row[0]
+        return task
+
+    def load_all(self):
+        return dict(self.iter_tasks())
+
+    def iter_tasks(self):
+        rows = self.conn.execute('SELECT id, user_id, data FROM tasks ORDER BY user_id, datetime')
+        for user_id, user_rows in itertools.groupby(rows, key=lambda row: row[1]):
+            yield user_id, [self._row_to_task(row) for row in user_rows]
+
+    def save_all(self, tasks):
+        self.conn.execute('DELETE FROM tasks')
+        for user_id, user_tasks in tasks.items():
+            for task in user_tasks:
+                self.insert_task(user_id, task)
+        self.flush()
+
+    def insert_task(self, user_id, task):
+        cursor = self.conn.execute(
+            'INSERT INTO tasks (id, user_id, datetime, data) VALUES (?, ?, ?, ?)',
+            (task.get('id'), user_id, task['datetime'], self._dump(task))
+        )
+        task['id'] = cursor.lastrowid
+
+    def insert_tasks(self, user_id, tasks):
+        # In autocommit mode the batch needs a transaction of its own; ids
+        # are taken under its write lock
+        autocommit = self.conn.isolation_level is None
+        if autocommit:
+            self.conn.execute('BEGIN IMMEDIATE')
+        try:
+            next_id = self.conn.execute('SELECT COALESCE(MAX(id), 0) + 1 FROM tasks').fetchone()[0]
+            for task in tasks:
+                if task.get('id') is None:
+                    task['id'] = next_id
+                    next_id += 1
+            self.conn.executemany(
+                'INSERT INTO tasks (id, user_id, datetime, data) VALUES (?, ?, ?, ?)',
+                [(task['id'], user_id, task['datetime'], self._dump(task)) for task in tasks]
+            )
+        except Exception:
+            if autocommit:
+                self.conn.execute('ROLLBACK')
+            raise
+        if autocommit:
+            self.conn.execute('COMMIT')
+
+    def update_task(self, user_id, task):
+        self.conn.execute(
+            'UPDATE tasks SET datetime = ?, data = ? WHERE id = ?',
+            (task['datetime'], self._dump(task), task['id'])
+        )
+
+    def delete_task(self, user_id, task):
+        self.conn.execute('DELETE FROM tasks WHERE id = ?', (task['id'],))
+
+    def load_outbox(self):
+        return [json.loads(row[0]) for row in self.conn.execute('SELECT data FROM outbox')]
+
+    def save_outbox_entry(self, entry):
+        self.conn.execute(
+            'INSERT OR REPLACE INTO outbox (key, data) VALUES (?, ?)',
+            (entry['key'], json.dumps(entry, ensure_ascii=False))
+        )
+
+    def delete_outbox_entry(self, key):
+        self.conn.execute('DELETE FROM outbox WHERE key = ?', (key,))
+
+    def iter_user_data(self):
+        for user_id, data in self.conn.execute('SELECT user_id, data FROM user_data'):
+            yield user_id, json.loads(data)
+
+    def load_user_data(self, user_id):
+        row = self.conn.execute('SELECT data FROM user_data WHERE user_id = ?', (user_id,)).fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    def save_user_data(self, user_id, data):
+        self.conn.execute(
+            'INSERT OR REPLACE INTO user_data (user_id, data) VALUES (?, ?)',
+            (user_id, json.dumps(data, ensure_ascii=False))
+        )
+
+    def delete_user_data(self, user_id):
+        self.conn.execute('DELETE FROM user_data WHERE user_id = ?', (user_id,))
+
+    def load_conversations(self, name):
+        rows = self.conn.execute('SELECT key, state, updated FROM conversations WHERE name = ?', (name,))
+        return {key: (json.loads(state), updated) for key, state, updated in rows}
+
+    def save_conversation(self, name, key, state):
+        self.conn.execute(
+            'INSERT OR REPLACE INTO conversations (name, key, state, updated) VALUES (?, ?, ?, ?)',
+            (name, key, json.dumps(state), time.time())
+        )
+
+    def delete_conversation(self, name, key):
+        self.conn.execute('DELETE FROM conversations WHERE name = ? AND key = ?', (name, key))
+
+    def flush(self):
+        self.conn.commit()
+
+    def close(self):
+        self.flush()
+        self.conn.close()
+
+    def files(self):
+        return [self.path, f"{self.path}-wal"]
+
+
+class StoreLockedError(RuntimeError):
+    """Another process (a running bot) holds the store"""
+
+
+def lock_store(path):
+    """Take the store's writer lock (``<path>.lock``) or raise StoreLockedError.
+
+    The bot holds it while it runs and the offline tools that write a store
+    take it too. The lock lasts as long as the returned file stays open and
+    goes away with the process.
+    """
+    f = open(path + '.lock', 'a')
+    try:
+        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        f.close()
+        raise StoreLockedError(f"{path} is in use by another process") from None
+    return f
+
+
+def create_backend(kind, path):
+    """Create a storage backend by name ('json' or 'sqlite')"""
+    if kind == 'json':
+        return JsonBackend(path)
+    if kind == 'sqlite':
+        return SQLiteBackend(path)
+    raise ValueError(f"Unknown storage backend: {kind}")
+
+
+def migrate_json_to_sqlite(json_path, db_path):
+    """Import tasks from a JSON file into an SQLite database, return task count"""
+    tasks = JsonBackend(json_path).load_all()
+    backend = SQLiteBackend(db_path)
+    try:
+        backend.save_all(tasks)
+    finally:
+        backend.close()
+    return sum(len(user_tasks) for user_tasks in tasks.values())
+
+
+def dump_store(open_backend, output, attempts=5):
+    """Write every task and user_data of a store to `output` as JSON Lines.
+
+    Each line is {"user": ..., "task": {...}} or {"user": ..., "user_data":
+    {...}}. The store is only read, a user at a time, so this works on the
+    store of a running bot: `open_backend` is called for a fresh read-only
+    view, and the dump is taken again if the store's generation changed
+    while it was read. The lines go to a temporary file that replaces
+    `output` once complete. Returns (tasks, users).
+    """
+    temporary = output + '.tmp'
+    try:
+        for _ in range(attempts):
+            backend = open_backend()
+            generation = backend.generation()
+            tasks = users = 0
+            with open(temporary, 'w', encoding='utf-8') as f:
+                for user_id, user_tasks in backend.iter_tasks():
+                    f.writelines(
+                        json.dumps({'user': user_id, 'task': task}, ensure_ascii=False) + '\n'
+                        for task in user_tasks
+                    )
+                    tasks += len(user_tasks)
+                for user_id, data in backend.iter_user_data():
+                    f.write(json.dumps({'user': user_id, 'user_data': data}, ensure_ascii=False) + '\n')
+                    users += 1
+                f.flush()
+                os.fsync(f.fileno())
+            if backend.generation() == generation:
+                os.replace(temporary, output)
+                return tasks, users
+            logger.info("Хранилище было свёрнуто во время выгрузки, выгрузка повторяется")
+    finally:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+    raise RuntimeError(f"The store kept changing, no consistent dump in {attempts} attempts")
+
+
+def load_store(backend, path, batch_size=1000):
+    """Add the tasks and user_data of a dump_store() file to an empty store.
+
+    The store must not be in use: a running bot keeps its tasks in memory
+    and would never see them (main() checks the lock).
+
+    The file is read a line at a time and the tasks are written
+    `batch_size` at a time, each batch with one insert_tasks() and one
+    flush(), so neither the file nor the store's changes are held whole.
+    Task ids are kept. Returns (tasks, users).
+    """
+    if sum(len(user_tasks) for _, user_tasks in backend.iter_tasks()):
+        raise ValueError("The store already has tasks; load a dump into an empty store")
+    tasks = users = 0
+
+    def write(user_id, batch):
+        backend.insert_tasks(user_id, batch)
+        backend.flush()
+        return len(batch)
+
+    with open(path, 'r', encoding='utf-8') as f:
+        records = (json.loads(line) for line in f if line.strip())
+        for user_id, user_records in itertools.groupby(records, key=lambda record: record['user']):
+            batch = []
+            for record in user_records:
+                if 'user_data' in record:
+                    backend.save_user_data(user_id, record['user_data'])
+                    users += 1
+                    continue
+                batch.append(record['task'])
+                if len(batch) == batch_size:
+                    tasks += write(user_id, batch)
+                    batch = []
+            if batch:
+                tasks += write(user_id, batch)
+    backend.flush()
+    return tasks, users
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Task storage utilities")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    migrate = subparsers.add_parser('migrate', help="Import tasks.json into an SQLite database")
+    migrate.add_argument('json_path', nargs='?', default='tasks.json')
+    migrate.add_argument('db_path', nargs='?', default='tasks.db')
+    restore = subparsers.add_parser(
+        'restore', help="Write the JSON store as it was at a point in time since the last compaction"
+    )
+    restore.add_argument('until', help="ISO datetime, e.g. 2025-11-25T14:30:00")
+    restore.add_argument('--json-path', default='tasks.json')
+    restore.add_argument('--output', default='tasks_restored.json')
+    dump = subparsers.add_parser(
+        'dump', help="Write all tasks and user_data as JSON Lines; safe while the bot is running"
+    )
+    dump.add_argument('--backend', choices=('json', 'sqlite'), default='json')
+    dump.add_argument('--path', help="Store to read (default: tasks.json or tasks.db)")
+    dump.add_argument('--output', default='tasks_dump.jsonl')
+    load = subparsers.add_parser(
+        'load', help="Add the tasks and user_data of a dump to a new, empty store; not while the bot runs on it"
+    )
+    load.add_argument('input')
+    load.add_argument('--backend', choices=('json', 'sqlite'), default='json')
+    load.add_argument('--path', help="Store to write (default: tasks.json or tasks.db)")
+    load.add_argument('--batch', type=int, default=1000, help="Tasks per write")
+    args = parser.parse_args()
+
+    if args.command in ('dump', 'load') and args.path is None:
+        args.path = 'tasks.db' if args.backend == 'sqlite' else 'tasks.json'
+
+    if args.command == 'migrate':
+        count = migrate_json_to_sqlite(args.json_path, args.db_path)
+        print(f"Imported {count} tasks from {args.json_path} into {args.db_path}")
+    elif args.command == 'restore':
+        until = datetime.fromisoformat(args.until).timestamp()
+        tasks = JsonBackend(args.json_path).load_all(until=until)
+        atomic_write(args.output, json.dumps(tasks, ensure_ascii=False, indent=2))
+        count = sum(len(user_tasks) for user_tasks in tasks.values())
+        print(f"Wrote {count} tasks as of {args.until} to {args.output}")
+    elif args.command == 'dump':
+        if args.backend == 'sqlite':
+            open_backend = lambda: SQLiteBackend(args.path, readonly=True)
+        else:
+            # Only read: a JsonBackend writes nothing until it is flushed or closed
+            open_backend = lambda: JsonBackend(args.path)
+        tasks, users = dump_store(open_backend, args.output)
+        print(f"Wrote {tasks} tasks and user_data of {users} users from {args.path} to {args.output}")
+    elif args.command == 'load':
+        try:
+            lock = lock_store(args.path)
+        except StoreLockedError as e:
+            parser.exit(1, f"{e}: stop the bot first or load into another store\n")
+        with lock:
+            backend = create_backend(args.backend, args.path)
+            try:
+                tasks, users = load_store(backend, args.input, args.batch)
+            finally:
+                backend.close()
+        print(f"Loaded {tasks} tasks and user_data of {users} users from {args.input} into {args.path}")
+
+
+if __name__ == '__main__':
+    main()
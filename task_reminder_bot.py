@@ -1,10 +1,53 @@
+import asyncio
+import bisect
+import contextlib
+import gc
 import logging
+import math
+from collections import OrderedDict
 from datetime import datetime, timedelta
 import json
 import os
-from telegram import Update, ReplyKeyboardMarkup, ReplyKeyboardRemove, KeyboardButton
+import secrets
+import sys
+import tempfile
+import time
+from urllib.parse import urlsplit
+import ical
+from bot_api import TimedHTTPXRequest, format_stats
+from dispatch import Dispatcher, Outbox
+from metrics import (
+    Gauge,
+    MetricsServer,
+    Registry,
+    Summary,
+    api_metrics,
+    delivery_metrics,
+    delivery_stats,
+    timed,
+)
+from models import Repeat, Task, fold_series
+from persistence import StorePersistence
+from quickadd import parse_bulk, parse_events, parse_line
+from reminders import reminder_key, reminder_text
+from scheduler import ReminderEngine
+from shards import ShardCoordinator
+from storage import StoreLockedError, create_backend, lock_store
+from timezones import describe_zone, get_zone, now_local, parse_zone, to_timestamp
+from webhook import WebhookServer, run_webhook
+from telegram import (
+    Update,
+    ReplyKeyboardMarkup,
+    ReplyKeyboardRemove,
+    KeyboardButton,
+    InlineKeyboardButton,
+    InlineKeyboardMarkup,
+)
+from telegram.error import BadRequest
 from telegram.ext import (
     Application,
+    BaseUpdateProcessor,
+    CallbackQueryHandler,
     CommandHandler,
     MessageHandler,
     ConversationHandler,
@@ -22,26 +65,480 @@ logger = logging.getLogger(__name__)
 # Configuration
 TELEGRAM_BOT_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN', '7858168078:AAHMVmRHAzD8BiNCrHBHb7qFo457Mh8AH94')
 
+# Bot API server, e.g. a local fake server for load testing
+TELEGRAM_API_BASE_URL = os.getenv('TELEGRAM_API_BASE_URL', 'https://api.telegram.org/bot')
+
 # Conversation states
 TASK_NAME, TASK_DATE, TASK_TIME, TASK_REPEAT = range(4)
 DELETE_NUMBER, EDIT_TASK, EDIT_FIELD, EDIT_VALUE = range(4, 8)
+STATE_NAMES = {
+    TASK_NAME: 'task_name', TASK_DATE: 'task_date', TASK_TIME: 'task_time',
+    TASK_REPEAT: 'task_repeat', DELETE_NUMBER: 'delete_number', EDIT_TASK: 'edit_task',
+    EDIT_FIELD: 'edit_field', EDIT_VALUE: 'edit_value',
+}
 
-# File to store tasks
+# Task storage: 'json' (TASKS_FILE) or 'sqlite' (TASKS_DB)
+STORAGE_BACKEND = os.getenv('STORAGE_BACKEND', 'json')
 TASKS_FILE = 'tasks.json'
+TASKS_DB = os.getenv('TASKS_DB', 'tasks.db')
+
+# How many upcoming reminders are armed in the JobQueue at once
+REMINDER_WINDOW = int(os.getenv('REMINDER_WINDOW', '100'))
+
+# Reminders missed by less than this (seconds) are still delivered on startup;
+# older ones are not sent: one-off tasks are marked reminded, series move on
+REMINDER_CATCHUP = int(os.getenv('REMINDER_CATCHUP', str(24 * 3600)))
+
+# Reminder dispatch: worker count, global and per-chat limits (messages/second)
+DISPATCH_WORKERS = int(os.getenv('DISPATCH_WORKERS', '8'))
+DISPATCH_GLOBAL_RATE = float(os.getenv('DISPATCH_GLOBAL_RATE', '30'))
+DISPATCH_CHAT_RATE = float(os.getenv('DISPATCH_CHAT_RATE', '1'))
+
+# How often reminder latency percentiles are logged (seconds)
+REMINDER_STATS_INTERVAL = int(os.getenv('REMINDER_STATS_INTERVAL', '600'))
+
+# How many updates are handled concurrently (updates of one user never overlap)
+CONCURRENT_UPDATES = int(os.getenv('CONCURRENT_UPDATES', '64'))
+
+# How often dirty in-memory tasks are flushed to disk (seconds)
+TASKS_FLUSH_INTERVAL = int(os.getenv('TASKS_FLUSH_INTERVAL', '5'))
+
+# Bot API HTTP client: connections for everything except getUpdates (which has
+# its own), HTTP version ('1.1' or '2', needs python-telegram-bot[http2]),
+# how long idle connections are kept, request and pool timeouts (seconds)
+BOT_POOL_SIZE = int(os.getenv('BOT_POOL_SIZE', '64'))
+BOT_HTTP_VERSION = os.getenv('BOT_HTTP_VERSION', '1.1')
+BOT_KEEPALIVE = float(os.getenv('BOT_KEEPALIVE', '60'))
+BOT_TIMEOUT = float(os.getenv('BOT_TIMEOUT', '10'))
+BOT_POOL_TIMEOUT = float(os.getenv('BOT_POOL_TIMEOUT', '5'))
+
+# Reminder worker processes (0 = schedule and send reminders in this process)
+# and the SQLite file their outboxes share
+SHARD_WORKERS = int(os.getenv('SHARD_WORKERS', '0'))
+SHARD_OUTBOX_DB = os.getenv('SHARD_OUTBOX_DB', 'outbox.db')
+
+# Webhook mode: public HTTPS URL Telegram posts updates to (empty = long polling),
+# local address and port, secret token (random on every start if empty),
+# Telegram's max parallel connections, keep-alive timeout (seconds) and
+# how many accepted updates may wait or be handled at once
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', '')
+WEBHOOK_LISTEN = os.getenv('WEBHOOK_LISTEN', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', os.getenv('PORT', '8443')))
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET', '')
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv('WEBHOOK_MAX_CONNECTIONS', '40'))
+WEBHOOK_KEEPALIVE = int(os.getenv('WEBHOOK_KEEPALIVE', '75'))
+WEBHOOK_MAX_PENDING = int(os.getenv('WEBHOOK_MAX_PENDING', '1000'))
+
+ALLOWED_UPDATES = ["message", "callback_query"]
+
+# Prometheus metrics at http://METRICS_LISTEN:METRICS_PORT/metrics (0 = off),
+# how often shard workers report their stats (seconds), and whether every
+# handler is timed by conversation state (METRICS_HANDLER_TIMINGS=1)
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0'))
+METRICS_LISTEN = os.getenv('METRICS_LISTEN', '127.0.0.1')
+METRICS_INTERVAL = int(os.getenv('METRICS_INTERVAL', '15'))
+METRICS_HANDLER_TIMINGS = os.getenv('METRICS_HANDLER_TIMINGS', '0') == '1'
+
+# Conversation state and user_data are kept in the task storage. user_data of
+# users idle for USER_DATA_IDLE seconds is unloaded from memory (sooner once
+# more than USER_DATA_CACHE_SIZE users are loaded); dialogs left unfinished
+# for CONVERSATION_TTL seconds are dropped on startup
+USER_DATA_CACHE_SIZE = int(os.getenv('USER_DATA_CACHE_SIZE', '10000'))
+USER_DATA_IDLE = int(os.getenv('USER_DATA_IDLE', '1800'))
+CONVERSATION_TTL = int(os.getenv('CONVERSATION_TTL', str(7 * 24 * 3600)))
+
+# Time zone of users who have not chosen one with /timezone: an IANA name
+# (Europe/Moscow) or a UTC offset (+3); empty means the server's zone
+DEFAULT_TIMEZONE = parse_zone(os.getenv('DEFAULT_TIMEZONE')) if os.getenv('DEFAULT_TIMEZONE') else None
+
+# Quick-add and bulk input: most tasks one message or file may add, and the
+# largest file (bytes) read
+IMPORT_MAX_TASKS = int(os.getenv('IMPORT_MAX_TASKS', '1000'))
+IMPORT_MAX_BYTES = int(os.getenv('IMPORT_MAX_BYTES', str(1024 * 1024)))
+
+# Backups (/export, /import): the largest document sent at once (bigger
+# exports are split into several files), the largest .ics/.jsonl file
+# accepted (bytes) and how many of its tasks are added per batch
+EXPORT_CHUNK_BYTES = int(os.getenv('EXPORT_CHUNK_BYTES', str(5 * 1024 * 1024)))
+BACKUP_MAX_BYTES = int(os.getenv('BACKUP_MAX_BYTES', str(20 * 1024 * 1024)))
+BACKUP_BATCH_SIZE = int(os.getenv('BACKUP_BATCH_SIZE', '500'))
+
+# Task list and pickers: tasks per page, cached pages, list page lifetime (seconds)
+LIST_PAGE_SIZE = int(os.getenv('LIST_PAGE_SIZE', '10'))
+PAGE_CACHE_SIZE = int(os.getenv('PAGE_CACHE_SIZE', '10000'))
+LIST_CACHE_TTL = int(os.getenv('LIST_CACHE_TTL', '60'))
+
+
+storage_backend = create_backend(
+    STORAGE_BACKEND,
+    TASKS_DB if STORAGE_BACKEND == 'sqlite' else TASKS_FILE
+)
+
+
+class TaskConflictError(Exception):
+    """The task was changed or removed since it was read"""
+
+
+class TaskStore:
+    """In-memory task storage with write-behind persistence.
+
+    Tasks are loaded once at startup and kept in memory; handlers read and
+    modify only the tasks of the current user. load_async() streams them
+    from the backend in short slices between which the event loop keeps
+    running, so the bot takes updates while it loads; `loaded` is set once
+    it is done (or has failed with `load_error`). Every task has a stable
+    id assigned by the storage backend: tasks are found by id in O(1), and
+    each user's tasks are kept in a list ordered by due time. Tasks are
+    held as Task objects and converted to the stored JSON shape only when
+    they are passed to the backend. Every
+    mutation is passed to the backend as a single-row change, and a
+    background job calls flush() so a burst of updates is made durable in
+    one write.
+    
+    Every user has a version counter that changes with their tasks, so
+    views rendered from them can be cached.
+    
+    Tasks that still need a reminder are handed to the scheduler, which
+    orders them by due time, so nothing ever has to scan all tasks.
+    
+    Work that reads a user's tasks, awaits, and then writes them back runs
+    under lock(user_id). Every task carries a version that update_task()
+    checks, so a copy edited across several messages cannot overwrite a
+    task that changed in the meantime.
+    """
+
+    def __init__(self, backend, scheduler):
+        self.backend = backend
+        self.scheduler = scheduler
+        self._tasks = {}
+        self._order = {}
+        self._owners = {}
+        self._locks = {}
+        self._versions = {}
+        self.loaded = asyncio.Event()
+        self.load_error = None
+
+    def __len__(self):
+        return len(self._owners)
+
+    @contextlib.asynccontextmanager
+    async def lock(self, user_id):
+        """Hold the user's lock; locks nobody waits for are dropped"""
+        entry = self._locks.get(user_id)
+        if entry is None:
+            entry = self._locks[user_id] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._locks[user_id]
+
+    def load(self):
+        """Load tasks from storage into memory"""
+        for _ in self._load():
+            pass
+
+    async def load_async(self, slice_seconds=0.01):
+        """Load tasks like load(), letting other coroutines run every `slice_seconds`"""
+        for _ in self._load(slice_seconds):
+            await asyncio.sleep(0)
+
+    def _load(self, slice_seconds=None):
+        started = time.perf_counter()
+        self.loaded.clear()
+        self.load_error = None
+        # Loaded tasks live until shutdown, so collections during the load
+        # would only re-scan them again and again: the collector is paused
+        # and the tasks are frozen out of its reach afterwards
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            yield from self._read_tasks(slice_seconds)
+        except Exception as e:
+            self.load_error = e
+            self.loaded.set()
+            raise
+        finally:
+            if gc_enabled:
+                gc.enable()
+        gc.freeze()
+        self.loaded.set()
+        elapsed = time.perf_counter() - started
+        storage_seconds.observe(elapsed, 'load')
+        logger.info(f"Загружено задач: {len(self)} за {elapsed:.2f} с")
+
+    def _read_tasks(self, slice_seconds):
+        self._tasks = {}
+        self._order = {}
+        self._owners = {}
+        folded = 0
+        # Reminders are indexed as tasks are read, so there is no long
+        # step at the end
+        self.scheduler.build(())
+        # Backends may be reading the rows being changed, so folded series
+        # are written once everything is read
+        changes = []
+        next_yield = time.perf_counter() + (slice_seconds or math.inf)
+        for user_id, user_tasks in self.backend.iter_tasks():
+            tasks = [Task.from_dict(data) for data in user_tasks]
+            changed, dropped = fold_series(tasks)
+            if changed or dropped:
+                changes.append((user_id, changed, dropped))
+                folded += len(dropped)
+                dropped = {id(task) for task in dropped}
+                tasks = [task for task in tasks if id(task) not in dropped]
+            if tasks:
+                by_id = self._tasks[user_id] = {}
+                for task in tasks:
+                    by_id[task.id] = task
+                    self._owners[task.id] = user_id
+                    if not task.reminded:
+                        self.scheduler.schedule(user_id, task)
+                self._order[user_id] = sorted((task.due, task.id) for task in tasks)
+                self._versions[user_id] = self._versions.get(user_id, 0) + 1
+            if time.perf_counter() > next_yield:
+                yield
+                next_yield = time.perf_counter() + slice_seconds
+        for user_id, changed, dropped in changes:
+            for task in dropped:
+                self.backend.delete_task(user_id, task.to_dict())
+            for task in changed:
+                task.version += 1
+                self.backend.update_task(user_id, task.to_dict())
+        if folded:
+            logger.info(f"Сработавшие повторы свёрнуты в историю задач: {folded}")
+
+    def get_user_tasks(self, user_id):
+        """Return the user's tasks sorted by datetime"""
+        user_tasks = self._tasks.get(user_id)
+        if not user_tasks:
+            return []
+        return [user_tasks[task_id] for _, task_id in self._order[user_id]]
+
+    def get_user_tasks_page(self, user_id, offset, limit):
+        """Return up to `limit` of the user's tasks starting at `offset` in datetime order"""
+        user_tasks = self._tasks.get(user_id)
+        if not user_tasks:
+            return []
+        return [user_tasks[task_id] for _, task_id in self._order[user_id][offset:offset + limit]]
+
+    def get_user_task_ids(self, user_id):
+        """Return the ids of the user's tasks in datetime order"""
+        return [task_id for _, task_id in self._order.get(user_id, ())]
 
+    def count_user_tasks(self, user_id):
+        return len(self._order.get(user_id, ()))
 
-def load_tasks():
-    """Load tasks from JSON file"""
-    if os.path.exists(TASKS_FILE):
-        with open(TASKS_FILE, 'r', encoding='utf-8') as f:
-            return json.load(f)
-    return {}
+    def user_version(self, user_id):
+        """Counter that changes whenever the user's tasks change"""
+        return self._versions.get(user_id, 0)
 
+    def get_task(self, task_id):
+        """Return (user_id, task) for a task id, or (None, None)"""
+        user_id = self._owners.get(task_id)
+        if user_id is None:
+            return None, None
+        return user_id, self._tasks[user_id][task_id]
 
-def save_tasks(tasks):
-    """Save tasks to JSON file"""
-    with open(TASKS_FILE, 'w', encoding='utf-8') as f:
-        json.dump(tasks, f, ensure_ascii=False, indent=2)
+    def add_task(self, user_id, task):
+        """Add a task for the user; the backend assigns task.id"""
+        data = task.to_dict()
+        self.backend.insert_task(user_id, data)
+        task.id = data['id']
+        self._insert(user_id, task)
+        self._index_task(user_id, task)
+
+    def add_tasks(self, user_id, tasks):
+        """Add several tasks for the user in one batch (see StorageBackend.insert_tasks)"""
+        data = [task.to_dict() for task in tasks]
+        self.backend.insert_tasks(user_id, data)
+        for task, task_data in zip(tasks, data):
+            task.id = task_data['id']
+            self._insert(user_id, task)
+            self._index_task(user_id, task)
+
+    def delete_task(self, user_id, task_id):
+        """Delete the user's task by id, return it or None if there is none"""
+        if self._owners.get(task_id) != user_id:
+            return None
+        task = self._remove(user_id, task_id)
+        self.scheduler.unschedule(task)
+        self.backend.delete_task(user_id, task.to_dict())
+        return task
+
+    def update_task(self, user_id, task):
+        """Replace the user's task with an edited copy (matched by task.id).
+        
+        The copy must have the version of the stored task; otherwise
+        TaskConflictError is raised.
+        """
+        task_id = task.id
+        if self._owners.get(task_id) != user_id:
+            raise TaskConflictError(task_id)
+        current = self._tasks[user_id][task_id]
+        if current.version != task.version:
+            raise TaskConflictError(task_id)
+        task.version = current.version + 1
+        self.scheduler.unschedule(current)
+        self._remove(user_id, task_id)
+        self._insert(user_id, task)
+        self._index_task(user_id, task)
+        self.backend.update_task(user_id, task.to_dict())
+
+    def task_fired(self, user_id, task):
+        """Mark the task's current occurrence as reminded (see Task.fire)"""
+        due = task.due
+        # If fire() fails, the task stays in memory and in storage as it was
+        task.fire(time.time())
+        self._remove(user_id, task.id, due)
+        task.version += 1
+        self._insert(user_id, task)
+        self._index_task(user_id, task)
+        self.backend.update_task(user_id, task.to_dict())
+
+    def _insert(self, user_id, task):
+        self._tasks.setdefault(user_id, {})[task.id] = task
+        bisect.insort(self._order.setdefault(user_id, []), (task.due, task.id))
+        self._owners[task.id] = user_id
+        self._versions[user_id] = self._versions.get(user_id, 0) + 1
+
+    def _remove(self, user_id, task_id, due=None):
+        # `due` is the task's due time in the order if it has changed since
+        task = self._tasks[user_id].pop(task_id)
+        order = self._order[user_id]
+        del order[bisect.bisect_left(order, (task.due if due is None else due, task_id))]
+        del self._owners[task_id]
+        self._versions[user_id] = self._versions.get(user_id, 0) + 1
+        if not order:
+            del self._tasks[user_id]
+            del self._order[user_id]
+        return task
+
+    def _index_task(self, user_id, task):
+        if task.reminded:
+            self.scheduler.unschedule(task)
+        else:
+            self.scheduler.schedule(user_id, task)
+
+    async def flush(self):
+        """Make pending changes durable"""
+        with storage_seconds.time('flush'):
+            await self.backend.flush_async()
+
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """Handles updates concurrently, but one at a time for each user.
+    
+    Updates of the same user are serialized on the TaskStore user lock, so
+    conversation states and task edits stay consistent while different
+    users are served in parallel.
+    """
+
+    async def process_update(self, update, coroutine):
+        user = update.effective_user if isinstance(update, Update) else None
+        if user is None:
+            await super().process_update(update, coroutine)
+            return
+        with update_seconds.time():
+            # Updates that arrive during the startup load wait for it
+            await task_store.loaded.wait()
+            if task_store.load_error is not None:
+                # Задачи не загрузились, бот останавливается
+                coroutine.close()
+                return
+            async with task_store.lock(str(user.id)):
+                await super().process_update(update, coroutine)
+
+    async def do_process_update(self, update, coroutine):
+        await coroutine
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+
+if SHARD_WORKERS > 0:
+    # Telegram's global limit is per bot, so the workers share it
+    reminder_engine = ShardCoordinator(SHARD_WORKERS, {
+        'token': TELEGRAM_BOT_TOKEN,
+        'base_url': TELEGRAM_API_BASE_URL,
+        'outbox_db': SHARD_OUTBOX_DB,
+        'window': REMINDER_WINDOW,
+        'catchup': REMINDER_CATCHUP,
+        'dispatch_workers': DISPATCH_WORKERS,
+        'global_rate': DISPATCH_GLOBAL_RATE / SHARD_WORKERS,
+        'chat_rate': DISPATCH_CHAT_RATE,
+        'stats_interval': REMINDER_STATS_INTERVAL,
+        'metrics_interval': METRICS_INTERVAL if METRICS_PORT else 0,
+        'request': {
+            'connection_pool_size': max(BOT_POOL_SIZE // SHARD_WORKERS, DISPATCH_WORKERS),
+            'http_version': BOT_HTTP_VERSION,
+            'keepalive': BOT_KEEPALIVE,
+            'read_timeout': BOT_TIMEOUT,
+            'write_timeout': BOT_TIMEOUT,
+            'connect_timeout': BOT_TIMEOUT,
+            'pool_timeout': BOT_POOL_TIMEOUT,
+        },
+    })
+else:
+    reminder_engine = ReminderEngine(window=REMINDER_WINDOW, catchup=REMINDER_CATCHUP)
+dispatcher = Dispatcher(
+    workers=DISPATCH_WORKERS,
+    global_rate=DISPATCH_GLOBAL_RATE,
+    chat_rate=DISPATCH_CHAT_RATE
+)
+outbox = Outbox(storage_backend, dispatcher)
+# getUpdates holds its connection for the whole long poll, so it has its own
+get_updates_request = TimedHTTPXRequest(
+    connection_pool_size=1,
+    http_version=BOT_HTTP_VERSION,
+    keepalive=BOT_KEEPALIVE,
+    connect_timeout=BOT_TIMEOUT,
+    pool_timeout=BOT_POOL_TIMEOUT
+)
+task_store = TaskStore(storage_backend, reminder_engine)
+# PTB writes changed conversation state as often as tasks are flushed
+persistence = StorePersistence(
+    storage_backend,
+    update_interval=TASKS_FLUSH_INTERVAL,
+    cache_size=USER_DATA_CACHE_SIZE,
+    idle_timeout=USER_DATA_IDLE,
+    conversation_ttl=CONVERSATION_TTL
+)
+
+# Rendered pages: {(user_id, kind, page): (user version, rendered at, text, markup)}
+page_cache = OrderedDict()
+
+metrics = Registry()
+metrics_server = MetricsServer(metrics)
+update_seconds = metrics.histogram(
+    'taskbot_update_seconds', "Time to handle an update, including waiting for the user's previous ones"
+)
+handler_seconds = metrics.histogram(
+    'taskbot_handler_seconds', 'Handler run time by conversation state (METRICS_HANDLER_TIMINGS)',
+    ('conversation', 'state', 'callback')
+)
+storage_seconds = metrics.histogram(
+    'taskbot_storage_seconds', 'Time to load tasks and to flush changes', ('operation',)
+)
+
+
+def user_zone_name(context):
+    """Name of the user's time zone, None for the server's zone"""
+    return context.user_data.get('tz', DEFAULT_TIMEZONE)
+
+
+def clear_dialog(context):
+    """Forget the finished dialog's data; the user's settings stay"""
+    tz = context.user_data.get('tz')
+    context.user_data.clear()
+    if tz is not None:
+        context.user_data['tz'] = tz
 
 
 def get_main_keyboard():
@@ -65,6 +562,8 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "/listtasks - Посмотреть все ваши задачи\n"
         "/deletetask - Удалить задачу\n"
         "/edittask - Редактировать задачу\n"
+        "/timezone - Выбрать часовой пояс\n"
+        "/export - Выгрузить задачи в календарь или копию\n"
         "/help - Показать это сообщение\n\n"
         "Давайте начнем! 🎯",
         reply_markup=get_main_keyboard()
@@ -80,6 +579,10 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "/listtasks - Посмотреть все задачи\n"
         "/deletetask - Удалить задачу\n"
         "/edittask - Редактировать задачу\n"
+        "/add - Добавить задачу одним сообщением\n"
+        "/timezone - Выбрать часовой пояс\n"
+        "/export - Выгрузить задачи (.ics или /export jsonl)\n"
+        "/import - Загрузить задачи из файла\n"
         "/help - Показать это сообщение\n\n"
         "При добавлении задачи:\n"
         "1. Введите описание задачи\n"
@@ -91,6 +594,14 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "📆 Каждую неделю - напоминать еженедельно\n"
         "🗓 Каждый месяц - напоминать ежемесячно\n"
         "🎇 Каждый год - напоминать ежегодно\n\n"
+        "⚡ Быстрое добавление - просто напишите задачу одним сообщением:\n"
+        "Купить продукты завтра 14:30 каждую неделю\n"
+        "Планёрка по будням в 10:00\n"
+        "Позвонить маме через 2 часа\n"
+        "Несколько задач - по одной в строке; можно прислать файл\n"
+        "CSV (название;дата;время;повтор) или календарь .ics\n\n"
+        "🌍 Время задач - время вашего часового пояса, его можно\n"
+        "выбрать командой /timezone, например /timezone Europe/Moscow\n\n"
         "Пример:\n"
         "Задача: Купить продукты\n"
         "Дата: 25.11.2025\n"
@@ -136,7 +647,7 @@ async def task_date_received(update: Update, context: ContextTypes.DEFAULT_TYPE)
         task_date = datetime.strptime(date_text, '%d.%m.%Y')
         
         # Check if date is in the past
-        if task_date.date() < datetime.now().date():
+        if task_date.date() < now_local(get_zone(user_zone_name(context))).date():
             await update.message.reply_text(
                 "⚠️ Эта дата уже прошла!\n\n"
                 "Пожалуйста, введите будущую дату (ДД.ММ.ГГГГ):"
@@ -178,7 +689,7 @@ async def task_time_received(update: Update, context: ContextTypes.DEFAULT_TYPE)
         task_datetime = datetime.strptime(f"{date_str} {time_str}", '%d.%m.%Y %H:%M')
         
         # Check if datetime is in the past
-        if task_datetime < datetime.now():
+        if task_datetime < now_local(get_zone(user_zone_name(context))):
             await update.message.reply_text(
                 "⚠️ Это время уже прошло!\n\n"
                 "Пожалуйста, введите будущее время (ЧЧ:ММ):"
@@ -232,32 +743,20 @@ async def task_repeat_received(update: Update, context: ContextTypes.DEFAULT_TYP
     
     # Save the task
     user_id = str(update.effective_user.id)
-    tasks = load_tasks()
-    
-    if user_id not in tasks:
-        tasks[user_id] = []
-    
-    task = {
-        'name': context.user_data['task_name'],
-        'date': date_str,
-        'time': time_str,
-        'datetime': task_datetime.isoformat(),
-        'repeat': repeat_type,
-        'created_at': datetime.now().isoformat()
-    }
-    
-    tasks[user_id].append(task)
-    save_tasks(tasks)
-    
-    # Schedule the reminder
-    job_queue = context.application.job_queue
-    job_queue.run_once(
-        send_reminder,
-        when=task_datetime,
-        data={'task': task, 'chat_id': update.effective_chat.id, 'user_id': user_id},
-        name=f"{user_id}_{len(tasks[user_id])-1}"
+    tz = user_zone_name(context)
+    
+    # Время введено по часовому поясу пользователя, храним момент в UTC
+    task = Task(
+        name=context.user_data['task_name'],
+        due=to_timestamp(task_datetime, get_zone(tz)),
+        repeat=Repeat(repeat_type),
+        created=time.time(),
+        tz=tz
     )
     
+    # Сохраняем задачу, напоминание планирует reminder_engine
+    task_store.add_task(user_id, task)
+    
     # Prepare repeat info
     repeat_info = ""
     if repeat_type == 'daily':
@@ -271,23 +770,382 @@ async def task_repeat_received(update: Update, context: ContextTypes.DEFAULT_TYP
     
     await update.message.reply_text(
         f"✅ Задача успешно добавлена!\n\n"
-        f"📝 Задача: {task['name']}\n"
-        f"📅 Дата: {task['date']}\n"
-        f"🕐 Время: {task['time']}\n"
+        f"📝 Задача: {task.name}\n"
+        f"📅 Дата: {date_str}\n"
+        f"🕐 Время: {time_str}\n"
         f"{repeat_info}\n\n"
         f"Я напомню вам в назначенное время! ⏰",
         reply_markup=get_main_keyboard()
     )
     
     # Clear user data
-    context.user_data.clear()
+    clear_dialog(context)
     
     return ConversationHandler.END
 
 
+def describe_repeat(task):
+    """Repeat of a task for confirmations, empty for a one-off task"""
+    rule = task.recurrence
+    return f"🔁 Повтор: {rule.describe()}\n" if rule is not None else ""
+
+
+async def quick_add(update: Update, context: ContextTypes.DEFAULT_TYPE, text, explicit=False):
+    """Add the tasks a message describes; return False if it describes none.
+    
+    A message of several lines is a bulk input (see bulk_add). Unless
+    `explicit` (/add), a message without a date or time is not a task.
+    """
+    if '\n' in text.strip():
+        return await bulk_add(update, context, text, explicit)
+    
+    user_id = str(update.effective_user.id)
+    tz = user_zone_name(context)
+    now = now_local(get_zone(tz))
+    try:
+        parsed = parse_line(text, now, strict=not explicit)
+    except ValueError:
+        parsed = False
+    if parsed is None and not explicit:
+        return await confirm_quick_add(update, context, text, now)
+    if not parsed:
+        await update.message.reply_text(
+            "❌ Не получилось разобрать задачу.\n\n"
+            "Укажите описание, дату или время и, если нужно, повтор (время - в будущем)\n"
+            "Пример: Купить продукты завтра 14:30 каждую неделю",
+            reply_markup=get_main_keyboard()
+        )
+        return True
+    
+    task = parsed.to_task(tz, time.time())
+    task_store.add_task(user_id, task)
+    await update.message.reply_text(
+        f"✅ Задача добавлена!\n\n"
+        f"📝 {task.name}\n"
+        f"📅 {task.date} в {task.time}\n"
+        f"{describe_repeat(task)}",
+        reply_markup=get_main_keyboard()
+    )
+    return True
+
+
+async def confirm_quick_add(update: Update, context: ContextTypes.DEFAULT_TYPE, text, now):
+    """Ask before adding a message that is a task only by a short date.
+    
+    "Купить 1.5 литра молока" reads as a task on 01.05; it is added only
+    from the button (see handle_quick_add_callback). Returns False if the
+    message is not a task at all.
+    """
+    try:
+        parsed = parse_line(text, now)
+    except ValueError:
+        parsed = None
+    if parsed is None:
+        return False
+    
+    task = parsed.to_task(user_zone_name(context), time.time())
+    context.user_data['quick_add'] = text
+    await update.message.reply_text(
+        f"Добавить задачу?\n\n"
+        f"📝 {task.name}\n"
+        f"📅 {task.date} в {task.time}",
+        reply_markup=InlineKeyboardMarkup([[
+            InlineKeyboardButton("✅ Добавить", callback_data="quickadd:yes"),
+            InlineKeyboardButton("❌ Не надо", callback_data="quickadd:no"),
+        ]])
+    )
+    return True
+
+
+async def handle_quick_add_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Add or drop the task confirm_quick_add asked about"""
+    query = update.callback_query
+    await query.answer()
+    # Кнопка срабатывает один раз и только для последнего вопроса
+    text = context.user_data.pop('quick_add', None)
+    if query.data != 'quickadd:yes' or text is None:
+        await query.edit_message_text("Задача не добавлена.")
+        return
+    
+    user_id = str(query.from_user.id)
+    tz = user_zone_name(context)
+    try:
+        parsed = parse_line(text, now_local(get_zone(tz)))
+    except ValueError:
+        parsed = None
+    if parsed is None:
+        await query.edit_message_text("❌ Не получилось добавить задачу: время уже прошло.")
+        return
+    
+    task = parsed.to_task(tz, time.time())
+    task_store.add_task(user_id, task)
+    await query.edit_message_text(
+        f"✅ Задача добавлена!\n\n"
+        f"📝 {task.name}\n"
+        f"📅 {task.date} в {task.time}\n"
+        f"{describe_repeat(task)}"
+    )
+
+
+async def bulk_add(update: Update, context: ContextTypes.DEFAULT_TYPE, text, explicit=True):
+    """Add every task of quick-add lines, a CSV table or an iCalendar file.
+    
+    The tasks are stored in one batch. Returns False if nothing in the text
+    is a task and the input was not `explicit` (a file or /add).
+    """
+    user_id = str(update.effective_user.id)
+    tz = user_zone_name(context)
+    tasks, failed = [], []
+    created = time.time()
+    for number, parsed in parse_bulk(text, now_local(get_zone(tz)), tz):
+        if isinstance(parsed, ValueError):
+            failed.append(number)
+        else:
+            tasks.append(parsed.to_task(tz, created))
+    if not tasks and not explicit:
+        return False
+    
+    if len(tasks) > IMPORT_MAX_TASKS:
+        await update.message.reply_text(
+            f"❌ Слишком много задач: {len(tasks)}.\n\n"
+            f"За один раз можно добавить не больше {IMPORT_MAX_TASKS}.",
+            reply_markup=get_main_keyboard()
+        )
+        return True
+    
+    if tasks:
+        task_store.add_tasks(user_id, tasks)
+        logger.info(f"Пользователь {user_id} добавил задач списком: {len(tasks)}")
+    
+    parts = [f"✅ Добавлено задач: {len(tasks)}\n\n" if tasks else "❌ Задачи не найдены.\n\n"]
+    parts += [f"📝 {short_name(task.name, 60)} - {task.date} {task.time}\n" for task in tasks[:10]]
+    if len(tasks) > 10:
+        parts.append(f"…и ещё {len(tasks) - 10}\n")
+    if failed:
+        numbers = ", ".join(str(number) for number in failed[:20])
+        if len(failed) > 20:
+            numbers += ", …"
+        parts.append(f"\n⚠️ Не удалось разобрать строки ({len(failed)}): {numbers}")
+    await update.message.reply_text("".join(parts), reply_markup=get_main_keyboard())
+    return True
+
+
+async def quick_add_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle /add <task in one message>"""
+    text = update.message.text.partition(' ')[2].strip()
+    if not text:
+        await update.message.reply_text(
+            "⚡ Напишите задачу после команды, например:\n"
+            "/add Купить продукты завтра 14:30 каждую неделю\n\n"
+            "Или используйте /addtask для пошагового добавления.",
+            reply_markup=get_main_keyboard()
+        )
+        return
+    await quick_add(update, context, text, explicit=True)
+
+
+async def import_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Add the tasks of a CSV, iCalendar, JSON Lines or text file"""
+    document = update.message.document
+    # Calendars and backups may be large and are read as a stream
+    if (document.file_name or '').lower().endswith(('.ics', '.jsonl')):
+        await import_backup(update, context, document)
+        return
+    
+    if document.file_size and document.file_size > IMPORT_MAX_BYTES:
+        await update.message.reply_text(
+            f"❌ Файл слишком большой. Максимум {IMPORT_MAX_BYTES // 1024} КБ.",
+            reply_markup=get_main_keyboard()
+        )
+        return
+    
+    file = await document.get_file()
+    data = await file.download_as_bytearray()
+    try:
+        text = bytes(data).decode('utf-8-sig')
+    except UnicodeDecodeError:
+        await update.message.reply_text(
+            "❌ Не удалось прочитать файл: нужна кодировка UTF-8.",
+            reply_markup=get_main_keyboard()
+        )
+        return
+    await bulk_add(update, context, text)
+
+
+def backup_line(task):
+    """JSON line of a task for /export jsonl; ids are given anew on import"""
+    data = task.to_dict()
+    data.pop('id', None)
+    data.pop('version', None)
+    return json.dumps(data, ensure_ascii=False) + '\n'
+
+
+# Format: (file head, one task, file tail)
+EXPORT_FORMATS = {
+    'ics': (ical.CALENDAR_HEAD, ical.format_event, ical.CALENDAR_TAIL),
+    'jsonl': ('', backup_line, ''),
+}
+
+
+def export_documents(tasks, kind, limit):
+    """Yield the tasks as files (bytes) of about `limit` bytes at most.
+
+    Tasks are serialized as the files are built, so only one file is held
+    at a time; each file is complete (an .ics file is a calendar of its own).
+    """
+    head, format_task, tail = EXPORT_FORMATS[kind]
+    head, tail = head.encode('utf-8'), tail.encode('utf-8')
+    parts, size = [], len(head) + len(tail)
+    for task in tasks:
+        data = format_task(task).encode('utf-8')
+        if parts and size + len(data) > limit:
+            yield head + b''.join(parts) + tail
+            parts, size = [], len(head) + len(tail)
+        parts.append(data)
+        size += len(data)
+    yield head + b''.join(parts) + tail
+
+
+async def export_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Send the user's tasks as files: /export (iCalendar) or /export jsonl"""
+    user_id = str(update.effective_user.id)
+    kind = update.message.text.partition(' ')[2].strip().lower().lstrip('.') or 'ics'
+    if kind not in EXPORT_FORMATS:
+        await update.message.reply_text(
+            "❌ Неизвестный формат.\n\n"
+            "/export - календарь .ics для Google, Apple или Outlook\n"
+            "/export jsonl - полная резервная копия задач",
+            reply_markup=get_main_keyboard()
+        )
+        return
+    
+    task_ids = task_store.get_user_task_ids(user_id)
+    if not task_ids:
+        await update.message.reply_text(
+            "📭 У вас пока нет задач для экспорта.",
+            reply_markup=get_main_keyboard()
+        )
+        return
+    
+    # Задачи читаются по одной по мере сборки файлов; удалённые тем
+    # временем пропускаются
+    tasks = (task for _, task in map(task_store.get_task, task_ids) if task is not None)
+    documents = export_documents(tasks, kind, EXPORT_CHUNK_BYTES)
+    # One file is looked ahead to know whether the files need numbers
+    current, number = next(documents), 1
+    for following in documents:
+        await update.message.reply_document(current, filename=f"tasks_{number}.{kind}")
+        current, number = following, number + 1
+    await update.message.reply_document(
+        current,
+        filename=f"tasks_{number}.{kind}" if number > 1 else f"tasks.{kind}",
+        caption=f"📤 Задач: {len(task_ids)}. Чтобы восстановить их, пришлите файл боту.",
+        reply_markup=get_main_keyboard()
+    )
+    logger.info(f"Пользователь {user_id} выгрузил задачи ({kind}): {len(task_ids)}, файлов: {number}")
+
+
+async def import_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle /import: tell the user which files to send"""
+    await update.message.reply_text(
+        "📥 Пришлите файл с задачами:\n"
+        "📅 .ics - календарь (из /export, Google, Apple или Outlook)\n"
+        "💾 .jsonl - резервная копия из /export jsonl\n"
+        "📋 .csv или .txt - таблица или строки, как при быстром добавлении\n\n"
+        "Задачи из календаря или копии, которые у вас уже есть, не повторяются.",
+        reply_markup=get_main_keyboard()
+    )
+
+
+def backup_tasks(lines):
+    """Yield (line number, Task or ValueError) for the lines of /export jsonl"""
+    for number, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        try:
+            task = Task.from_dict(json.loads(line))
+            # An unknown zone would only fail when the task is shown
+            get_zone(task.tz)
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            yield number, ValueError(f"Invalid task: {e}")
+            continue
+        task.id = None
+        task.version = 0
+        yield number, task
+
+
+async def import_backup(update: Update, context: ContextTypes.DEFAULT_TYPE, document):
+    """Add the tasks of an .ics or .jsonl file, reading it a line at a time.
+    
+    The file is downloaded to disk and its tasks are added in batches of
+    BACKUP_BATCH_SIZE with the event loop free between them. Tasks the
+    user already has (same name and due time) are skipped, so importing
+    the same file twice adds nothing.
+    """
+    if document.file_size and document.file_size > BACKUP_MAX_BYTES:
+        await update.message.reply_text(
+            f"❌ Файл слишком большой. Максимум {BACKUP_MAX_BYTES // (1024 * 1024)} МБ.",
+            reply_markup=get_main_keyboard()
+        )
+        return
+    
+    user_id = str(update.effective_user.id)
+    tz = user_zone_name(context)
+    added, skipped, failed = 0, 0, []
+    error = None
+    file = await document.get_file()
+    with tempfile.TemporaryDirectory() as directory:
+        path = await file.download_to_drive(os.path.join(directory, 'import'))
+        existing = {(task.name, task.due) for task in task_store.get_user_tasks(user_id)}
+        batch = []
+        try:
+            with open(path, 'r', encoding='utf-8-sig') as f:
+                if document.file_name.lower().endswith('.jsonl'):
+                    records = backup_tasks(f)
+                else:
+                    created = time.time()
+                    records = (
+                        (number, parsed if isinstance(parsed, ValueError) else parsed.to_task(tz, created))
+                        for number, parsed in parse_events(f, now_local(get_zone(tz)), tz)
+                    )
+                for number, task in records:
+                    if isinstance(task, ValueError):
+                        failed.append(number)
+                        continue
+                    if (task.name, task.due) in existing:
+                        skipped += 1
+                        continue
+                    existing.add((task.name, task.due))
+                    batch.append(task)
+                    if len(batch) == BACKUP_BATCH_SIZE:
+                        task_store.add_tasks(user_id, batch)
+                        added += len(batch)
+                        batch = []
+                        await asyncio.sleep(0)
+        except UnicodeDecodeError:
+            error = "❌ Не удалось прочитать файл: нужна кодировка UTF-8."
+        if batch:
+            task_store.add_tasks(user_id, batch)
+            added += len(batch)
+    if added:
+        logger.info(f"Пользователь {user_id} импортировал задачи из {document.file_name}: {added}")
+    
+    parts = [f"✅ Добавлено задач: {added}\n" if added else "❌ Новых задач не найдено.\n"]
+    if skipped:
+        parts.append(f"↩️ Уже были: {skipped}\n")
+    if failed:
+        numbers = ", ".join(str(number) for number in failed[:20])
+        if len(failed) > 20:
+            numbers += ", …"
+        parts.append(f"\n⚠️ Не удалось разобрать записи ({len(failed)}), строки: {numbers}")
+    if error:
+        parts.append(f"\n{error}")
+    await update.message.reply_text("".join(parts), reply_markup=get_main_keyboard())
+
+
 async def cancel_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Cancel the conversation"""
-    context.user_data.clear()
+    clear_dialog(context)
     await update.message.reply_text(
         "❌ Создание задачи отменено.\n\n"
         "Используйте /addtask чтобы начать снова.",
@@ -296,72 +1154,191 @@ async def cancel_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     return ConversationHandler.END
 
 
+def short_name(name, limit=200):
+    """Trim long task names so a page always fits into one message"""
+    return name if len(name) <= limit else name[:limit - 1] + "…"
+
+
+def page_keyboard(kind, page, pages):
+    """Inline ◀️/▶️ buttons for a paginated view, or None for a single page"""
+    if pages <= 1:
+        return None
+    buttons = []
+    if page > 0:
+        buttons.append(InlineKeyboardButton("◀️ Назад", callback_data=f"page:{kind}:{page - 1}"))
+    if page < pages - 1:
+        buttons.append(InlineKeyboardButton("Вперёд ▶️", callback_data=f"page:{kind}:{page + 1}"))
+    return InlineKeyboardMarkup([buttons])
+
+
+def render_task_line(idx, task, now):
+    """One task of /listtasks; `now` is a timestamp"""
+    task_dt = task.when
+    
+    # Check if task is overdue
+    if task.due < now:
+        status = "⏰ ПРОСРОЧЕНО"
+    else:
+        time_left = timedelta(seconds=task.due - now)
+        days = time_left.days
+        hours = time_left.seconds // 3600
+        
+        if days > 0:
+            status = f"⏳ через {days} дн."
+        elif hours > 0:
+            status = f"⏳ через {hours} ч."
+        else:
+            status = "⏳ скоро"
+    
+    # Add repeat info
+    repeat_type = task.repeat
+    repeat_badge = ""
+    if repeat_type == 'daily':
+        repeat_badge = " 🔁📅"
+    elif repeat_type == 'weekly':
+        repeat_badge = " 🔁📆"
+    elif repeat_type == 'monthly':
+        repeat_badge = " 🔁🗓"
+    elif repeat_type == 'yearly':
+        repeat_badge = " 🔁🎇"
+    
+    return (
+        f"{idx}. {short_name(task.name)}{repeat_badge}\n"
+        f"   📅 {task_dt:%d.%m.%Y} в {task_dt:%H:%M}\n"
+        f"   {status}\n\n"
+    )
+
+
+def render_page(user_id, kind, page):
+    """Render a page of /listtasks ('list') or of a picker ('delete', 'edit').
+    
+    Returns (text, inline keyboard or None). Pages are cached until the
+    user's tasks change; list pages also show the time left, so they are
+    re-rendered at least every LIST_CACHE_TTL seconds.
+    """
+    version = task_store.user_version(user_id)
+    key = (user_id, kind, page)
+    cached = page_cache.get(key)
+    if cached is not None and cached[0] == version and (
+        kind != 'list' or time.monotonic() - cached[1] < LIST_CACHE_TTL
+    ):
+        page_cache.move_to_end(key)
+        return cached[2], cached[3]
+    
+    total = task_store.count_user_tasks(user_id)
+    pages = max((total + LIST_PAGE_SIZE - 1) // LIST_PAGE_SIZE, 1)
+    page = min(max(page, 0), pages - 1)
+    first = page * LIST_PAGE_SIZE
+    tasks = task_store.get_user_tasks_page(user_id, first, LIST_PAGE_SIZE)
+    
+    if kind == 'list':
+        now = time.time()
+        parts = ["📋 Ваши задачи:\n" + "━" * 30 + "\n\n"]
+        parts += [render_task_line(idx, task, now) for idx, task in enumerate(tasks, first + 1)]
+        parts.append(f"Всего задач: {total}")
+        if pages > 1:
+            parts.append(f"\n\nСтраница {page + 1} из {pages}")
+    else:
+        action = "удаления" if kind == 'delete' else "редактирования"
+        parts = [f"{'🗑️' if kind == 'delete' else '✏️'} Выберите задачу для {action}:\n\n"]
+        parts += [
+            f"{idx}. {short_name(task.name)} - {task.date} {task.time}\n"
+            for idx, task in enumerate(tasks, first + 1)
+        ]
+        if pages > 1:
+            parts.append(f"\nСтраница {page + 1} из {pages}\n")
+        parts.append(f"\nОтветьте номером задачи для {action}.\nОтправьте /cancel для отмены.")
+    
+    text = "".join(parts)
+    markup = page_keyboard(kind, page, pages)
+    page_cache[key] = (version, time.monotonic(), text, markup)
+    if len(page_cache) > PAGE_CACHE_SIZE:
+        page_cache.popitem(last=False)
+    return text, markup
+
+
+def remember_picker(context, user_id):
+    """Remember which task each number of the picker means"""
+    context.user_data['task_ids'] = task_store.get_user_task_ids(user_id)
+    context.user_data['task_ids_version'] = task_store.user_version(user_id)
+
+
 async def list_tasks_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """List all tasks for the user"""
     user_id = str(update.effective_user.id)
-    tasks = load_tasks()
     
-    if user_id not in tasks or not tasks[user_id]:
+    if not task_store.count_user_tasks(user_id):
         await update.message.reply_text(
             "📋 У вас пока нет задач.\n\n"
             "Используйте /addtask чтобы создать первую задачу!"
         )
         return
     
-    user_tasks = tasks[user_id]
-    
-    # Sort tasks by datetime
-    user_tasks.sort(key=lambda x: x['datetime'])
+    text, markup = render_page(user_id, 'list', 0)
+    await update.message.reply_text(text, reply_markup=markup or get_main_keyboard())
+
+
+async def timezone_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Show or set the user's time zone: /timezone Europe/Moscow"""
+    user_id = str(update.effective_user.id)
     
-    message = "📋 Ваши задачи:\n" + "━" * 30 + "\n\n"
+    if not context.args:
+        await update.message.reply_text(
+            f"🌍 Ваш часовой пояс: {describe_zone(user_zone_name(context))}\n\n"
+            "Чтобы изменить его, отправьте /timezone и название пояса\n"
+            "или смещение от UTC.\n"
+            "Примеры: /timezone Europe/Moscow, /timezone Asia/Yekaterinburg, /timezone +3",
+            reply_markup=get_main_keyboard()
+        )
+        return
     
-    for idx, task in enumerate(user_tasks, 1):
-        task_dt = datetime.fromisoformat(task['datetime'])
-        
-        # Check if task is overdue
-        if task_dt < datetime.now():
-            status = "⏰ ПРОСРОЧЕНО"
-        else:
-            time_left = task_dt - datetime.now()
-            days = time_left.days
-            hours = time_left.seconds // 3600
-            
-            if days > 0:
-                status = f"⏳ через {days} дн."
-            elif hours > 0:
-                status = f"⏳ через {hours} ч."
-            else:
-                status = "⏳ скоро"
-        
-        # Add repeat info
-        repeat_type = task.get('repeat', 'none')
-        repeat_badge = ""
-        if repeat_type == 'daily':
-            repeat_badge = " 🔁📅"
-        elif repeat_type == 'weekly':
-            repeat_badge = " 🔁📆"
-        elif repeat_type == 'monthly':
-            repeat_badge = " 🔁🗓"
-        elif repeat_type == 'yearly':
-            repeat_badge = " 🔁🎇"
-        
-        message += (
-            f"{idx}. {task['name']}{repeat_badge}\n"
-            f"   📅 {task['date']} в {task['time']}\n"
-            f"   {status}\n\n"
+    try:
+        tz = parse_zone(" ".join(context.args))
+    except ValueError:
+        await update.message.reply_text(
+            "❌ Неизвестный часовой пояс!\n\n"
+            "Используйте название из базы часовых поясов или смещение от UTC\n"
+            "Примеры: Europe/Moscow, America/New_York, UTC+5:30",
+            reply_markup=get_main_keyboard()
         )
+        return
     
-    message += f"Всего задач: {len(user_tasks)}"
+    # Задачи сохраняют время по часам: 09:00 остаётся 09:00 в новом поясе
+    moved, failed = 0, 0
+    for task in task_store.get_user_tasks(user_id):
+        for _ in range(3):
+            if task is None or task.tz == tz:
+                break
+            moved_task = task.copy()
+            moved_task.move_to_zone(tz)
+            try:
+                task_store.update_task(user_id, moved_task)
+            except TaskConflictError:
+                # Задачу изменили (например, сработало напоминание) - берём новую версию
+                owner, task = task_store.get_task(task.id)
+                if owner != user_id:
+                    task = None
+                continue
+            moved += 1
+            break
+        else:
+            failed += 1
+    context.user_data['tz'] = tz
     
+    message = f"✅ Часовой пояс: {describe_zone(tz)}"
+    if moved:
+        message += f"\n\nЗадачи переведены на него с тем же временем: {moved}"
+    if failed:
+        message += (f"\n\n⚠️ Не удалось перевести задач: {failed}. "
+                    "Отправьте эту команду ещё раз, чтобы перевести их.")
     await update.message.reply_text(message, reply_markup=get_main_keyboard())
 
 
 async def delete_task_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Delete a task by number"""
     user_id = str(update.effective_user.id)
-    tasks = load_tasks()
     
-    if user_id not in tasks or not tasks[user_id]:
+    if not task_store.count_user_tasks(user_id):
         await update.message.reply_text(
             "📋 У вас нет задач для удаления.\n\n"
             "Используйте /addtask чтобы создать задачу!",
@@ -369,26 +1346,18 @@ async def delete_task_command(update: Update, context: ContextTypes.DEFAULT_TYPE
         )
         return ConversationHandler.END
     
-    # Show tasks with numbers
-    user_tasks = tasks[user_id]
-    user_tasks.sort(key=lambda x: x['datetime'])
-    
-    message = "🗑️ Выберите задачу для удаления:\n\n"
-    for idx, task in enumerate(user_tasks, 1):
-        message += f"{idx}. {task['name']} - {task['date']} {task['time']}\n"
-    
-    message += "\nОтветьте номером задачи для удаления.\nОтправьте /cancel для отмены."
-    
-    await update.message.reply_text(message, reply_markup=ReplyKeyboardRemove())
+    # Show tasks with numbers and remember which task each number means
+    remember_picker(context, user_id)
+    text, markup = render_page(user_id, 'delete', 0)
+    await update.message.reply_text(text, reply_markup=markup or ReplyKeyboardRemove())
     return DELETE_NUMBER
 
 
 async def edit_task_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Edit a task by number"""
     user_id = str(update.effective_user.id)
-    tasks = load_tasks()
     
-    if user_id not in tasks or not tasks[user_id]:
+    if not task_store.count_user_tasks(user_id):
         await update.message.reply_text(
             "📋 У вас нет задач для редактирования.\n\n"
             "Используйте /addtask чтобы создать задачу!",
@@ -396,18 +1365,37 @@ async def edit_task_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return ConversationHandler.END
     
-    # Show tasks with numbers
-    user_tasks = tasks[user_id]
-    user_tasks.sort(key=lambda x: x['datetime'])
-    
-    message = "✏️ Выберите задачу для редактирования:\n\n"
-    for idx, task in enumerate(user_tasks, 1):
-        message += f"{idx}. {task['name']} - {task['date']} {task['time']}\n"
+    # Show tasks with numbers and remember which task each number means
+    remember_picker(context, user_id)
+    text, markup = render_page(user_id, 'edit', 0)
+    await update.message.reply_text(text, reply_markup=markup or ReplyKeyboardRemove())
+    return EDIT_TASK
+
+
+async def handle_page_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Show another page of the task list or a picker"""
+    query = update.callback_query
+    parts = query.data.split(':')
+    # Устаревшая или подделанная кнопка
+    if len(parts) != 3 or parts[1] not in ('list', 'delete', 'edit') or not parts[2].isdecimal():
+        await query.answer()
+        return
+    _, kind, page = parts
+    user_id = str(query.from_user.id)
     
-    message += "\nОтветьте номером задачи для редактирования.\nОтправьте /cancel для отмены."
+    # Номера на странице должны совпадать с теми, что запомнил выбор задачи
+    if kind != 'list' and 'task_ids' in context.user_data:
+        if context.user_data.get('task_ids_version') != task_store.user_version(user_id):
+            remember_picker(context, user_id)
     
-    await update.message.reply_text(message, reply_markup=ReplyKeyboardRemove())
-    return EDIT_TASK
+    text, markup = render_page(user_id, kind, int(page))
+    await query.answer()
+    try:
+        await query.edit_message_text(text, reply_markup=markup)
+    except BadRequest as e:
+        # Повторное нажатие на ту же страницу
+        if 'not modified' not in str(e):
+            raise
 
 
 async def handle_menu_buttons(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -430,9 +1418,14 @@ async def handle_menu_buttons(update: Update, context: ContextTypes.DEFAULT_TYPE
     elif text == "ℹ️ Помощь":
         return await help_command(update, context)
     else:
+        # Сообщение с датой или временем - быстрое добавление задачи
+        if await quick_add(update, context, text):
+            return
         # Show menu for any other message
         await update.message.reply_text(
-            "Используйте меню ниже или команду /start",
+            "Используйте меню ниже или команду /start\n\n"
+            "Или напишите задачу одним сообщением, например:\n"
+            "Купить продукты завтра 14:30",
             reply_markup=get_main_keyboard()
         )
 
@@ -442,29 +1435,32 @@ async def handle_delete_number(update: Update, context: ContextTypes.DEFAULT_TYP
     try:
         task_num = int(update.message.text)
         user_id = str(update.effective_user.id)
-        tasks = load_tasks()
+        task_ids = context.user_data.get('task_ids', [])
         
-        if user_id not in tasks or not tasks[user_id]:
+        if not task_ids:
             await update.message.reply_text("Задачи не найдены.", reply_markup=get_main_keyboard())
             return ConversationHandler.END
         
-        user_tasks = tasks[user_id]
-        user_tasks.sort(key=lambda x: x['datetime'])
-        
-        if task_num < 1 or task_num > len(user_tasks):
+        if task_num < 1 or task_num > len(task_ids):
             await update.message.reply_text(
-                f"❌ Неверный номер задачи. Выберите от 1 до {len(user_tasks)}"
+                f"❌ Неверный номер задачи. Выберите от 1 до {len(task_ids)}"
             )
             return DELETE_NUMBER
         
-        deleted_task = user_tasks.pop(task_num - 1)
-        tasks[user_id] = user_tasks
-        save_tasks(tasks)
+        deleted_task = task_store.delete_task(user_id, task_ids[task_num - 1])
+        clear_dialog(context)
+        
+        if deleted_task is None:
+            await update.message.reply_text(
+                "⚠️ Эта задача уже удалена.",
+                reply_markup=get_main_keyboard()
+            )
+            return ConversationHandler.END
         
         await update.message.reply_text(
             f"✅ Задача удалена:\n"
-            f"📝 {deleted_task['name']}\n"
-            f"📅 {deleted_task['date']} {deleted_task['time']}",
+            f"📝 {deleted_task.name}\n"
+            f"📅 {deleted_task.date} {deleted_task.time}",
             reply_markup=get_main_keyboard()
         )
         
@@ -481,28 +1477,31 @@ async def handle_edit_task_selection(update: Update, context: ContextTypes.DEFAU
     """Handle task selection for editing"""
     try:
         task_num = int(update.message.text)
-        user_id = str(update.effective_user.id)
-        tasks = load_tasks()
+        task_ids = context.user_data.get('task_ids', [])
         
-        if user_id not in tasks or not tasks[user_id]:
+        if not task_ids:
             await update.message.reply_text("Задачи не найдены.", reply_markup=get_main_keyboard())
             return ConversationHandler.END
         
-        user_tasks = tasks[user_id]
-        user_tasks.sort(key=lambda x: x['datetime'])
-        
-        if task_num < 1 or task_num > len(user_tasks):
+        if task_num < 1 or task_num > len(task_ids):
             await update.message.reply_text(
-                f"❌ Неверный номер задачи. Выберите от 1 до {len(user_tasks)}"
+                f"❌ Неверный номер задачи. Выберите от 1 до {len(task_ids)}"
             )
             return EDIT_TASK
         
-        # Store task info for editing
-        context.user_data['edit_task_index'] = task_num - 1
-        context.user_data['edit_task'] = user_tasks[task_num - 1].copy()
+        user_id, task = task_store.get_task(task_ids[task_num - 1])
+        if task is None or user_id != str(update.effective_user.id):
+            clear_dialog(context)
+            await update.message.reply_text(
+                "⚠️ Эта задача уже удалена.",
+                reply_markup=get_main_keyboard()
+            )
+            return ConversationHandler.END
+        
+        # Store a copy of the task for editing
+        context.user_data['edit_task'] = task.copy()
         
         # Show edit options
-        task = user_tasks[task_num - 1]
         keyboard = [
             [KeyboardButton("📝 Название"), KeyboardButton("📅 Дата")],
             [KeyboardButton("🕐 Время"), KeyboardButton("🔁 Повтор")],
@@ -511,8 +1510,8 @@ async def handle_edit_task_selection(update: Update, context: ContextTypes.DEFAU
         
         message = (
             f"✏️ Редактирование задачи:\n\n"
-            f"📝 {task['name']}\n"
-            f"📅 {task['date']} в {task['time']}\n\n"
+            f"📝 {task.name}\n"
+            f"📅 {task.date} в {task.time}\n\n"
             "Что хотите изменить?"
         )
         
@@ -580,29 +1579,25 @@ async def handle_edit_field_selection(update: Update, context: ContextTypes.DEFA
     elif text == "✅ Сохранить":
         # Save the edited task
         user_id = str(update.effective_user.id)
-        tasks = load_tasks()
         
-        if user_id in tasks and 'edit_task_index' in context.user_data:
-            task_index = context.user_data['edit_task_index']
+        if 'edit_task' in context.user_data:
             edited_task = context.user_data['edit_task']
             
-            # Update datetime
             try:
-                task_datetime = datetime.strptime(
-                    f"{edited_task['date']} {edited_task['time']}", 
-                    '%d.%m.%Y %H:%M'
+                task_store.update_task(user_id, edited_task)
+            except TaskConflictError:
+                await update.message.reply_text(
+                    "⚠️ Задача была изменена, пока вы её редактировали.\n\n"
+                    "Используйте /edittask чтобы попробовать снова.",
+                    reply_markup=get_main_keyboard()
                 )
-                edited_task['datetime'] = task_datetime.isoformat()
-            except ValueError:
-                pass  # Keep original datetime if parsing fails
-            
-            tasks[user_id][task_index] = edited_task
-            save_tasks(tasks)
+                clear_dialog(context)
+                return ConversationHandler.END
             
             await update.message.reply_text(
                 f"✅ Задача успешно обновлена!\n\n"
-                f"📝 {edited_task['name']}\n"
-                f"📅 {edited_task['date']} в {edited_task['time']}",
+                f"📝 {edited_task.name}\n"
+                f"📅 {edited_task.date} в {edited_task.time}",
                 reply_markup=get_main_keyboard()
             )
         else:
@@ -611,7 +1606,7 @@ async def handle_edit_field_selection(update: Update, context: ContextTypes.DEFA
                 reply_markup=get_main_keyboard()
             )
         
-        context.user_data.clear()
+        clear_dialog(context)
         return ConversationHandler.END
     
     elif text == "❌ Отмена":
@@ -619,7 +1614,7 @@ async def handle_edit_field_selection(update: Update, context: ContextTypes.DEFA
             "❌ Редактирование отменено.",
             reply_markup=get_main_keyboard()
         )
-        context.user_data.clear()
+        clear_dialog(context)
         return ConversationHandler.END
     
     else:
@@ -636,7 +1631,7 @@ async def handle_edit_value_input(update: Update, context: ContextTypes.DEFAULT_
     value = update.message.text
     
     if field == 'name':
-        context.user_data['edit_task']['name'] = value
+        context.user_data['edit_task'].name = value
         
     elif field == 'date':
         # Validate date
@@ -645,14 +1640,16 @@ async def handle_edit_value_input(update: Update, context: ContextTypes.DEFAULT_
             task_date = datetime.strptime(date_text, '%d.%m.%Y')
             
             # Check if date is in the past
-            if task_date.date() < datetime.now().date():
+            task = context.user_data['edit_task']
+            if task_date.date() < now_local(task.zone).date():
                 await update.message.reply_text(
                     "⚠️ Эта дата уже прошла!\n\n"
                     "Пожалуйста, введите будущую дату (ДД.ММ.ГГГГ):"
                 )
                 return EDIT_VALUE
             
-            context.user_data['edit_task']['date'] = task_date.strftime('%d.%m.%Y')
+            # Новое время означает новое напоминание
+            task.reschedule(datetime.combine(task_date.date(), task.when.time()))
         except ValueError:
             await update.message.reply_text(
                 "❌ Неверный формат даты!\n\n"
@@ -665,7 +1662,8 @@ async def handle_edit_value_input(update: Update, context: ContextTypes.DEFAULT_
         # Validate time
         try:
             task_time = datetime.strptime(value, '%H:%M')
-            context.user_data['edit_task']['time'] = task_time.strftime('%H:%M')
+            task = context.user_data['edit_task']
+            task.reschedule(datetime.combine(task.when.date(), task_time.time()))
         except ValueError:
             await update.message.reply_text(
                 "❌ Неверный формат времени!\n\n"
@@ -685,7 +1683,11 @@ async def handle_edit_value_input(update: Update, context: ContextTypes.DEFAULT_
         }
         
         repeat_type = repeat_map.get(value, "none")
-        context.user_data['edit_task']['repeat'] = repeat_type
+        # Простой выбор заменяет особое правило и начинает серию заново
+        task = context.user_data['edit_task']
+        task.repeat = Repeat(repeat_type)
+        task.rule = None
+        task.start = None
     
     # Show edit options again
     task = context.user_data['edit_task']
@@ -697,8 +1699,8 @@ async def handle_edit_value_input(update: Update, context: ContextTypes.DEFAULT_
     
     message = (
         f"✏️ Редактирование задачи:\n\n"
-        f"📝 {task['name']}\n"
-        f"📅 {task['date']} в {task['time']}\n\n"
+        f"📝 {task.name}\n"
+        f"📅 {task.date} в {task.time}\n\n"
         "Что хотите изменить?"
     )
     
@@ -709,130 +1711,175 @@ async def handle_edit_value_input(update: Update, context: ContextTypes.DEFAULT_
     return EDIT_FIELD
 
 
-async def send_reminder(context: ContextTypes.DEFAULT_TYPE):
-    """Send reminder for a task"""
-    job_data = context.job.data
-    task = job_data['task']
-    chat_id = job_data['chat_id']
+async def deliver_reminder(context: ContextTypes.DEFAULT_TYPE, user_id, task):
+    """Queue the reminder for a due task and move a repeating task to its next occurrence"""
+    repeat_type = task.repeat
+    message = reminder_text(task)
     
-    message = (
-        "⏰ НАПОМИНАНИЕ!\n\n"
-        f"📝 {task['name']}\n"
-        f"📅 {task['date']} в {task['time']}\n\n"
-        "Время пришло! ⏱️"
-    )
+    # Напоминание сохраняется в outbox, отправка и повторы идут оттуда
+    outbox.put(reminder_key(user_id, task), int(user_id), message, task.due)
+    
+    # Разовая задача отмечается как отправленная, повторяющаяся
+    # переходит к следующему повторению
+    task_store.task_fired(user_id, task)
+    
+    if repeat_type != 'none' and not task.reminded:
+        logger.info(f"Следующее повторение задачи для {user_id}: {task.name} на {task.when:%d.%m.%Y %H:%M}")
     
-    await context.bot.send_message(chat_id=chat_id, text=message)
+    logger.info(f"Напоминание поставлено в очередь для {user_id}: {task.name}")
 
 
-async def check_tasks_periodically(context: ContextTypes.DEFAULT_TYPE):
-    """Проверка задач каждую минуту"""
-    tasks = load_tasks()
-    current_time = datetime.now()
-    tasks_updated = False
-    
-    for user_id, user_tasks in tasks.items():
-        for idx, task in enumerate(user_tasks):
-            task_datetime = datetime.fromisoformat(task['datetime'])
-            
-            # Проверяем, не прошло ли время задачи (с точностью до минуты)
-            if (task_datetime.year == current_time.year and
-                task_datetime.month == current_time.month and
-                task_datetime.day == current_time.day and
-                task_datetime.hour == current_time.hour and
-                task_datetime.minute == current_time.minute):
-                
-                # Проверяем, не отправляли ли уже напоминание
-                if not task.get('reminded', False):
-                    repeat_type = task.get('repeat', 'none')
-                    repeat_info = ""
-                    if repeat_type == 'daily':
-                        repeat_info = "\n🔁 Повторяется каждый день"
-                    elif repeat_type == 'weekly':
-                        repeat_info = "\n🔁 Повторяется каждую неделю"
-                    elif repeat_type == 'monthly':
-                        repeat_info = "\n🔁 Повторяется каждый месяц"
-                    elif repeat_type == 'yearly':
-                        repeat_info = "\n🔁 Повторяется каждый год"
-                    
-                    message = (
-                        "⏰ Напоминание о задаче!\n\n"
-                        f"📝 {task['name']}\n"
-                        f"📅 {task['date']} в {task['time']}"
-                        f"{repeat_info}\n\n"
-                        "Не забудьте выполнить! ✅"
-                    )
-                    
-                    try:
-                        await context.bot.send_message(chat_id=int(user_id), text=message)
-                        
-                        # Отмечаем, что напоминание отправлено
-                        task['reminded'] = True
-                        
-                        # Если задача повторяющаяся, создаем следующую
-                        if repeat_type != 'none':
-                            next_datetime = calculate_next_datetime(task_datetime, repeat_type)
-                            
-                            # Создаем новую задачу на следующий период
-                            new_task = {
-                                'name': task['name'],
-                                'date': next_datetime.strftime('%d.%m.%Y'),
-                                'time': next_datetime.strftime('%H:%M'),
-                                'datetime': next_datetime.isoformat(),
-                                'repeat': repeat_type,
-                                'created_at': task['created_at']
-                            }
-                            user_tasks.append(new_task)
-                            tasks_updated = True
-                            
-                            logger.info(f"Создана повторяющаяся задача для {user_id}: {task['name']} на {new_task['date']} {new_task['time']}")
-                        
-                        logger.info(f"Отправлено напоминание пользователю {user_id}: {task['name']}")
-                    except Exception as e:
-                        logger.error(f"Ошибка при отправке напоминания: {e}")
-    
-    # Сохраняем изменения, если были добавлены повторяющиеся задачи
-    if tasks_updated:
-        save_tasks(tasks)
-
-
-def calculate_next_datetime(current_dt, repeat_type):
-    """Calculate next datetime for repeating task"""
-    if repeat_type == 'daily':
-        return current_dt + timedelta(days=1)
-    elif repeat_type == 'weekly':
-        return current_dt + timedelta(weeks=1)
-    elif repeat_type == 'monthly':
-        # Add one month (handle month overflow)
-        next_month = current_dt.month + 1
-        next_year = current_dt.year
-        if next_month > 12:
-            next_month = 1
-            next_year += 1
-        
-        # Handle day overflow (e.g., Jan 31 -> Feb 28/29)
-        try:
-            return current_dt.replace(year=next_year, month=next_month)
-        except ValueError:
-            # Day doesn't exist in next month, use last day of month
-            import calendar
-            last_day = calendar.monthrange(next_year, next_month)[1]
-            return current_dt.replace(year=next_year, month=next_month, day=last_day)
-    elif repeat_type == 'yearly':
-        next_year = current_dt.year + 1
-        try:
-            return current_dt.replace(year=next_year)
-        except ValueError:
-            # Handle Feb 29 on non-leap years
-            return current_dt.replace(year=next_year, day=28)
+def reminder_fired(user_id, task_id, due):
+    """A shard worker queued the reminder for the task's occurrence at `due`"""
+    owner, task = task_store.get_task(task_id)
+    if task is None or owner != user_id or task.reminded or task.due != due:
+        return
+    task_store.task_fired(user_id, task)
+    logger.info(f"Напоминание поставлено в очередь для {user_id}: {task.name}")
+
+
+def reminder_missed(user_id, task):
+    """The task's reminder is older than REMINDER_CATCHUP: move on without sending it"""
+    task_store.task_fired(user_id, task)
+
+
+async def flush_tasks_periodically(context: ContextTypes.DEFAULT_TYPE):
+    """Flush in-memory task changes to disk"""
+    try:
+        await task_store.flush()
+    except Exception as e:
+        logger.error(f"Ошибка при сохранении задач: {e}")
+
+
+async def evict_idle_user_data(context: ContextTypes.DEFAULT_TYPE):
+    """Unload user_data of idle users; it stays in storage"""
+    evicted = persistence.evict(context.application)
+    if evicted:
+        logger.info(f"Выгружены данные неактивных пользователей: {evicted}, в памяти {persistence.loaded_users()}")
+
+
+async def log_reminder_stats(context: ContextTypes.DEFAULT_TYPE):
+    """Log reminder delivery latency percentiles and dispatch counters"""
+    dispatch_stats = dispatcher.stats()
+    logger.info(
+        f"Отправка: отправлено {dispatch_stats['sent']}, ошибок {dispatch_stats['failed']}, "
+        f"повторов {dispatch_stats['retried']}, в очереди {dispatch_stats['queue_depth']}, "
+        f"{dispatch_stats['throughput']:.1f} сообщ./с, в outbox {len(outbox)}"
+    )
     
-    return current_dt
+    stats = outbox.latency.summary()
+    if stats['p50'] is None:
+        return
+    logger.info(
+        f"Задержка напоминаний (всего {stats['count']}): "
+        f"p50={stats['p50']:.3f}с p90={stats['p90']:.3f}с "
+        f"p99={stats['p99']:.3f}с max={stats['max']:.3f}с"
+    )
 
 
-def main():
-    """Start the bot"""
-    # Create application
-    application = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
+async def log_api_stats(context: ContextTypes.DEFAULT_TYPE):
+    """Log call counts and timing of Bot API methods"""
+    for name, request in (('запросы', context.bot.request), ('getUpdates', get_updates_request)):
+        if request.endpoints:
+            logger.info(f"Bot API ({name}): {format_stats(request)}")
+
+
+def collect_metrics(application, server=None):
+    """Metrics read from the bot's components on every scrape"""
+    if SHARD_WORKERS > 0:
+        sources = {str(worker): stats for worker, stats in reminder_engine.worker_stats.items()}
+    else:
+        sources = {'bot': delivery_stats(dispatcher, outbox, reminder_engine, application.bot.request)}
+    clients = {'bot': application.bot.request.stats(), 'getUpdates': get_updates_request.stats()}
+    clients.update((f"worker {worker}", stats['api']) for worker, stats in sources.items() if worker != 'bot')
+
+    tasks = Gauge('taskbot_tasks', 'Tasks in memory')
+    tasks.set(len(task_store))
+    jobs = Gauge('taskbot_job_queue_jobs', 'Jobs in the JobQueue')
+    jobs.set(len(application.job_queue.jobs()))
+    size = Gauge('taskbot_storage_size_bytes', 'Size of the task storage files')
+    size.set(storage_backend.size())
+    loaded = Gauge('taskbot_user_data_loaded', 'Users whose user_data is in memory')
+    loaded.set(persistence.loaded_users())
+    result = [tasks, jobs, size, loaded] + delivery_metrics(sources) + api_metrics(clients)
+    if server is not None:
+        stats = server.stats()
+        webhook = Gauge('taskbot_webhook_updates', 'Webhook updates by outcome', ('status',))
+        webhook.set(stats['received'], 'received')
+        webhook.set(stats['rejected'], 'rejected')
+        webhook.set(stats['pending'], 'pending')
+        latency = Summary('taskbot_webhook_update_seconds', 'Time from receiving an update to the end of its handlers')
+        latency.set(server.latency.summary())
+        result += [webhook, latency]
+    return result
+
+
+async def load_tasks_and_schedule(application: Application):
+    """Load tasks and start scheduling reminders while updates are already received"""
+    try:
+        await task_store.load_async()
+    except Exception as e:
+        logger.critical(f"Не удалось загрузить задачи: {e}")
+        # The bot is stopped through the hook of its run mode (see main),
+        # which only works once the application is running
+        while not application.running:
+            await asyncio.sleep(0.1)
+        application.bot_data['stop']()
+        return
+    if SHARD_WORKERS > 0:
+        # Напоминания планируют и отправляют процессы-воркеры
+        reminder_engine.start(application.job_queue, reminder_fired)
+    else:
+        reminder_engine.start(application.job_queue, deliver_reminder, reminder_missed)
+    logger.info(f"Запланировано напоминаний: {len(reminder_engine)}")
+
+
+async def on_startup(application: Application):
+    """Start the metrics server, reminder dispatch workers, the outbox and the task load"""
+    if METRICS_PORT:
+        await metrics_server.start(METRICS_LISTEN, METRICS_PORT)
+    # PTB does not wait for its create_task() tasks created before the
+    # application runs, so on_stop waits for this one
+    application.bot_data['task_loader'] = asyncio.create_task(load_tasks_and_schedule(application))
+    if SHARD_WORKERS > 0:
+        return
+    dispatcher.start(application.bot)
+    outbox.load()
+    outbox.start()
+
+
+async def on_stop(application: Application):
+    """Send queued reminders while the bot is still connected"""
+    await application.bot_data['task_loader']
+    if SHARD_WORKERS > 0:
+        await reminder_engine.stop()
+        return
+    await outbox.stop()
+    await dispatcher.stop()
+
+
+async def on_shutdown(application: Application):
+    """Flush pending task changes before exit"""
+    await metrics_server.stop()
+    storage_backend.close()
+
+
+def time_handler(handler, conversation=''):
+    """Record the run time of the handler's callbacks in handler_seconds"""
+    if isinstance(handler, ConversationHandler):
+        states = {'entry': handler.entry_points, 'fallback': handler.fallbacks}
+        states.update((STATE_NAMES[state], handlers) for state, handlers in handler.states.items())
+        for state, handlers in states.items():
+            for h in handlers:
+                h.callback = timed(handler_seconds, h.callback, conversation, state, h.callback.__name__)
+    else:
+        handler.callback = timed(handler_seconds, handler.callback, conversation, '', handler.callback.__name__)
+
+
+def register_handlers(application):
+    """Add all command, menu and conversation handlers to the application"""
+    # Dialogs survive restarts when the application has a persistence
+    persistent = application.persistence is not None
     
     # Add conversation handler for adding tasks
     conv_handler = ConversationHandler(
@@ -847,7 +1894,9 @@ def main():
             TASK_REPEAT: [MessageHandler(filters.TEXT & ~filters.COMMAND, task_repeat_received)],
         },
         fallbacks=[CommandHandler('cancel', cancel_command)],
-        allow_reentry=True
+        allow_reentry=True,
+        name='addtask',
+        persistent=persistent
     )
     
     # Add conversation handler for deleting tasks
@@ -860,7 +1909,9 @@ def main():
             DELETE_NUMBER: [MessageHandler(filters.TEXT & ~filters.COMMAND, handle_delete_number)],
         },
         fallbacks=[CommandHandler('cancel', cancel_command)],
-        allow_reentry=True
+        allow_reentry=True,
+        name='deletetask',
+        persistent=persistent
     )
     
     # Add conversation handler for editing tasks
@@ -875,7 +1926,9 @@ def main():
             EDIT_VALUE: [MessageHandler(filters.TEXT & ~filters.COMMAND, handle_edit_value_input)],
         },
         fallbacks=[CommandHandler('cancel', cancel_command)],
-        allow_reentry=True
+        allow_reentry=True,
+        name='edittask',
+        persistent=persistent
     )
     
     # Register handlers (order matters - ConversationHandlers first!)
@@ -885,33 +1938,120 @@ def main():
     application.add_handler(CommandHandler("start", start_command))
     application.add_handler(CommandHandler("help", help_command))
     application.add_handler(CommandHandler("listtasks", list_tasks_command))
+    application.add_handler(CommandHandler("timezone", timezone_command))
+    application.add_handler(CommandHandler("add", quick_add_command))
+    application.add_handler(CommandHandler("export", export_command))
+    application.add_handler(CommandHandler("import", import_command))
+    application.add_handler(MessageHandler(
+        filters.Document.FileExtension('csv') | filters.Document.FileExtension('ics')
+        | filters.Document.FileExtension('txt') | filters.Document.FileExtension('jsonl'),
+        import_document
+    ))
+    application.add_handler(CallbackQueryHandler(handle_page_callback, pattern=r'^page:'))
+    application.add_handler(CallbackQueryHandler(handle_quick_add_callback, pattern=r'^quickadd:'))
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_menu_buttons))
     
-    # Load existing tasks and schedule reminders
-    tasks = load_tasks()
-    for user_id, user_tasks in tasks.items():
-        for idx, task in enumerate(user_tasks):
-            task_datetime = datetime.fromisoformat(task['datetime'])
-            if task_datetime > datetime.now():
-                application.job_queue.run_once(
-                    send_reminder,
-                    when=task_datetime,
-                    data={'task': task, 'chat_id': int(user_id)},
-                    name=f"{user_id}_{idx}"
-                )
+    if METRICS_HANDLER_TIMINGS:
+        conversations = {conv_handler: 'addtask', delete_handler: 'deletetask', edit_handler: 'edittask'}
+        for handler in application.handlers[0]:
+            time_handler(handler, conversations.get(handler, ''))
+
+
+def main():
+    """Start the bot"""
+    # Only one process may write the store; storage.py load checks this too
+    try:
+        store_lock = lock_store(TASKS_DB if STORAGE_BACKEND == 'sqlite' else TASKS_FILE)
+    except StoreLockedError as e:
+        logger.critical(f"Хранилище задач занято другим процессом: {e}")
+        sys.exit(1)
+    
+    # Create application
+    builder = (
+        Application.builder()
+        .token(TELEGRAM_BOT_TOKEN)
+        .base_url(TELEGRAM_API_BASE_URL)
+        .request(TimedHTTPXRequest(
+            connection_pool_size=BOT_POOL_SIZE,
+            http_version=BOT_HTTP_VERSION,
+            keepalive=BOT_KEEPALIVE,
+            read_timeout=BOT_TIMEOUT,
+            write_timeout=BOT_TIMEOUT,
+            connect_timeout=BOT_TIMEOUT,
+            pool_timeout=BOT_POOL_TIMEOUT
+        ))
+        .concurrent_updates(PerUserUpdateProcessor(CONCURRENT_UPDATES))
+        .persistence(persistence)
+        .post_init(on_startup)
+        .post_stop(on_stop)
+        .post_shutdown(on_shutdown)
+    )
+    if WEBHOOK_URL:
+        # Обновления приходят на вебхук, long polling не нужен
+        builder.updater(None)
+    else:
+        builder.get_updates_request(get_updates_request)
+    application = builder.build()
+    
+    register_handlers(application)
+    
+    # Задачи загружаются в фоне после запуска (см. on_startup),
+    # обновления до конца загрузки ждут её в PerUserUpdateProcessor
     
-    # Добавляем периодическую проверку задач каждую минуту
+    # Фоновое сохранение изменённых задач на диск
     application.job_queue.run_repeating(
-        check_tasks_periodically,
-        interval=60,  # Каждые 60 секунд (каждую минуту)
-        first=5  # Первая проверка через 5 секунд
+        flush_tasks_periodically,
+        interval=TASKS_FLUSH_INTERVAL,
+        first=TASKS_FLUSH_INTERVAL
+    )
+    
+    # Данные диалогов неактивных пользователей выгружаются из памяти
+    application.job_queue.run_repeating(
+        evict_idle_user_data,
+        interval=min(USER_DATA_IDLE, 60),
+        first=min(USER_DATA_IDLE, 60)
+    )
+    
+    # Периодически пишем в лог задержку доставки напоминаний
+    # (в режиме воркеров это делает каждый воркер)
+    if SHARD_WORKERS == 0:
+        application.job_queue.run_repeating(
+            log_reminder_stats,
+            interval=REMINDER_STATS_INTERVAL,
+            first=REMINDER_STATS_INTERVAL
+        )
+    
+    application.job_queue.run_repeating(
+        log_api_stats,
+        interval=REMINDER_STATS_INTERVAL,
+        first=REMINDER_STATS_INTERVAL
     )
     
     logger.info("Бот-напоминалка задач запущен!")
-    logger.info("Периодическая проверка задач каждую минуту включена")
     
     # Start the bot
-    application.run_polling(allowed_updates=["message"])
+    if WEBHOOK_URL:
+        server = WebhookServer(
+            application,
+            urlsplit(WEBHOOK_URL).path or '/',
+            WEBHOOK_SECRET or secrets.token_urlsafe(32),
+            max_pending=WEBHOOK_MAX_PENDING
+        )
+        metrics.add_collector(lambda: collect_metrics(application, server))
+        # The loop belongs to asyncio.run(), so the bot stops like on SIGTERM
+        application.bot_data['stop'] = server.stop
+        asyncio.run(run_webhook(
+            application, server, WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_URL, ALLOWED_UPDATES,
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+            keepalive_timeout=WEBHOOK_KEEPALIVE
+        ))
+    else:
+        metrics.add_collector(lambda: collect_metrics(application))
+        application.bot_data['stop'] = application.stop_running
+        application.run_polling(allowed_updates=ALLOWED_UPDATES)
+    store_lock.close()
+    if task_store.load_error is not None:
+        sys.exit(1)
 
 
 if __name__ == '__main__':
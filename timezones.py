@@ -0,0 +1,103 @@
+"""Time zones of users and tasks.
+
+Due times are kept as UTC POSIX timestamps everywhere; a zone is only
+needed where a wall-clock time comes from a user (the add/edit dialogs),
+is shown to one, or is the base of a repeating series (daily at 09:00
+stays at 09:00 across DST changes). A zone is stored by name; None is the
+server's local zone, which is what tasks created before zones existed use.
+"""
+import re
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError, available_timezones
+
+# UTC offsets as users type them: +3, UTC+3, GMT-05:30
+_OFFSET = re.compile(r'(?:UTC|GMT)?\s*([+-])(\d{1,2})(?::?(\d{2}))?', re.IGNORECASE)
+
+
+# Bounded: TZIDs of uploaded iCalendar files come here too
+@lru_cache(maxsize=512)
+def get_zone(name):
+    """tzinfo for a stored zone name, or None for the server's zone"""
+    if name is None:
+        return None
+    match = _OFFSET.fullmatch(name)
+    if match:
+        sign, hours, minutes = match.groups()
+        offset = timedelta(hours=int(hours), minutes=int(minutes or 0))
+        return timezone(-offset if sign == '-' else offset, name)
+    return ZoneInfo(name)
+
+
+@lru_cache(maxsize=1)
+def _zone_names():
+    # Lower-case names to the proper ones; the tz database is case-sensitive
+    return {name.lower(): name for name in available_timezones()}
+
+
+def parse_zone(text):
+    """Name to store for a zone typed by a user; raise ValueError if unknown.
+
+    Accepts IANA names in any case ('europe/moscow') and UTC offsets
+    ('+3', 'UTC+5:30'), which are stored as 'UTC+03:00'.
+    """
+    text = text.strip()
+    match = _OFFSET.fullmatch(text)
+    if match:
+        sign, hours, minutes = match.groups()
+        hours, minutes = int(hours), int(minutes or 0)
+        if hours > 14 or minutes > 59:
+            raise ValueError(f"Invalid UTC offset: {text}")
+        return f"UTC{sign}{hours:02d}:{minutes:02d}"
+    if text.upper() in ('UTC', 'GMT', 'Z'):
+        return 'UTC'
+    name = _zone_names().get(text.lower())
+    if name is None:
+        raise ValueError(f"Unknown time zone: {text}")
+    try:
+        get_zone(name)
+    except ZoneInfoNotFoundError:
+        raise ValueError(f"Unknown time zone: {text}") from None
+    return name
+
+
+def to_local(timestamp, zone=None):
+    """Wall-clock time of a timestamp in the zone, as a naive datetime"""
+    if zone is None:
+        return datetime.fromtimestamp(timestamp)
+    return datetime.fromtimestamp(timestamp, zone).replace(tzinfo=None)
+
+
+def to_timestamp(wall, zone=None):
+    """Timestamp of a naive wall-clock time in the zone.
+
+    A time skipped by a DST change counts as the time before the change
+    (02:30 becomes 03:30); a repeated one is its first occurrence.
+    """
+    return wall.replace(tzinfo=zone).timestamp()
+
+
+def now_local(zone=None):
+    """Current wall-clock time in the zone, as a naive datetime"""
+    return to_local(datetime.now(timezone.utc).timestamp(), zone)
+
+
+def utc_isoformat(timestamp):
+    """ISO string of a timestamp in UTC, the stored form of due times"""
+    return datetime.fromtimestamp(timestamp, timezone.utc).isoformat()
+
+
+def describe_zone(name):
+    """Zone name with its current UTC offset for messages"""
+    if name is None:
+        offset = datetime.now().astimezone().utcoffset()
+        label = "время сервера"
+    elif name == 'UTC' or _OFFSET.fullmatch(name):
+        return name
+    else:
+        offset = datetime.now(get_zone(name)).utcoffset()
+        label = name
+    minutes = int(offset.total_seconds()) // 60
+    sign = '-' if minutes < 0 else '+'
+    hours, minutes = divmod(abs(minutes), 60)
+    return f"{label} (UTC{sign}{hours:02d}:{minutes:02d})"
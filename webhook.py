@@ -0,0 +1,124 @@
+"""Receiving updates through a webhook served by aiohttp.
+
+Telegram POSTs every update to the webhook URL. A request is answered as
+soon as the update is parsed and handed to the application's update
+processor, so slow handlers do not hold Telegram's connections, and
+updates of one user are still handled in order by the processor.
+Requests must carry the secret token passed to setWebhook. At most
+`max_pending` updates may wait or be handled at once; beyond that the
+server answers 503 and Telegram delivers the update again later.
+"""
+import asyncio
+import hmac
+import logging
+import signal
+import time
+
+from aiohttp import web
+from telegram import Update
+
+from scheduler import LatencyTracker
+
+logger = logging.getLogger(__name__)
+
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+
+class WebhookServer:
+    """aiohttp application that feeds Telegram updates to a PTB Application"""
+
+    def __init__(self, application, path, secret, max_pending=1000):
+        self.application = application
+        self.path = path
+        self.secret = secret
+        self.max_pending = max_pending
+        self.pending = 0
+        self.received = 0
+        self.rejected = 0
+        # Time from receiving an update to the end of its handlers
+        self.latency = LatencyTracker()
+        # Set by run_webhook(); stop() ends it like SIGTERM does
+        self.stopping = None
+
+    def stop(self):
+        """Make run_webhook() shut the application down and return"""
+        if self.stopping is not None:
+            self.stopping.set()
+
+    def make_app(self):
+        app = web.Application()
+        app.router.add_post(self.path, self.handle_update)
+        return app
+
+    async def handle_update(self, request):
+        token = request.headers.get(SECRET_HEADER, '')
+        if not hmac.compare_digest(token.encode(), self.secret.encode()):
+            return web.Response(status=403)
+        if self.pending >= self.max_pending:
+            self.rejected += 1
+            return web.Response(status=503)
+        received = time.perf_counter()
+        try:
+            update = Update.de_json(await request.json(), self.application.bot)
+        except Exception as e:
+            logger.warning(f"Некорректное обновление от Telegram: {e}")
+            return web.Response(status=400)
+
+        self.pending += 1
+        self.received += 1
+        self.application.create_task(self._process(update, received), update=update)
+        return web.Response()
+
+    async def _process(self, update, received):
+        try:
+            await self.application.update_processor.process_update(
+                update, self.application.process_update(update)
+            )
+        finally:
+            self.pending -= 1
+            self.latency.add(time.perf_counter() - received)
+
+    def stats(self):
+        return {'received': self.received, 'rejected': self.rejected, 'pending': self.pending}
+
+
+async def run_webhook(application, server, listen, port, url, allowed_updates,
+                      max_connections=40, keepalive_timeout=75):
+    """Run the application with updates coming from `server` until SIGINT/SIGTERM
+    or server.stop().
+
+    Mirrors Application.run_polling: post_init, post_stop and post_shutdown
+    are called at the same points. The webhook stays registered on exit,
+    so Telegram keeps updates until the bot is back.
+    """
+    stopping = server.stopping = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stopping.set)
+
+    runner = web.AppRunner(server.make_app(), access_log=None, keepalive_timeout=keepalive_timeout)
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    await application.start()
+    try:
+        await runner.setup()
+        await web.TCPSite(runner, listen, port).start()
+        await application.bot.set_webhook(
+            url,
+            secret_token=server.secret,
+            allowed_updates=allowed_updates,
+            max_connections=max_connections
+        )
+        logger.info(f"Вебхук {url} принимает обновления на {listen}:{port}")
+        await stopping.wait()
+    finally:
+        # Stop accepting updates first; the application then finishes the
+        # ones already accepted
+        await runner.cleanup()
+        await application.stop()
+        if application.post_stop:
+            await application.post_stop(application)
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)